@@ -1,20 +1,23 @@
-from sqlmodel import Session, select
+from sqlalchemy import func, union
+from sqlmodel import select, and_, or_
+from sqlmodel.ext.asyncio.session import AsyncSession
 import app.models as models
+from app.utils.search import search_statement
 from app.schemas import UserCreate, MessageCreate, ChatCreate, AlbumCreate
 from datetime import datetime, timezone
-from typing import List, Optional
+from typing import AsyncIterator, List, Optional, Sequence, Tuple
 
-def create_user(db: Session, user: UserCreate) -> models.User:
+async def create_user(db: AsyncSession, user: UserCreate) -> models.User:
     db_user = models.User(username=user.username, email=user.email, password=user.password)
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
+    await db.refresh(db_user)
     return db_user
 
-def get_user(db: Session, user_id: int) -> Optional[models.User]:
-    return db.get(models.User, user_id)
+async def get_user(db: AsyncSession, user_id: int) -> Optional[models.User]:
+    return await db.get(models.User, user_id)
 
-def create_message(db: Session, message: MessageCreate, sender_id: int) -> models.Message:
+async def create_message(db: AsyncSession, message: MessageCreate, sender_id: int) -> models.Message:
     db_message = models.Message(
         chat_id=message.chat_id,
         sender_id=sender_id,
@@ -22,31 +25,206 @@ def create_message(db: Session, message: MessageCreate, sender_id: int) -> model
         sent_at=datetime.now(timezone.utc),
     )
     db.add(db_message)
-    db.commit()
-    db.refresh(db_message)
+    await db.commit()
+    await db.refresh(db_message)
     return db_message
 
-def get_messages(db: Session, chat_id: int) -> List[models.Message]:
-    statement = select(models.Message).where(models.Message.chat_id == chat_id)
-    return db.exec(statement).all()
+async def get_messages(
+    db: AsyncSession,
+    chat_id: int,
+    limit: int,
+    before: Optional[Tuple[datetime, int]] = None,
+    after: Optional[Tuple[datetime, int]] = None,
+    columns: Optional[Sequence] = None,
+) -> List[models.Message]:
+    """Return one page of a chat's history in chronological order.
 
-def create_chat(db: Session, chat: ChatCreate) -> models.Chat:
+    Pages are addressed with a ``(sent_at, id)`` keyset cursor so every page is
+    a range scan on ``ix_messages_chat_id_sent_at_id``. Without ``after`` the
+    newest ``limit`` messages (older than ``before``, if given) are returned.
+    With ``columns`` plain rows of those columns are returned instead of
+    entities.
+    """
+    Message = models.Message
+    statement = (select(*columns) if columns else select(Message)).where(Message.chat_id == chat_id)
+
+    if after is not None:
+        sent_at, message_id = after
+        statement = statement.where(
+            or_(Message.sent_at > sent_at, and_(Message.sent_at == sent_at, Message.id > message_id))
+        )
+        return (await db.exec(statement.order_by(Message.sent_at, Message.id).limit(limit))).all()
+
+    if before is not None:
+        sent_at, message_id = before
+        statement = statement.where(
+            or_(Message.sent_at < sent_at, and_(Message.sent_at == sent_at, Message.id < message_id))
+        )
+    page = (await db.exec(statement.order_by(Message.sent_at.desc(), Message.id.desc()).limit(limit))).all()
+    return list(reversed(page))
+
+async def get_messages_after_id(
+    db: AsyncSession, chat_id: int, last_seen_id: int, limit: int, columns: Optional[Sequence] = None
+) -> List[models.Message]:
+    """Return the newest ``limit`` messages with an id above ``last_seen_id``, oldest first.
+
+    Walks ``ix_messages_chat_id_sent_at_id`` backwards from the newest message,
+    so a client that missed little is answered after reading a few entries.
+    """
+    Message = models.Message
+    statement = (
+        (select(*columns) if columns else select(Message))
+        .where(Message.chat_id == chat_id, Message.id > last_seen_id)
+        .order_by(Message.sent_at.desc(), Message.id.desc())
+        .limit(limit)
+    )
+    return list(reversed((await db.exec(statement)).all()))
+
+async def iter_messages(
+    db: AsyncSession, chat_id: int, batch_size: int = 500, columns: Optional[Sequence] = None
+) -> AsyncIterator[List[models.Message]]:
+    """Walk a chat's full history oldest first, one keyset batch at a time.
+
+    Loaded rows are expunged after each batch so the session never holds more
+    than ``batch_size`` messages.
+    """
+    cursor = None
+    while True:
+        batch = await get_messages(db, chat_id, batch_size, after=cursor, columns=columns)
+        if not batch:
+            return
+        cursor = (batch[-1].sent_at, batch[-1].id)
+        yield batch
+        db.expunge_all()
+        if len(batch) < batch_size:
+            return
+
+async def create_chat(db: AsyncSession, chat: ChatCreate) -> models.Chat:
     db_chat = models.Chat(image_id=chat.image_id, created_at=datetime.now(timezone.utc))
     db.add(db_chat)
-    db.commit()
-    db.refresh(db_chat)
+    await db.commit()
+    await db.refresh(db_chat)
     return db_chat
 
-def get_chat(db: Session, chat_id: int, image_id: int) -> Optional[models.Chat]:
+async def get_chat(db: AsyncSession, chat_id: int, image_id: int) -> Optional[models.Chat]:
     statement = select(models.Chat).where((models.Chat.id == chat_id) & (models.Chat.image_id == image_id))
-    return db.exec(statement).first()
+    return (await db.exec(statement)).first()
 
-def create_album(db: Session, album: AlbumCreate, owner_id: int) -> models.Album:
+async def create_album(db: AsyncSession, album: AlbumCreate, owner_id: int) -> models.Album:
     db_album = models.Album(title=album.title, owner_id=owner_id)
     db.add(db_album)
-    db.commit()
-    db.refresh(db_album)
+    await db.commit()
+    await db.refresh(db_album)
     return db_album
 
-def get_album(db: Session, album_id: int) -> Optional[models.Album]:
-    return db.get(models.Album, album_id)
+async def get_album(db: AsyncSession, album_id: int) -> Optional[models.Album]:
+    return await db.get(models.Album, album_id)
+
+def accessible_album_ids(user_id: int):
+    """Subquery of the ids of albums a user owns or has joined (column ``album_id``).
+
+    Owned and joined albums are collected with a ``UNION`` so each branch can
+    use its own index and albums are never duplicated.
+    """
+    return union(
+        select(models.Album.id.label("album_id")).where(models.Album.owner_id == user_id),
+        select(models.AlbumParticipant.album_id).where(models.AlbumParticipant.user_id == user_id),
+    ).subquery()
+
+async def get_user_albums(
+    db: AsyncSession,
+    user_id: int,
+    limit: int,
+    before: Optional[Tuple[datetime, int]] = None,
+) -> List[Tuple[models.Album, int, datetime]]:
+    """Return a page of the albums a user owns or has joined, newest first.
+
+    Each row carries the album, its image count and the time of its latest
+    message (or its creation time if nobody wrote yet).
+    """
+    Album, Image, Chat, Message = models.Album, models.Image, models.Chat, models.Message
+    accessible = accessible_album_ids(user_id)
+
+    image_count = (
+        select(func.count(Image.id)).where(Image.album_id == Album.id).correlate(Album).scalar_subquery()
+    )
+    # Latest message per chat is one seek on ix_messages_chat_id_sent_at_id,
+    # so the cost grows with the album's chats, not with their messages.
+    chat_last_message_at = (
+        select(Message.sent_at)
+        .where(Message.chat_id == Chat.id)
+        .order_by(Message.sent_at.desc())
+        .limit(1)
+        .correlate(Chat)
+        .scalar_subquery()
+    )
+    last_message_at = (
+        select(func.max(chat_last_message_at))
+        .select_from(Chat)
+        .join(Image, Image.id == Chat.image_id)
+        .where(Image.album_id == Album.id)
+        .correlate(Album)
+        .scalar_subquery()
+    )
+
+    statement = select(Album, image_count, func.coalesce(last_message_at, Album.created_at)).join(
+        accessible, accessible.c.album_id == Album.id
+    )
+    if before is not None:
+        created_at, album_id = before
+        statement = statement.where(
+            or_(Album.created_at < created_at, and_(Album.created_at == created_at, Album.id < album_id))
+        )
+    statement = statement.order_by(Album.created_at.desc(), Album.id.desc()).limit(limit)
+    return (await db.exec(statement)).all()
+
+async def get_album_feed(
+    db: AsyncSession,
+    album_id: int,
+    limit: int,
+    before: Optional[int] = None,
+) -> Tuple[Optional[models.Album], List[dict]]:
+    """Load an album screen with a fixed number of queries, whatever the page size.
+
+    Returns the album and a page of its images, newest first, each as a dict
+    with the image, its chat id, message count and latest message.
+    """
+    Image, Chat, Message = models.Image, models.Chat, models.Message
+    album = await db.get(models.Album, album_id)
+    if album is None:
+        return None, []
+
+    statement = select(Image).where(Image.album_id == album_id)
+    if before is not None:
+        statement = statement.where(Image.id < before)
+    images = (await db.exec(statement.order_by(Image.id.desc()).limit(limit))).all()
+    if not images:
+        return album, []
+
+    chat_rows = (await db.exec(
+        select(Chat.id, Chat.image_id, func.count(Message.id), func.max(Message.id))
+        .outerjoin(Message, Message.chat_id == Chat.id)
+        .where(Chat.image_id.in_([image.id for image in images]))
+        .group_by(Chat.id, Chat.image_id)
+        .order_by(Chat.id.desc())
+    )).all()
+    # Ordered so the oldest chat wins if an image somehow has several.
+    chats = {image_id: (chat_id, count, latest_id) for chat_id, image_id, count, latest_id in chat_rows}
+
+    latest_ids = [latest_id for _, _, latest_id in chats.values() if latest_id is not None]
+    latest = {}
+    if latest_ids:
+        latest = {m.id: m for m in (await db.exec(select(Message).where(Message.id.in_(latest_ids)))).all()}
+
+    feed = []
+    for image in images:
+        chat_id, count, latest_id = chats.get(image.id, (None, 0, None))
+        feed.append({"image": image, "chat_id": chat_id, "message_count": count, "latest_message": latest.get(latest_id)})
+    return album, feed
+
+async def search(db: AsyncSession, user_id: int, terms: str, limit: int, offset: int = 0) -> list:
+    """Rank messages and image titles/descriptions matching ``terms`` in the user's albums."""
+    statement = search_statement(db.bind.dialect.name, accessible_album_ids(user_id), terms)
+    if statement is None:
+        return []
+    return (await db.exec(statement.limit(limit).offset(offset))).all()
@@ -1,7 +1,15 @@
-from sqlalchemy import NullPool
-from sqlmodel import create_engine, Session, SQLModel
+from collections import deque
+from sqlalchemy import NullPool, event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlmodel import create_engine, SQLModel
+from sqlmodel.ext.asyncio.session import AsyncSession
 from dotenv import load_dotenv
 import os
+import time
+
+from app.utils.metrics import instrument_engine
 
 
 os.makedirs("./database", exist_ok=True)
@@ -10,6 +18,76 @@ load_dotenv()
 # a temporary database file.
 USER = os.getenv("user")
 
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """Queue pool that records how long each checkout waited for a connection."""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.waits: deque = deque(maxlen=1000)
+        self.timeouts = 0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            self.waits.append(time.perf_counter() - start)
+
+
+def pool_options() -> dict:
+    """Pool settings for the request engine, driven by ``DB_POOL_*`` env vars.
+
+    ``DB_POOL_MODE=external`` disables client-side pooling for deployments
+    behind PgBouncer or a similar pooler.
+    """
+    if os.getenv("DB_POOL_MODE", "internal") == "external":
+        return {"poolclass": NullPool}
+    return {
+        "poolclass": TimedQueuePool,
+        "pool_size": int(os.getenv("DB_POOL_SIZE", "5")),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "10")),
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "1800")),
+        "pool_pre_ping": os.getenv("DB_POOL_PRE_PING", "true").lower() == "true",
+        "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", "30")),
+    }
+
+
+def sqlite_pragmas(read_only: bool = False):
+    """Build a connect hook applying the SQLite profile chosen by ``SQLITE_PROFILE``.
+
+    The ``production`` profile (default) switches to WAL so readers never block
+    on the writer, relaxes fsync to once per checkpoint and sizes the page
+    cache and memory map. ``basic`` keeps SQLite's defaults. Foreign keys,
+    which the schema relies on for cascading deletes, are always enforced.
+    """
+    pragmas = ["PRAGMA foreign_keys=ON"]
+    if os.getenv("SQLITE_PROFILE", "production") == "production":
+        pragmas += [
+            "PRAGMA journal_mode=WAL",
+            "PRAGMA synchronous=NORMAL",
+            f"PRAGMA busy_timeout={int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))}",
+            f"PRAGMA mmap_size={int(os.getenv('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)))}",
+            f"PRAGMA cache_size={int(os.getenv('SQLITE_CACHE_SIZE', '-65536'))}",
+            "PRAGMA temp_store=MEMORY",
+        ]
+    if read_only:
+        pragmas.append("PRAGMA query_only=ON")
+
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+    return on_connect
+
+
+# Requests are served through ``async_engine`` (writes) and ``read_engine``
+# (reads). The sync ``engine`` points at the same database and is kept for
+# schema management and scripts.
 if USER:
     PASSWORD = os.getenv("password")
     HOST = os.getenv("host")
@@ -17,24 +95,91 @@ if USER:
     DBNAME = os.getenv("dbname")
 
     DATABASE_URL = f"postgresql+psycopg2://{USER}:{PASSWORD}@{HOST}:{PORT}/{DBNAME}?sslmode=require"
+    ASYNC_DATABASE_URL = f"postgresql+asyncpg://{USER}:{PASSWORD}@{HOST}:{PORT}/{DBNAME}?ssl=require"
     engine = create_engine(DATABASE_URL, poolclass=NullPool)
+    if os.getenv("DB_POOL_MODE", "internal") == "external":
+        # Transaction-mode poolers cannot keep prepared statements per client.
+        ASYNC_DATABASE_URL += "&prepared_statement_cache_size=0"
+        async_engine = create_async_engine(
+            ASYNC_DATABASE_URL, connect_args={"statement_cache_size": 0}, **pool_options()
+        )
+    else:
+        async_engine = create_async_engine(ASYNC_DATABASE_URL, **pool_options())
+    read_engine = async_engine
 else:
-    DATABASE_URL = "sqlite:///./database/sql_app.db"
+    DATABASE_URL = os.getenv("SQLMODEL_DATABASE_URL", "sqlite:///./database/sql_app.db")
+    ASYNC_DATABASE_URL = DATABASE_URL.replace("sqlite://", "sqlite+aiosqlite://", 1)
     engine = create_engine(
         DATABASE_URL,
         connect_args={"check_same_thread": False},
     )
+    # SQLite allows one writer at a time: a single pooled connection serializes
+    # writes in-process instead of failing with "database is locked", while a
+    # separate read-only pool serves queries from the WAL snapshot.
+    pool_timeout = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+    async_engine = create_async_engine(
+        ASYNC_DATABASE_URL, poolclass=TimedQueuePool, pool_size=1, max_overflow=0, pool_timeout=pool_timeout
+    )
+    read_engine = create_async_engine(
+        ASYNC_DATABASE_URL,
+        poolclass=TimedQueuePool,
+        pool_size=int(os.getenv("SQLITE_READERS", "4")),
+        max_overflow=0,
+        pool_timeout=pool_timeout,
+    )
+    event.listen(engine, "connect", sqlite_pragmas())
+    event.listen(async_engine.sync_engine, "connect", sqlite_pragmas())
+    event.listen(read_engine.sync_engine, "connect", sqlite_pragmas(read_only=True))
+
+instrument_engine(engine, "sync")
+instrument_engine(async_engine.sync_engine, "write")
+if read_engine is not async_engine:
+    instrument_engine(read_engine.sync_engine, "read")
 
 
-def get_db():
-    with Session(engine) as session:
+async def get_db():
+    # Attributes stay loaded after commit: lazy refreshes are not possible
+    # outside of an awaited call.
+    async with AsyncSession(async_engine, expire_on_commit=False) as session:
         yield session
 
+async def get_read_db():
+    """Session for handlers that only read; never waits behind the writer."""
+    async with AsyncSession(read_engine, expire_on_commit=False) as session:
+        yield session
+
+def _pool_stats(pool) -> dict:
+    stats = {"pool": type(pool).__name__}
+    if isinstance(pool, AsyncAdaptedQueuePool):
+        stats.update(
+            size=pool.size(),
+            checked_in=pool.checkedin(),
+            checked_out=pool.checkedout(),
+            overflow=pool.overflow(),
+        )
+    if isinstance(pool, TimedQueuePool):
+        waits = sorted(pool.waits)
+        stats.update(
+            timeouts=pool.timeouts,
+            wait_ms_p50=round(waits[len(waits) // 2] * 1000, 2) if waits else None,
+            wait_ms_max=round(waits[-1] * 1000, 2) if waits else None,
+        )
+    return stats
+
+def pool_stats() -> dict:
+    stats = {"write": _pool_stats(async_engine.pool)}
+    if read_engine is not async_engine:
+        stats["read"] = _pool_stats(read_engine.pool)
+    return stats
+
 def init_db():
+    from app.utils.search import create_search_indexes
+
     SQLModel.metadata.create_all(engine)
+    create_search_indexes(engine)
 
 try:
     with engine.connect() as connection:
         print("Connection successful!")
 except Exception as e:
-    print(f"Failed to connect: {e}")
\ No newline at end of file
+    print(f"Failed to connect: {e}")
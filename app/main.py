@@ -1,31 +1,121 @@
-from fastapi import FastAPI, Depends
-from sqlmodel import Session
+from contextlib import asynccontextmanager
 
-from app.database import get_db, init_db
+from fastapi import APIRouter, FastAPI, Depends
+from fastapi.responses import PlainTextResponse
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.database import get_db, init_db, pool_stats
 import app.models as models
+from app.utils.hashing import password_hasher
+from app.utils.admission import AdmissionMiddleware, admission
+from app.utils.export import exports
+from app.utils.jobs import jobs
+from app.utils.metrics import MetricsMiddleware, registry
+from app.utils.profiling import QueryProfilerMiddleware
+from app.utils.ratelimit import limiter_stats
+from app.utils.security import require_ops_token
+from app.utils.thumbnails import thumbnails
 
 import app.routes.users as users_router
 import app.routes.messages as messages_router
+from app.routes.jobs import jobs_router
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await jobs.resume()
+    yield
+    await jobs.stop()
+    await admission.stop()
+    await messages_router.writer.stop()
+    await messages_router.manager.backend.stop()
+    password_hasher.shutdown()
+    thumbnails.shutdown()
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(AdmissionMiddleware)
+app.add_middleware(QueryProfilerMiddleware)
+# Added last so it is outermost and also times requests that are shed.
+app.add_middleware(MetricsMiddleware)
 
 @app.get("/")
-def read_root():
+async def read_root():
     return {"message": "Hello World"}
 
 @app.get("/testdb")
-def test_db(db: Session = Depends(get_db)):
+async def test_db(db: AsyncSession = Depends(get_db)):
     try:
         test_album = models.Album(title="Test Album", owner_id=1)
         db.add(test_album)
-        db.commit()
-        db.refresh(test_album)
+        await db.commit()
+        await db.refresh(test_album)
 
-        album = db.query(models.Album).filter(models.Album.title == "Test Album").first()
+        album = (await db.exec(select(models.Album).where(models.Album.title == "Test Album"))).first()
         return {"message": "Database is working"}
     except Exception as e:
         return {"message": f"Database error: {e}"}
 
+# Operational endpoints, for holders of OPS_TOKEN only.
+ops_router = APIRouter(dependencies=[Depends(require_ops_token)])
+
+@ops_router.get("/stats/hashing")
+async def hashing_stats():
+    return password_hasher.stats()
+
+@ops_router.get("/stats/db")
+async def db_stats():
+    return pool_stats()
+
+@ops_router.get("/stats/hot_chats")
+async def hot_chat_stats():
+    return messages_router.manager.recent.stats()
+
+@ops_router.get("/stats/exports")
+async def export_stats():
+    return exports.stats()
+
+@ops_router.get("/stats/load")
+async def load_stats():
+    return {"admission": admission.stats(), "rate_limits": limiter_stats()}
+
+@registry.collector
+def component_metrics():
+    """Read the state kept by each component at scrape time."""
+    connections = messages_router.manager.connections
+    yield ("ws_connections", "gauge", "Open chat WebSockets held by this worker.", ("chat_id",),
+           [((chat_id,), len(sockets)) for chat_id, sockets in connections.items()])
+
+    hashing = password_hasher.stats()
+    yield ("password_hash_in_flight", "gauge", "Password hashes running or queued.", (), [((), hashing["in_flight"])])
+    yield ("password_hash_completed_total", "counter", "Password hashes completed.", (), [((), hashing["completed"])])
+    yield ("password_hash_rejected_total", "counter", "Password hashes rejected as overloaded.", (), [((), hashing["rejected"])])
+    yield ("password_hash_pool_restarts_total", "counter", "Hash pools replaced after a worker died.", (), [((), hashing["restarts"])])
+
+    pools = pool_stats()
+    for field, help in (
+        ("checked_out", "Connections in use."),
+        ("checked_in", "Idle connections."),
+        ("overflow", "Connections opened beyond the pool size."),
+        ("timeouts", "Checkouts that timed out."),
+    ):
+        yield (f"db_pool_{field}", "counter" if field == "timeouts" else "gauge", help, ("pool",),
+               [((name,), stats.get(field)) for name, stats in pools.items()])
+
+    load = admission.stats()
+    yield ("event_loop_lag_seconds", "gauge", "Last measured event loop lag.", (), [((), load["event_loop_lag_ms"] / 1000)])
+    yield ("threadpool_queue", "gauge", "Tasks waiting for a threadpool worker.", (), [((), load["threadpool_queue"])])
+    yield ("admission_rejected_total", "counter", "Requests shed by admission control.", (), [((), load["rejected"])])
+    yield ("rate_limit_rejected_total", "counter", "Requests refused by a rate limit.", ("limiter",),
+           [((name,), stats["rejected"]) for name, stats in limiter_stats().items()])
+
+    hot = messages_router.manager.recent.stats()
+    yield ("hot_chat_hits_total", "counter", "Reconnects served from the recent message buffer.", (), [((), hot["hits"])])
+    yield ("hot_chat_misses_total", "counter", "Reconnects that fell back to the database.", (), [((), hot["misses"])])
+
+@ops_router.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
 @app.get("/initdb")
 def start():
     init_db()
@@ -34,3 +124,5 @@ def start():
 app.include_router(users_router.auth_router)
 app.include_router(users_router.me_router)
 app.include_router(messages_router.messages_router)
+app.include_router(jobs_router)
+app.include_router(ops_router)
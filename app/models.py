@@ -1,5 +1,10 @@
-from sqlmodel import SQLModel, Field, Relationship
+from sqlmodel import SQLModel, Field, Relationship, Index
 from datetime import datetime, timezone
+from typing import Optional
+
+# Child rows are removed by ON DELETE CASCADE foreign keys. passive_deletes
+# stops the ORM from loading children just to delete them one by one.
+PASSIVE = {"cascade": "all, delete", "passive_deletes": True}
 
 class User(SQLModel, table=True):
 
@@ -10,22 +15,27 @@ class User(SQLModel, table=True):
     username: str = Field(index=True, nullable=False)
     password: str = Field(nullable=False)
 
-    albums: list["Album"] = Relationship(back_populates="owner")
-    messages: list["Message"] = Relationship(back_populates="sender")
-    albums_participation: list["AlbumParticipant"] = Relationship(back_populates="user")
+    albums: list["Album"] = Relationship(back_populates="owner", sa_relationship_kwargs=PASSIVE)
+    messages: list["Message"] = Relationship(back_populates="sender", sa_relationship_kwargs=PASSIVE)
+    albums_participation: list["AlbumParticipant"] = Relationship(back_populates="user", sa_relationship_kwargs=PASSIVE)
 
 class Album(SQLModel, table=True):
 
     __tablename__ = "albums"
+    __table_args__ = (
+        Index("ix_albums_owner_id_created_at", "owner_id", "created_at"),
+    )
 
     id: int = Field(primary_key=True, index=True)
     title: str = Field(index=True, nullable=False)
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
-    owner_id: int = Field(foreign_key="users.id", nullable=False)
+    owner_id: int = Field(foreign_key="users.id", ondelete="CASCADE", nullable=False)
+    # Bumped whenever the album or its images change; used as the ETag.
+    version: int = Field(default=0, nullable=False, sa_column_kwargs={"server_default": "0"})
 
     owner: "User" = Relationship(back_populates="albums")
-    images: list["Image"] = Relationship(back_populates="album", sa_relationship_kwargs={"cascade": "all, delete"})
-    participants: list["AlbumParticipant"] = Relationship(back_populates="album")
+    images: list["Image"] = Relationship(back_populates="album", sa_relationship_kwargs=PASSIVE)
+    participants: list["AlbumParticipant"] = Relationship(back_populates="album", sa_relationship_kwargs=PASSIVE)
 
 class Image(SQLModel, table=True):
 
@@ -35,9 +45,12 @@ class Image(SQLModel, table=True):
     title: str = Field(index=True, nullable=False)
     description: str = Field(nullable=True)
     path: str = Field(nullable=False)
-    album_id: int = Field(foreign_key="albums.id", nullable=False)
+    album_id: int = Field(foreign_key="albums.id", ondelete="CASCADE", index=True, nullable=False)
+    sha256: str = Field(default=None, index=True, nullable=True)
+    content_type: str = Field(default=None, nullable=True)
+    size: int = Field(default=None, nullable=True)
 
-    chat: "Chat" = Relationship(back_populates="image", sa_relationship_kwargs={"cascade": "all, delete"})
+    chat: "Chat" = Relationship(back_populates="image", sa_relationship_kwargs=PASSIVE)
     album: "Album" = Relationship(back_populates="images")
 
 class Chat(SQLModel, table=True):
@@ -45,21 +58,26 @@ class Chat(SQLModel, table=True):
     __tablename__ = "chats"
 
     id: int = Field(primary_key=True, index=True)
-    image_id: int = Field(foreign_key="images.id", nullable=False)
+    image_id: int = Field(foreign_key="images.id", ondelete="CASCADE", index=True, nullable=False)
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    # Bumped whenever a message is added; used as the ETag of the history.
+    version: int = Field(default=0, nullable=False, sa_column_kwargs={"server_default": "0"})
 
     image: "Image" = Relationship(back_populates="chat")
-    messages: list["Message"] = Relationship(back_populates="chat")
+    messages: list["Message"] = Relationship(back_populates="chat", sa_relationship_kwargs=PASSIVE)
 
 class Message(SQLModel, table=True):
 
     __tablename__ = "messages"
+    __table_args__ = (
+        Index("ix_messages_chat_id_sent_at_id", "chat_id", "sent_at", "id"),
+    )
 
     id: int = Field(primary_key=True, index=True)
     content: str = Field(nullable=False)
     sent_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
-    sender_id: int = Field(foreign_key="users.id", nullable=False)
-    chat_id: int = Field(foreign_key="chats.id", nullable=False)
+    sender_id: int = Field(foreign_key="users.id", ondelete="CASCADE", index=True, nullable=False)
+    chat_id: int = Field(foreign_key="chats.id", ondelete="CASCADE", nullable=False)
 
     sender: "User" = Relationship(back_populates="messages")
     chat: "Chat" = Relationship(back_populates="messages")
@@ -67,9 +85,26 @@ class Message(SQLModel, table=True):
 class AlbumParticipant(SQLModel, table=True):
 
     __tablename__ = "album_participants"
+    # The (user_id, album_id) primary key doubles as the index for
+    # "albums joined by user" lookups.
 
-    user_id: int = Field(foreign_key="users.id", primary_key=True)
-    album_id: int = Field(foreign_key="albums.id", primary_key=True)
+    user_id: int = Field(foreign_key="users.id", ondelete="CASCADE", primary_key=True)
+    album_id: int = Field(foreign_key="albums.id", ondelete="CASCADE", primary_key=True, index=True)
 
     user: "User" = Relationship(back_populates="albums_participation")
     album: "Album" = Relationship(back_populates="participants")
+
+class Job(SQLModel, table=True):
+    """A long-running delete executed in the background."""
+
+    __tablename__ = "jobs"
+
+    # Random token: knowing it is what allows polling the job.
+    id: str = Field(primary_key=True)
+    kind: str = Field(nullable=False)
+    target_id: int = Field(nullable=False)
+    status: str = Field(default="pending", index=True, nullable=False)
+    progress: int = Field(default=0, nullable=False)
+    error: Optional[str] = Field(default=None, nullable=True)
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
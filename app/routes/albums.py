@@ -1,98 +1,150 @@
-from fastapi import APIRouter, Depends, HTTPException
-from typing import List
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from typing import List, Optional
 
-from sqlmodel import Session, select,or_, and_
+from sqlmodel.ext.asyncio.session import AsyncSession
 
-from app.database import get_db
+from app.database import get_db, get_read_db
 import app.models as models
-from app.schemas import UserResponse
-from app.schemas import AlbumCreate, AlbumResponse
+from app.schemas import JobAccepted, UserResponse
+from app.schemas import AlbumCreate, AlbumResponse, AlbumSummaryResponse, AlbumFeedResponse, FeedImageResponse, ImageResponse, MessagePreview
+from app import crud
 
 from app.routes.images import images_router, me_images_router
 
 from app.utils.security import get_current_user
+from app.utils.concurrent import participation_controller, verify_album_access
+from app.utils.export import album_archive
+from app.utils.jobs import jobs
+from app.utils.pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, encode_cursor, decode_cursor
+from app.utils.versions import album_version, bump_album_version, conditional_json, entity_tag
 
 
 me_albums_router = APIRouter(prefix="/albums", tags=["albums"])
 
-@me_albums_router.get("/", response_model=List[AlbumResponse])
-def read_user_albums(current_user: UserResponse = Depends(get_current_user), db: Session = Depends(get_db)):
-    albums = db.exec(select(models.Album).join(models.AlbumParticipant, isouter=True).where(
-        or_(
-            models.Album.owner_id == current_user.id,
-            models.AlbumParticipant.user_id == current_user.id
+@me_albums_router.get("/", response_model=List[AlbumSummaryResponse])
+async def read_user_albums(
+    response: Response,
+    before: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    current_user: UserResponse = Depends(get_current_user),
+    db: AsyncSession = Depends(get_read_db),
+):
+    """Albums the user owns or participates in, newest first.
+
+    Pass the ``X-Next-Cursor`` header of a page as ``before`` to get the next one.
+    """
+    rows = await crud.get_user_albums(db, current_user.id, limit, before=decode_cursor(before) if before else None)
+    if len(rows) == limit:
+        last = rows[-1][0]
+        response.headers["X-Next-Cursor"] = encode_cursor(last.created_at, last.id)
+    return [
+        AlbumSummaryResponse(
+            id=album.id,
+            title=album.title,
+            created_at=album.created_at,
+            owner_id=album.owner_id,
+            image_count=image_count,
+            last_activity_at=last_activity_at,
         )
-    ))
-    return albums
+        for album, image_count, last_activity_at in rows
+    ]
+
 @me_albums_router.post("/new_album")
-def create_album(album: AlbumCreate, current_user: UserResponse = Depends(get_current_user), db: Session = Depends(get_db)):
+async def create_album(album: AlbumCreate, current_user: UserResponse = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
     new_album = models.Album(title=album.title, owner_id=current_user.id)
     db.add(new_album)
-    db.commit()
-    db.refresh(new_album)
+    await db.commit()
+    await db.refresh(new_album)
     return new_album
 
 @me_albums_router.get("/{album_id}", response_model=AlbumResponse)
-def read_album(album_id: int, current_user: UserResponse = Depends(get_current_user), db: Session = Depends(get_db)):
-    album = db.get(models.Album, album_id)
-    if not album:
+async def read_album(album_id: int, request: Request, current_user: UserResponse = Depends(get_current_user), db: AsyncSession = Depends(get_read_db)):
+    await verify_album_access(album_id, db, current_user)
+    version = await album_version(db, album_id)
+    if version is None:
         raise HTTPException(status_code=404, detail="Album not found")
 
-    if album.owner_id != current_user.id:
-        participant = db.exec(select(models.AlbumParticipant).where(
-            and_(
-                models.AlbumParticipant.user_id == current_user.id,
-                models.AlbumParticipant.album_id == album_id
+    async def render():
+        album = await db.get(models.Album, album_id)
+        return AlbumResponse.model_validate(album).model_dump_json().encode(), {}
+
+    return await conditional_json(request, entity_tag("album", album_id, version), render)
+
+@me_albums_router.get("/{album_id}/feed", response_model=AlbumFeedResponse)
+async def read_album_feed(
+    album_id: int,
+    response: Response,
+    before: Optional[int] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    current_user: UserResponse = Depends(get_current_user),
+    db: AsyncSession = Depends(get_read_db),
+):
+    """Everything an album screen needs: the album and a page of images with chat summaries.
+
+    Images are newest first; pass ``X-Next-Cursor`` as ``before`` for the next page.
+    """
+    await verify_album_access(album_id, db, current_user)
+
+    album, feed = await crud.get_album_feed(db, album_id, limit, before=before)
+    if album is None:
+        raise HTTPException(status_code=404, detail="Album not found")
+    if len(feed) == limit:
+        response.headers["X-Next-Cursor"] = str(feed[-1]["image"].id)
+
+    return AlbumFeedResponse(
+        album=AlbumResponse.model_validate(album),
+        images=[
+            FeedImageResponse(
+                **ImageResponse.model_validate(entry["image"]).model_dump(),
+                chat_id=entry["chat_id"],
+                message_count=entry["message_count"],
+                latest_message=MessagePreview.model_validate(entry["latest_message"]) if entry["latest_message"] else None,
             )
-        ))
-        if not participant:
-            raise HTTPException(status_code=403, detail="Album not found")
-
-    return album
+            for entry in feed
+        ],
+    )
+
+@me_albums_router.get("/{album_id}/export")
+async def export_album(album_id: int, current_user: UserResponse = Depends(get_current_user), db: AsyncSession = Depends(get_read_db)):
+    """Download the whole album as a zip, generated while it is sent. Progress is at /stats/exports."""
+    await verify_album_access(album_id, db, current_user)
+    await db.close()
+    return StreamingResponse(
+        album_archive(album_id, current_user.id),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="album-{album_id}.zip"'},
+    )
 
 @me_albums_router.delete("/delete/{album_id}")
-def delete_album(album_id: int, current_user: UserResponse = Depends(get_current_user), db: Session = Depends(get_db)):
-    album = db.get(models.Album, album_id)
-    if not current_user.id == album.owner_id:
-        participant = db.exec(select(models.AlbumParticipant).where(
-            and_(
-                models.AlbumParticipant.user_id == current_user.id,
-                models.Album == album_id
-            )
-        )).first()
+async def delete_album(album_id: int, response: Response, current_user: UserResponse = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    access = await participation_controller(album_id, db, current_user)
+    if not current_user.id == access.owner_id:
+        participant = access.is_participant and await db.get(models.AlbumParticipant, (current_user.id, album_id))
         if not participant:
             raise HTTPException(status_code=401, detail="denied")
 
-        db.delete(participant)
-        db.commit()
+        await db.delete(participant)
+        await db.commit()
         return {"message": "deleted for you"}
 
 
-    db.delete(album)
-    db.commit()
-    return {"message": "Album deleted successfully"}
+    # Large albums take a while: their rows are removed in batches by a job.
+    job = await jobs.submit(db, "delete_album", album_id)
+    response.status_code = 202
+    return JobAccepted(job_id=job.id, status_url=f"/jobs/{job.id}")
 
 @me_albums_router.put("update/{album_id}")
-def update_album(album_id: int, album_data: AlbumCreate, current_user: UserResponse = Depends(get_current_user), db: Session = Depends(get_db)):
-    db_album = db.get(models.Album, album_id)
-    if not current_user.id == db_album.owner_id:
-        participant = db.exec(select(models.AlbumParticipant).where(
-            and_(
-                models.AlbumParticipant.user_id == current_user.id,
-                models.Album == album_id
-            )
-        )).first()
-        if not participant:
-            raise HTTPException(status_code=401, detail="denied")
-
-        db_album.title = album_data.title
-        db.commit()
-        db.refresh(db_album)
-        return db_album
+async def update_album(album_id: int, album_data: AlbumCreate, current_user: UserResponse = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    access = await participation_controller(album_id, db, current_user)
+    if not access.allows(current_user.id):
+        raise HTTPException(status_code=401, detail="denied")
 
+    db_album = await db.get(models.Album, album_id)
     db_album.title = album_data.title
-    db.commit()
-    db.refresh(db_album)
+    await bump_album_version(db, album_id)
+    await db.commit()
+    await db.refresh(db_album)
     return db_album
 
 me_albums_router.include_router(images_router)
@@ -1,89 +1,271 @@
-from fastapi import Depends, HTTPException, APIRouter
-from sqlmodel import Session, select
-from typing import List
+from fastapi import Body, Depends, HTTPException, APIRouter, File, Form, Request, Response, UploadFile
+from sqlalchemy import delete, insert, update
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from typing import List, Optional
+import os
 
-from app.schemas import ImageCreate, ImageResponse
+from app.schemas import BulkImageResult, ImageCreate, ImageResponse, ImageUpdate
 from app.schemas import UserResponse
-from app.database import get_db
+from app.database import get_db, get_read_db
 import app.models as models
 
 from app.utils.security import get_current_user
-from app.utils.concurrent import participation_controller, get_image, not_found_exception, existing_element_exception
+from app.utils.concurrent import verify_album_access, get_image, not_found_exception, existing_element_exception
+from app.utils.storage import (
+    IMAGE_CONTENT_TYPES, MEDIA_ROOT, BlobResponse, UploadRoute, blob_path, release_blob, save_upload,
+    stored_content_type,
+)
+from app.utils.thumbnails import SIZES, placeholder_svg, thumbnails
+from app.utils.serialization import dump_rows, response_columns
+from app.utils.versions import album_version, bump_album_version, conditional_json, entity_tag, etag_matches
+
+THUMB_SYNC_TIMEOUT = float(os.getenv("THUMB_SYNC_TIMEOUT", "2"))
+MAX_BULK_ITEMS = int(os.getenv("MAX_BULK_ITEMS", "500"))
+
+image_columns = response_columns(models.Image, ImageResponse)
 
 images_router = APIRouter(prefix='/images', tags=["images"])
-me_images_router = APIRouter(prefix='/{album_id}/images', tags=["me_images"])
+me_images_router = APIRouter(prefix='/{album_id}/images', tags=["me_images"], route_class=UploadRoute)
 
 @me_images_router.post("/create")
-def create_image(album_id: int, image: ImageCreate, current_user: UserResponse = Depends(get_current_user), db: Session = Depends(get_db)):
-    album, participant = participation_controller(album_id, db, current_user)
+async def create_image(album_id: int, image: ImageCreate, current_user: UserResponse = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    await verify_album_access(album_id, db, current_user)
+
+    new_image = models.Image(title=image.title, description=image.description, path=image.image_path, album_id=album_id)
+    db.add(new_image)
+    await bump_album_version(db, album_id)
+    await db.commit()
+    await db.refresh(new_image)
+    return new_image
 
-    if not album.owner_id == current_user.id and not participant:
-        raise HTTPException(status_code=403, detail="Album not found")
 
+def check_bulk_size(items: list) -> None:
+    if not items:
+        raise HTTPException(status_code=400, detail="No items given")
+    if len(items) > MAX_BULK_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_BULK_ITEMS} items per request")
 
+@me_images_router.post("/bulk/create", response_model=List[BulkImageResult])
+async def bulk_create_images(album_id: int, images: List[ImageCreate], current_user: UserResponse = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    """Create many images with one access check, one multi-row INSERT and one commit."""
+    check_bulk_size(images)
+    await verify_album_access(album_id, db, current_user)
 
-    new_image = models.Image(title=image.title, description=image.description, path=image.image_path, album_id=album_id)
-    db.add(new_image)
-    db.commit()
-    db.refresh(new_image)
+    ids = (await db.exec(
+        insert(models.Image).returning(models.Image.id, sort_by_parameter_order=True),
+        params=[
+            {"title": image.title, "description": image.description, "path": image.image_path, "album_id": album_id}
+            for image in images
+        ],
+    )).scalars().all()
+    await bump_album_version(db, album_id)
+    await db.commit()
+    return [BulkImageResult(index=index, id=image_id, status="created") for index, image_id in enumerate(ids)]
+
+@me_images_router.put("/bulk/update", response_model=List[BulkImageResult])
+async def bulk_update_images(album_id: int, images: List[ImageUpdate], current_user: UserResponse = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    """Update many images of the album in one transaction; unknown ids are reported, not fatal."""
+    check_bulk_size(images)
+    await verify_album_access(album_id, db, current_user)
+
+    found = set((await db.exec(
+        select(models.Image.id).where(models.Image.album_id == album_id, models.Image.id.in_({image.id for image in images}))
+    )).all())
+    rows = [
+        {"id": image.id, "title": image.title, "description": image.description, "path": image.image_path}
+        for image in images if image.id in found
+    ]
+    if rows:
+        await db.exec(update(models.Image), params=rows)
+        await bump_album_version(db, album_id)
+        await db.commit()
+    return [
+        BulkImageResult(index=index, id=image.id, status="updated" if image.id in found else "not_found")
+        for index, image in enumerate(images)
+    ]
+
+@me_images_router.post("/bulk/delete", response_model=List[BulkImageResult])
+async def bulk_delete_images(album_id: int, image_ids: List[int] = Body(...), current_user: UserResponse = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    """Delete many images with their chats and messages using set-based DELETEs in one transaction."""
+    check_bulk_size(image_ids)
+    await verify_album_access(album_id, db, current_user)
+
+    found = dict((await db.exec(
+        select(models.Image.id, models.Image.sha256).where(models.Image.album_id == album_id, models.Image.id.in_(set(image_ids)))
+    )).all())
+    if found:
+        chat_ids = select(models.Chat.id).where(models.Chat.image_id.in_(found))
+        await db.exec(delete(models.Message).where(models.Message.chat_id.in_(chat_ids)))
+        await db.exec(delete(models.Chat).where(models.Chat.image_id.in_(found)))
+        await db.exec(delete(models.Image).where(models.Image.id.in_(found)))
+        await bump_album_version(db, album_id)
+        await db.commit()
+        for sha256 in {sha256 for sha256 in found.values() if sha256}:
+            await release_blob(db, sha256)
+    return [
+        BulkImageResult(index=index, id=image_id, status="deleted" if image_id in found else "not_found")
+        for index, image_id in enumerate(image_ids)
+    ]
+
+@me_images_router.post("/upload", response_model=ImageResponse)
+async def upload_image(
+    album_id: int,
+    file: UploadFile = File(...),
+    title: str = Form(...),
+    description: Optional[str] = Form(None),
+    current_user: UserResponse = Depends(get_current_user),
+    read_db: AsyncSession = Depends(get_read_db),
+    db: AsyncSession = Depends(get_db),
+):
+    """Create an image from a multipart upload; identical files are stored once."""
+    await verify_album_access(album_id, read_db, current_user)
+
+    async with save_upload(file) as blob:
+        new_image = models.Image(
+            title=title,
+            description=description,
+            path=os.path.relpath(blob_path(blob.sha256), MEDIA_ROOT),
+            album_id=album_id,
+            sha256=blob.sha256,
+            content_type=stored_content_type(file.content_type),
+            size=blob.size,
+        )
+        db.add(new_image)
+        await bump_album_version(db, album_id)
+        await db.commit()
+    thumbnails.schedule(blob.sha256)
     return new_image
 
 
 @me_images_router.get("/", response_model=List[ImageResponse])
-def read_images(album_id: int, current_user: UserResponse = Depends(get_current_user), db: Session = Depends(get_db)):
-    album, participant = participation_controller(album_id, db, current_user)
+async def read_images(album_id: int, request: Request, current_user: UserResponse = Depends(get_current_user), db: AsyncSession = Depends(get_read_db)):
+    """List the album's images. Honours If-None-Match against the album version."""
+    await verify_album_access(album_id, db, current_user)
+    version = await album_version(db, album_id)
+    if version is None:
+        raise HTTPException(status_code=404, detail="Album not found")
 
-    if not album.owner_id == current_user.id and not participant:
-        raise HTTPException(status_code=403, detail="Album not found")
+    async def render():
+        images = (await db.exec(select(*image_columns).where(models.Image.album_id == album_id))).all()
+        return dump_rows(images, ImageResponse), {}
 
-    images = db.exec(select(models.Image).where(models.Image.album_id == album_id)).all()
-    return images
+    return await conditional_json(request, entity_tag("album", album_id, version), render)
 
 @me_images_router.get("/{image_id}", response_model=ImageResponse)
-def read_images_id(album_id:int, image_id: int, current_user: UserResponse = Depends(get_current_user), db: Session = Depends(get_db)):
+async def read_images_id(album_id:int, image_id: int, current_user: UserResponse = Depends(get_current_user), db: AsyncSession = Depends(get_read_db)):
+    await verify_album_access(album_id, db, current_user)
 
-    image = get_image(album_id, image_id, db)
+    image = await get_image(album_id, image_id, db)
     not_found_exception(image, "Image not found")
+    return image
 
-    album, participant = participation_controller(album_id, db, current_user)
+@me_images_router.get("/{image_id}/file")
+async def download_image(album_id: int, image_id: int, request: Request, current_user: UserResponse = Depends(get_current_user), db: AsyncSession = Depends(get_read_db)):
+    """Serve the stored file. Supports Range requests and If-None-Match on the content hash.
 
-    if not album.owner_id == current_user.id and not participant:
-        raise HTTPException(status_code=403, detail="Album not found")
+    Only allowed image types are served inline; anything else, including rows
+    stored before uploads were checked, is sent as an opaque attachment.
+    """
+    await verify_album_access(album_id, db, current_user)
 
-    return image
+    image = await get_image(album_id, image_id, db)
+    not_found_exception(image, "Image not found")
+    not_found_exception(image.sha256, "Image has no file")
 
-@me_images_router.delete("/{image_id}/delete")
-def delete_image(album_id:int, image_id: int, current_user: UserResponse = Depends(get_current_user), db: Session = Depends(get_db)):
-    image = get_image(album_id, image_id, db)
+    etag = f'"{image.sha256}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache", "X-Content-Type-Options": "nosniff"}
+    media_type = image.content_type
+    if media_type not in IMAGE_CONTENT_TYPES:
+        media_type = "application/octet-stream"
+        headers["Content-Disposition"] = "attachment"
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    path = blob_path(image.sha256)
+    try:
+        stat_result = os.stat(path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Image file missing")
+    return BlobResponse(path, media_type=media_type, headers=headers, stat_result=stat_result)
 
+@me_images_router.get("/{image_id}/thumb/{size}")
+async def read_thumbnail(album_id: int, image_id: int, size: str, current_user: UserResponse = Depends(get_current_user), db: AsyncSession = Depends(get_read_db)):
+    """Serve a resized copy, or a placeholder if it is not ready within THUMB_SYNC_TIMEOUT."""
+    if size not in SIZES:
+        raise HTTPException(status_code=404, detail="Unknown thumbnail size")
+    await verify_album_access(album_id, db, current_user)
+
+    image = await get_image(album_id, image_id, db)
     not_found_exception(image, "Image not found")
+    not_found_exception(image.sha256, "Image has no file")
+    await db.close()
+
+    path = await thumbnails.get(image.sha256, size, THUMB_SYNC_TIMEOUT)
+    try:
+        stat_result = os.stat(path) if path is not None else None
+    except FileNotFoundError:  # evicted since it was found
+        stat_result = None
+    if stat_result is None:
+        return Response(placeholder_svg(size), media_type="image/svg+xml", headers={"Cache-Control": "no-store"})
+    headers = {"ETag": f'"{image.sha256}-{size}"', "Cache-Control": "private, no-cache"}
+    return BlobResponse(path, media_type="image/jpeg", headers=headers, stat_result=stat_result)
+
+@me_images_router.put("/{image_id}/file", response_model=ImageResponse)
+async def replace_image_file(
+    album_id: int,
+    image_id: int,
+    file: UploadFile = File(...),
+    current_user: UserResponse = Depends(get_current_user),
+    read_db: AsyncSession = Depends(get_read_db),
+    db: AsyncSession = Depends(get_db),
+):
+    await verify_album_access(album_id, read_db, current_user)
+    not_found_exception(await get_image(album_id, image_id, read_db), "Image not found")
 
-    album, participant = participation_controller(album_id, db, current_user)
+    async with save_upload(file) as blob:
+        image_db = await get_image(album_id, image_id, db)
 
-    if not album.owner_id == current_user.id and not participant:
-        raise HTTPException(status_code=403, detail="Album not found")
+        previous = image_db.sha256
+        image_db.sha256 = blob.sha256
+        image_db.size = blob.size
+        image_db.content_type = stored_content_type(file.content_type)
+        image_db.path = os.path.relpath(blob_path(blob.sha256), MEDIA_ROOT)
+        await bump_album_version(db, album_id)
+        await db.commit()
+    thumbnails.schedule(blob.sha256)
+    if previous and previous != blob.sha256:
+        await release_blob(db, previous)
+    return image_db
+
+@me_images_router.delete("/{image_id}/delete")
+async def delete_image(album_id:int, image_id: int, current_user: UserResponse = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    await verify_album_access(album_id, db, current_user)
 
-    db.delete(image)
-    db.commit()
+    image = await get_image(album_id, image_id, db)
+    not_found_exception(image, "Image not found")
+
+    await db.delete(image)
+    await bump_album_version(db, album_id)
+    await db.commit()
+    if image.sha256:
+        await release_blob(db, image.sha256)
     return {"message": "Image deleted"}
 
 @me_images_router.put("/{image_id}/update")
-def update_image(album_id:int, image_id: int, image: ImageCreate, current_user: UserResponse = Depends(get_current_user), db: Session = Depends(get_db)):
-    image_db = get_image(album_id, image_id, db)
+async def update_image(album_id:int, image_id: int, image: ImageCreate, current_user: UserResponse = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    await verify_album_access(album_id, db, current_user)
 
+    image_db = await get_image(album_id, image_id, db)
     not_found_exception(image_db, "Image not found")
 
-    album, participant = participation_controller(album_id, db, current_user)
-
-    if not album.owner_id == current_user.id and not participant:
-        raise HTTPException(status_code=403, detail="Album not found")
-
     image_db.title = image.title
     image_db.description = image.description
     image_db.path = image.image_path
     db.add(image_db)
-    db.commit()
-    db.refresh(image_db)
+    await bump_album_version(db, album_id)
+    await db.commit()
+    await db.refresh(image_db)
     return image_db
 
 
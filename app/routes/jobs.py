@@ -0,0 +1,16 @@
+from fastapi import APIRouter, Depends, HTTPException
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.database import get_read_db
+from app.schemas import JobResponse
+import app.models as models
+
+jobs_router = APIRouter(prefix="/jobs", tags=["jobs"])
+
+@jobs_router.get("/{job_id}", response_model=JobResponse)
+async def read_job(job_id: str, db: AsyncSession = Depends(get_read_db)):
+    """Poll a background job. The id is an unguessable token handed out when the job was created."""
+    job = await db.get(models.Job, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
@@ -1,174 +1,320 @@
-
-from fastapi import APIRouter, Depends, HTTPException, WebSocket, WebSocketDisconnect, status
-from sqlmodel import Session, select
-from typing import List, Dict
-from app.database import get_db
+import asyncio
+import json
+import logging
+import os
+import time
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, WebSocket, WebSocketDisconnect, status
+from fastapi.responses import StreamingResponse
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from typing import Callable, List, Dict, Optional, Set
+from app.database import get_db, get_read_db, read_engine
 import app.models as models
 from app.schemas import MessageCreate, MessageResponse, ChatResponse, UserResponse
 from app.utils.security import get_current_user, get_current_user_ws
-from app.utils.concurrent import verify_album_access
+from app.utils.concurrent import get_chat_album_id, verify_album_access
+from app.utils.broadcast import BroadcastBackend, get_backend
+from app.utils.ingest import MessageWriter, message_payload
+from app.utils.metrics import broadcast_fanout, observe_delivery
+from app.utils.ratelimit import limit_messages, ws_frame_limiter
+from app.utils.recent import RecentMessages, recent_messages
+from app.utils.pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, encode_cursor, decode_cursor
+from app.utils.serialization import dump_ndjson, dump_rows, response_columns
+from app.utils.versions import chat_version, conditional_json, entity_tag
 from app import crud
 
+logger = logging.getLogger(__name__)
 
 messages_router = APIRouter(prefix="/chats", tags=["chat"])
 
-class ConnectionManager:
-    def __init__(self) -> None:
-        self.connections: Dict[int, list[WebSocket]] = {}
+# Message lists are read as plain rows and encoded directly.
+message_columns = response_columns(models.Message, MessageResponse)
+
+SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "100"))
+# "drop_oldest" discards the oldest queued event for a slow client,
+# "disconnect" closes the socket so the client reconnects and catches up.
+OVERFLOW_POLICY = os.getenv("WS_OVERFLOW_POLICY", "drop_oldest")
+# Most messages replayed from the database to a reconnecting client; older
+# ones are fetched through read_messages.
+REPLAY_LIMIT = int(os.getenv("WS_REPLAY_LIMIT", "500"))
+
+
+class Subscriber:
+    """Outbound side of one WebSocket: a bounded queue drained by its own task."""
+
+    def __init__(self, websocket: WebSocket, on_error: Callable[[], None], backlog: List[str] = ()) -> None:
+        self.websocket = websocket
+        self._backlog = list(backlog)
+        self.queue: asyncio.Queue[str] = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+        self._on_error = on_error
+        self._task = asyncio.create_task(self._drain())
+
+    def push(self, payload: str) -> bool:
+        """Queue ``payload`` without waiting. Returns False if the client must be dropped."""
+        try:
+            self.queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            if OVERFLOW_POLICY != "drop_oldest":
+                return False
+            self.queue.get_nowait()
+            self.queue.put_nowait(payload)
+        return True
+
+    def close(self) -> None:
+        self._task.cancel()
+
+    async def _drain(self) -> None:
+        try:
+            for payload in self._backlog:
+                await self.websocket.send_text(payload)
+            self._backlog = None
+            while True:
+                await self.websocket.send_text(await self.queue.get())
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self._on_error()
 
-    async def connect(self, chat_id: int, websocket: WebSocket) -> None:
+
+class ConnectionManager:
+    def __init__(self, backend: BroadcastBackend, recent: RecentMessages) -> None:
+        self.connections: Dict[int, Dict[WebSocket, Subscriber]] = {}
+        self.backend = backend
+        self.recent = recent
+        # Close handshakes with dropped slow clients, referenced until done.
+        self._closing: Set[asyncio.Task] = set()
+
+    async def connect(
+        self,
+        chat_id: int,
+        websocket: WebSocket,
+        last_seen_id: Optional[int] = None,
+        backlog: List[str] = (),
+    ) -> None:
+        """Subscribe a socket, first sending ``backlog`` and then buffered messages after ``last_seen_id``.
+
+        The buffer is read in the same step the socket is registered, so every
+        later message reaches it through its queue instead.
+        """
+        if not self.backend.started:
+            await self.backend.start(self.deliver, self.recent.clear)
         await websocket.accept()
-        self.connections.setdefault(chat_id, []).append(websocket)
+        backlog = list(backlog)
+        if last_seen_id is not None:
+            backlog += self.recent.since(chat_id, last_seen_id)
+        self.connections.setdefault(chat_id, {})[websocket] = Subscriber(
+            websocket, lambda: self.disconnect(chat_id, websocket), backlog
+        )
 
     def disconnect(self, chat_id: int, websocket: WebSocket) -> None:
-        if chat_id in self.connections:
-            self.connections[chat_id].remove(websocket)
-            if not self.connections[chat_id]:
-                del self.connections[chat_id]
+        subscribers = self.connections.get(chat_id)
+        if subscribers is None or websocket not in subscribers:
+            return
+        subscribers.pop(websocket).close()
+        if not subscribers:
+            del self.connections[chat_id]
 
     async def broadcast(self, chat_id: int, message: dict) -> None:
-        for connection in self.connections.get(chat_id, []):
-            await connection.send_json(message)
-
-
-manager = ConnectionManager()
+        """Publish ``message`` to every subscriber of the chat, in any worker."""
+        if not self.backend.started:
+            await self.backend.start(self.deliver, self.recent.clear)
+        await self.backend.publish(chat_id, json.dumps(message))
+
+    async def deliver(self, chat_id: int, payload: str) -> None:
+        """Queue an encoded event for the sockets held by this process.
+
+        Never waits on a client: each socket is written by its own task.
+        """
+        start = time.perf_counter()
+        message = json.loads(payload)
+        self.recent.add(chat_id, message["id"], payload)
+        for websocket, subscriber in list(self.connections.get(chat_id, {}).items()):
+            if not subscriber.push(payload):
+                self.disconnect(chat_id, websocket)
+                task = asyncio.create_task(self._close_slow_consumer(websocket))
+                self._closing.add(task)
+                task.add_done_callback(self._closing.discard)
+        broadcast_fanout.observe(time.perf_counter() - start)
+        observe_delivery(message.get("sent_at"))
+
+    async def _close_slow_consumer(self, websocket: WebSocket) -> None:
+        try:
+            await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+        except Exception:
+            pass
+
+
+manager = ConnectionManager(get_backend(), recent_messages)
+
+
+async def broadcast_messages(messages: List[dict]) -> None:
+    for message in messages:
+        try:
+            await manager.broadcast(message["chat_id"], message)
+        except ValueError as exc:
+            # Too large for the broadcast backend; reconnecting clients read
+            # it from the history, not from the now incomplete buffer.
+            logger.warning("Message %s was not broadcast: %s", message["id"], exc)
+            manager.recent.discard(message["chat_id"])
+
+
+writer = MessageWriter(broadcast_messages)
 
 @messages_router.post("/{image_id}", response_model=ChatResponse)
-def create_chat(
+async def create_chat(
     image_id: int,
     current_user: UserResponse = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
-    image = db.get(models.Image, image_id)
+    image = await db.get(models.Image, image_id)
     if not image:
         raise HTTPException(status_code=404, detail="Image not found")
 
-    verify_album_access(image.album_id, db, current_user)
+    await verify_album_access(image.album_id, db, current_user)
 
-    chat = db.exec(select(models.Chat).where(models.Chat.image_id == image_id)).first()
+    chat = (await db.exec(select(models.Chat).where(models.Chat.image_id == image_id))).first()
     if chat:
         return chat
 
     chat = models.Chat(image_id=image_id)
     db.add(chat)
-    db.commit()
-    db.refresh(chat)
+    await db.commit()
     return chat
 
 
 @messages_router.get("/{image_id}", response_model=ChatResponse)
-def get_chat(
+async def get_chat(
     image_id: int,
     current_user: UserResponse = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
-    chat = db.exec(select(models.Chat).where(models.Chat.image_id == image_id)).first()
+    chat = (await db.exec(select(models.Chat).where(models.Chat.image_id == image_id))).first()
 
-    image = db.get(models.Image, image_id)
+    image = await db.get(models.Image, image_id)
     if not image:
         raise HTTPException(status_code=404, detail="Image not found")
 
-    verify_album_access(image.album_id, db, current_user)
+    await verify_album_access(image.album_id, db, current_user)
 
     if not chat:
         chat = models.Chat(image_id=image_id)
         db.add(chat)
-        db.commit()
-        db.refresh(chat)
+        await db.commit()
 
     return chat
 
 
-@messages_router.post("/{chat_id}/messages", response_model=MessageResponse)
-def create_message(
+@messages_router.post("/{chat_id}/messages", response_model=MessageResponse, dependencies=[Depends(limit_messages)])
+async def create_message(
     chat_id: int,
     message: MessageCreate,
     current_user: UserResponse = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_read_db),
 ):
-    chat = db.get(models.Chat, chat_id)
-    if not chat:
-        raise HTTPException(status_code=404, detail="Chat not found")
-
-    image = db.get(models.Image, chat.image_id)
-    if not image:
-        raise HTTPException(status_code=404, detail="Image not found")
+    """Store a message through the same writer as WebSocket frames.
 
-    verify_album_access(image.album_id, db, current_user)
+    Every committed message is therefore broadcast and buffered for
+    reconnecting clients, whichever way it was sent.
+    """
+    await verify_album_access(await get_chat_album_id(chat_id, db), db, current_user)
+    await db.close()
 
-    new_message = models.Message(content=message.content, chat_id=chat_id, sender_id=current_user.id)
-    db.add(new_message)
-    db.commit()
-    db.refresh(new_message)
-
-    return new_message
+    return await writer.submit(chat_id, current_user.id, message.content)
 
 
 @messages_router.get("/{chat_id}/messages", response_model=List[MessageResponse])
-def read_messages(
+async def read_messages(
     chat_id: int,
+    request: Request,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    export: bool = False,
     current_user: UserResponse = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_read_db),
 ):
-    chat = db.get(models.Chat, chat_id)
-    if not chat:
+    """Return a page of messages, oldest first.
+
+    ``before``/``after`` take the ``X-Next-Cursor`` value of a previous page.
+    ``export=true`` streams the whole history as NDJSON instead. Pages honour
+    If-None-Match against the chat version.
+    """
+    if before and after:
+        raise HTTPException(status_code=400, detail="Use either before or after, not both")
+
+    await verify_album_access(await get_chat_album_id(chat_id, db), db, current_user)
+
+    if export:
+        return StreamingResponse(export_messages(chat_id), media_type="application/x-ndjson")
+
+    before_key = decode_cursor(before) if before else None
+    after_key = decode_cursor(after) if after else None
+    version = await chat_version(db, chat_id)
+    if version is None:
         raise HTTPException(status_code=404, detail="Chat not found")
 
-    image = db.get(models.Image, chat.image_id)
-    if not image:
-        raise HTTPException(status_code=404, detail="Image not found")
+    async def render():
+        messages = await crud.get_messages(db, chat_id, limit, before=before_key, after=after_key, columns=message_columns)
+        headers = {}
+        if len(messages) == limit:
+            edge = messages[-1] if after else messages[0]
+            headers["X-Next-Cursor"] = encode_cursor(edge.sent_at, edge.id)
+        return dump_rows(messages, MessageResponse), headers
+
+    return await conditional_json(request, entity_tag("chat", chat_id, version), render)
 
-    verify_album_access(image.album_id, db, current_user)
 
-    messages = db.exec(select(models.Message).where(models.Message.chat_id == chat_id)).all()
-    return messages
+async def export_messages(chat_id: int):
+    # The request session is closed before the body is streamed, so the
+    # export walks the history with a session of its own.
+    async with AsyncSession(read_engine) as db:
+        async for batch in crud.iter_messages(db, chat_id, columns=message_columns):
+            yield dump_ndjson(batch, MessageResponse)
 
 @messages_router.websocket("/ws/{chat_id}")
 async def chat_websocket(
     websocket: WebSocket,
     chat_id: int,
-    db: Session = Depends(get_db),
+    last_seen_id: Optional[int] = None,
+    db: AsyncSession = Depends(get_read_db),
 ):
+    """Live chat. Reconnecting clients pass ``last_seen_id`` to receive what they missed."""
     user = await get_current_user_ws(websocket, db)
 
-    chat = db.get(models.Chat, chat_id)
-    if not chat:
-        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
-        raise HTTPException(status_code=status.WS_1008_POLICY_VIOLATION, detail="Chat not found")
-
-    image = db.get(models.Image, chat.image_id)
-    if not image:
-        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
-        raise HTTPException(status_code=status.WS_1008_POLICY_VIOLATION, detail="Image not found")
-
     try:
-        verify_album_access(image.album_id, db, user)
-    except HTTPException:
+        await verify_album_access(await get_chat_album_id(chat_id, db), db, user)
+    except HTTPException as exc:
         await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
-        raise
-
-    await manager.connect(chat_id, websocket)
+        raise HTTPException(status_code=status.WS_1008_POLICY_VIOLATION, detail=exc.detail)
+
+    backlog = []
+    if last_seen_id is not None and not manager.recent.covers(chat_id, last_seen_id):
+        # Messages committed while this query runs are delivered to the
+        # buffer, and picked up from there by connect().
+        rows = await crud.get_messages_after_id(db, chat_id, last_seen_id, REPLAY_LIMIT, columns=message_columns)
+        backlog = [json.dumps(message_payload(row)) for row in rows]
+        if rows:
+            last_seen_id = rows[-1].id
+    # Release the connection: the socket may stay open for hours and all
+    # writes go through the message writer.
+    await db.close()
+
+    await manager.connect(chat_id, websocket, last_seen_id, backlog)
     try:
         while True:
             data = await websocket.receive_json()
             content = data.get("content")
             if not content:
                 continue
-            message = crud.create_message(
-                db,
-                MessageCreate(chat_id=chat_id, content=content),
-                sender_id=user.id,
-            )
-            await manager.broadcast(
-                chat_id,
-                {
-                    "id": message.id,
-                    "content": message.content,
-                    "sent_at": message.sent_at.isoformat(),
-                    "sender_id": message.sender_id,
-                    "chat_id": message.chat_id,
-                },
-            )
+            if ws_frame_limiter is not None and (wait := ws_frame_limiter.acquire(user.id)):
+                # Dropped, not queued: the client is told when to try again.
+                await websocket.send_json({"error": "rate_limited", "retry_after": round(wait, 2)})
+                continue
+            # Persisted by the group-commit writer, which also broadcasts it.
+            await writer.submit(chat_id, user.id, content)
     except WebSocketDisconnect:
+        pass
+    finally:
         manager.disconnect(chat_id, websocket)
 
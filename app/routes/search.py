@@ -0,0 +1,33 @@
+from fastapi import APIRouter, Depends, Query, Response
+from sqlmodel.ext.asyncio.session import AsyncSession
+from typing import List
+
+from app.database import get_read_db
+from app.schemas import SearchResult, UserResponse
+from app import crud
+
+from app.utils.security import get_current_user
+from app.utils.pagination import MAX_PAGE_SIZE
+
+# Ranked results are paged by offset; deep pages get expensive, so stop here.
+MAX_SEARCH_OFFSET = 1000
+
+search_router = APIRouter(prefix="/search", tags=["search"])
+
+@search_router.get("/", response_model=List[SearchResult])
+async def search(
+    response: Response,
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(20, ge=1, le=MAX_PAGE_SIZE),
+    offset: int = Query(0, ge=0, le=MAX_SEARCH_OFFSET),
+    current_user: UserResponse = Depends(get_current_user),
+    db: AsyncSession = Depends(get_read_db),
+):
+    """Search messages and image titles/descriptions in the albums the user can access.
+
+    Best matches first. Pass ``X-Next-Offset`` as ``offset`` for the next page.
+    """
+    results = await crud.search(db, current_user.id, q, limit, offset)
+    if len(results) == limit and offset + limit <= MAX_SEARCH_OFFSET:
+        response.headers["X-Next-Offset"] = str(offset + limit)
+    return results
@@ -1,41 +1,63 @@
 from fastapi import APIRouter, Depends, HTTPException, Response
-from sqlmodel import Session, select
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
 from datetime import timedelta
 
-from app.database import get_db
+from app.database import get_db, get_read_db
 import app.models as models
-from app.schemas import UserCreate, UserLogin, UserResponse
+from app.schemas import JobAccepted, UserCreate, UserLogin, UserResponse
 
-from app.auth import hash_password, verify_password, create_access_token
-from app.utils.security import get_current_user
+from app.auth import create_access_token, needs_rehash
+from app.utils.security import get_current_user, invalidate_user
+from app.utils.hashing import password_hasher
+from app.utils.jobs import jobs
+from app.utils.ratelimit import limit_login
 
 from app.routes.albums import me_albums_router
+from app.routes.search import search_router
 
 auth_router = APIRouter(prefix="/auth", tags=["auth"])
 me_router = APIRouter(prefix="/me", tags=["me"])
 
 @auth_router.post("/register")
-def register(user: UserCreate, db: Session = Depends(get_db)):
+async def register(user: UserCreate, db: AsyncSession = Depends(get_db), read_db: AsyncSession = Depends(get_read_db)):
     """register a new user"""
-    if db.exec(select(models.User).filter(models.User.email == user.email)).first():
+    # Look up and hash outside the writer session so bcrypt never holds the write connection.
+    if (await read_db.exec(select(models.User).filter(models.User.email == user.email))).first():
         raise HTTPException(status_code=400, detail="Email already registered")
+    await read_db.close()
 
-    hashed_password = hash_password(user.password)
+    hashed_password = await password_hasher.hash(user.password)
     new_user = models.User(email=user.email, username=user.username, password=hashed_password)
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    await db.commit()
+    await db.refresh(new_user)
     return new_user
 
-@auth_router.post("/login")
-def login(user_log: UserLogin, response: Response, db: Session = Depends(get_db)):
+@auth_router.post("/login", dependencies=[Depends(limit_login)])
+async def login(user_log: UserLogin, response: Response, db: AsyncSession = Depends(get_db), read_db: AsyncSession = Depends(get_read_db)):
     """login a user"""
-    user = db.exec(select(models.User).filter(models.User.email == user_log.email)).first()
-    if not user or not verify_password(user_log.password, user.password):
+    user = (await read_db.exec(select(models.User).filter(models.User.email == user_log.email))).first()
+    await read_db.close()
+    if not user or not await password_hasher.verify(user_log.password, user.password):
         raise HTTPException(status_code=404, detail="Invalid credentials")
 
+    """upgrade hashes made with an outdated cost factor"""
+    if needs_rehash(user.password):
+        try:
+            new_hash = await password_hasher.hash(user_log.password)
+        except HTTPException:
+            new_hash = None  # pool saturated, retry on a later login
+        if new_hash:
+            db_user = await db.get(models.User, user.id)
+            db_user.password = new_hash
+            await db.commit()
+
     """generate token"""
-    access_token = create_access_token(data={"sub": user_log.email}, expires_delta=timedelta(minutes=30))
+    access_token = create_access_token(
+        data={"sub": user.email, "uid": user.id, "username": user.username},
+        expires_delta=timedelta(minutes=30),
+    )
 
     """use cookie"""
     response.set_cookie(
@@ -49,28 +71,34 @@ def login(user_log: UserLogin, response: Response, db: Session = Depends(get_db)
     return {"message": "Login successful"}
 
 @auth_router.get("/logout")
-def logout(response: Response):
+async def logout(response: Response):
     response.delete_cookie(key="access")
     return {"message": "Logout successful"}
 
 @me_router.get("/", response_model=UserResponse)
-def read_users_me(current_user: UserResponse = Depends(get_current_user)):
+async def read_users_me(current_user: UserResponse = Depends(get_current_user)):
     return current_user
 
 @me_router.delete("/delete")
-def delete_me(current_user: UserResponse = Depends(get_current_user), db: Session = Depends(get_db)):
-    db.delete(current_user)
-    db.commit()
-    return {"message": "bye, bye"}
+async def delete_me(response: Response, current_user: UserResponse = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    """Schedule the account and everything it owns for deletion; poll the returned job."""
+    job = await jobs.submit(db, "delete_user", current_user.id)
+    response.delete_cookie("access")
+    response.status_code = 202
+    return JobAccepted(job_id=job.id, status_url=f"/jobs/{job.id}")
 
 @me_router.put("/update")
-def update_me(user: UserCreate, current_user: UserResponse = Depends(get_current_user), db: Session = Depends(get_db)):
-    current_user.email = user.email
-    current_user.username = user.username
-    current_user.password = hash_password(user.password)
-    db.commit()
-    return current_user
+async def update_me(user: UserCreate, current_user: UserResponse = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    hashed_password = await password_hasher.hash(user.password)
+    db_user = await db.get(models.User, current_user.id)
+    db_user.email = user.email
+    db_user.username = user.username
+    db_user.password = hashed_password
+    await db.commit()
+    invalidate_user(current_user.id)
+    return UserResponse.model_validate(db_user)
 me_router.include_router(me_albums_router)
+me_router.include_router(search_router)
 
 
 
@@ -1,6 +1,14 @@
-from pydantic import BaseModel, EmailStr
-from datetime import datetime
-from typing import Optional, List
+from pydantic import AfterValidator, BaseModel, EmailStr
+from datetime import datetime, timezone
+from typing import Annotated, Optional, List
+
+
+def _assume_utc(value: datetime) -> datetime:
+    return value if value.tzinfo is not None else value.replace(tzinfo=timezone.utc)
+
+# Message times are stored in UTC but read back naive from SQLite; this makes
+# every encoding of a message render them alike, with a ``Z`` suffix.
+UTCDatetime = Annotated[datetime, AfterValidator(_assume_utc)]
 
 
 class UserBase(BaseModel):
@@ -33,6 +41,10 @@ class AlbumResponse(AlbumBase):
     class Config:
         from_attributes = True
 
+class AlbumSummaryResponse(AlbumResponse):
+    image_count: int
+    last_activity_at: datetime
+
 class ImageBase(BaseModel):
     title: str
     description: Optional[str] = None
@@ -43,6 +55,47 @@ class ImageCreate(ImageBase):
 class ImageResponse(ImageBase):
     id: int
     album_id: int
+    sha256: Optional[str] = None
+    content_type: Optional[str] = None
+    size: Optional[int] = None
+
+    class Config:
+        from_attributes = True
+
+class ImageUpdate(ImageCreate):
+    id: int
+
+class BulkImageResult(BaseModel):
+    index: int  # position of the item in the request
+    id: Optional[int] = None
+    status: str  # "created", "updated", "deleted" or "not_found"
+
+class MessagePreview(BaseModel):
+    id: int
+    content: str
+    sent_at: UTCDatetime
+    sender_id: int
+
+    class Config:
+        from_attributes = True
+
+class FeedImageResponse(ImageResponse):
+    chat_id: Optional[int] = None
+    message_count: int = 0
+    latest_message: Optional[MessagePreview] = None
+
+class AlbumFeedResponse(BaseModel):
+    album: AlbumResponse
+    images: List[FeedImageResponse]
+
+class SearchResult(BaseModel):
+    kind: str  # "message" or "image"
+    id: int
+    album_id: int
+    image_id: int
+    chat_id: Optional[int] = None
+    snippet: str
+    rank: float
 
     class Config:
         from_attributes = True
@@ -55,7 +108,7 @@ class MessageCreate(MessageBase):
 
 class MessageResponse(MessageBase):
     id: int
-    sent_at: datetime
+    sent_at: UTCDatetime
     sender_id: int
     chat_id: int  # 📌 Referencia al chat, no al álbum
 
@@ -71,8 +124,24 @@ class ChatCreate(ChatBase):
     pass
 
 class ChatResponse(ChatBase):
+    """A chat without its messages; page through those with GET /chats/{chat_id}/messages."""
     id: int
-    messages: List["MessageResponse"]
 
     class Config:
         from_attributes = True
+
+class JobResponse(BaseModel):
+    id: str
+    kind: str
+    status: str  # "pending", "running", "done" or "failed"
+    progress: int  # rows deleted so far
+    error: Optional[str] = None
+    created_at: datetime
+    updated_at: datetime
+
+    class Config:
+        from_attributes = True
+
+class JobAccepted(BaseModel):
+    job_id: str
+    status_url: str
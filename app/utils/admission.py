@@ -0,0 +1,98 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Optional
+
+from anyio.to_thread import current_default_thread_limiter
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+MAX_LAG = int(os.getenv("ADMISSION_MAX_LAG_MS", "500")) / 1000
+MAX_THREADPOOL_QUEUE = int(os.getenv("ADMISSION_MAX_THREADPOOL_QUEUE", "100"))
+SAMPLE_INTERVAL = 0.1
+# Never shed these, so an overloaded worker can still be observed.
+EXEMPT_PREFIXES = ("/stats", "/metrics")
+
+logger = logging.getLogger(__name__)
+
+
+class AdmissionController:
+    """Rejects new HTTP requests early while the worker is overloaded.
+
+    A sampler task measures event-loop lag as how late a ``SAMPLE_INTERVAL``
+    sleep wakes up. Requests get a 503 when the last sample exceeds
+    ``MAX_LAG`` or more than ``MAX_THREADPOOL_QUEUE`` calls wait for a
+    threadpool slot (file reads and writes).
+    """
+
+    def __init__(self, max_lag: float, max_threadpool_queue: int) -> None:
+        self.max_lag = max_lag
+        self.max_threadpool_queue = max_threadpool_queue
+        self.lag = 0.0
+        self.rejected = 0
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def threadpool_queue(self) -> int:
+        return current_default_thread_limiter().statistics().tasks_waiting
+
+    def overloaded(self) -> Optional[str]:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._task = loop.create_task(self._sample())
+        if self.lag > self.max_lag:
+            return "event loop lag"
+        if self.threadpool_queue() > self.max_threadpool_queue:
+            return "threadpool queue"
+        return None
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = self._loop = None
+        self.lag = 0.0
+
+    async def _sample(self) -> None:
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(SAMPLE_INTERVAL)
+            self.lag = max(0.0, time.perf_counter() - start - SAMPLE_INTERVAL)
+
+    def stats(self) -> dict:
+        return {
+            "event_loop_lag_ms": round(self.lag * 1000, 2),
+            "threadpool_queue": self.threadpool_queue(),
+            "max_lag_ms": self.max_lag * 1000,
+            "max_threadpool_queue": self.max_threadpool_queue,
+            "rejected": self.rejected,
+        }
+
+
+admission = AdmissionController(MAX_LAG, MAX_THREADPOOL_QUEUE)
+
+
+class AdmissionMiddleware:
+    """ASGI middleware applying ``admission`` to HTTP requests."""
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http" and not scope["path"].startswith(EXEMPT_PREFIXES):
+            reason = admission.overloaded()
+            if reason is not None:
+                admission.rejected += 1
+                logger.warning("Shedding %s %s: %s", scope["method"], scope["path"], reason)
+                await send({
+                    "type": "http.response.start",
+                    "status": 503,
+                    "headers": [(b"content-type", b"application/json"), (b"retry-after", b"1")],
+                })
+                await send({"type": "http.response.body", "body": b'{"detail":"Server overloaded"}'})
+                return
+        await self.app(scope, receive, send)
@@ -0,0 +1,201 @@
+import asyncio
+import hashlib
+import logging
+import os
+import socket
+import tempfile
+import time
+from abc import ABC, abstractmethod
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+# deliver(chat_id, payload) pushes an already JSON-encoded event to the
+# sockets this process holds for the chat.
+Deliver = Callable[[int, str], Awaitable[None]]
+# lost() is called when events from another worker were missed, for which
+# chats unknown.
+Lost = Callable[[], None]
+
+
+class BroadcastBackend(ABC):
+    """Fans chat events out to every worker process serving the API."""
+
+    def __init__(self) -> None:
+        self._deliver: Optional[Deliver] = None
+        self._lost: Optional[Lost] = None
+
+    @property
+    def started(self) -> bool:
+        return self._deliver is not None
+
+    async def start(self, deliver: Deliver, lost: Optional[Lost] = None) -> None:
+        self._deliver = deliver
+        self._lost = lost
+
+    @abstractmethod
+    async def publish(self, chat_id: int, payload: str) -> None:
+        """Deliver ``payload`` to the chat's sockets in this and every other worker."""
+
+    async def stop(self) -> None:
+        self._deliver = self._lost = None
+
+
+class InProcessBackend(BroadcastBackend):
+    """Single-process delivery; the default when running one worker."""
+
+    async def publish(self, chat_id: int, payload: str) -> None:
+        await self._deliver(chat_id, payload)
+
+
+class UnixSocketBackend(BroadcastBackend):
+    """Broker-less fan-out between workers on the same host.
+
+    Each backend binds a datagram socket named after its pid inside a shared
+    directory and publishes by sending the event to every other socket found
+    there. Sockets left behind by dead workers are removed the first time a
+    send to them is refused. Frames carry a per-sender sequence number, so a
+    receiver that misses one (a full queue, an oversized event) calls
+    ``lost`` when the next one arrives.
+
+    The peer list is rescanned whenever the directory changes, and after a
+    failed send. Directory timestamps are coarse, so it is also rescanned on
+    every publish for ``PEER_REFRESH_SECONDS`` after a change.
+    """
+
+    PEER_REFRESH_SECONDS = 1.0
+    # Fits the default datagram send buffer (net.core.wmem_default, 208 KiB).
+    MAX_FRAME_BYTES = 128 * 1024
+
+    def __init__(self, directory: str) -> None:
+        super().__init__()
+        self.directory = directory
+        self.path = ""
+        self._sock: Optional[socket.socket] = None
+        self._peers: List[str] = []
+        self._peers_changed_at: Optional[float] = None
+        self._sequence = 0
+        # Last sequence number received from each peer.
+        self._received: Dict[str, int] = {}
+        # Deliveries of received frames; referenced until done so they are not
+        # garbage collected mid-flight, and cancelled on stop.
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def start(self, deliver: Deliver, lost: Optional[Lost] = None) -> None:
+        await super().start(deliver, lost)
+        os.makedirs(self.directory, exist_ok=True)
+        # Resolved at start so forked workers never share their parent's name.
+        self.path = os.path.join(self.directory, f"{os.getpid()}-{id(self):x}.sock")
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.setblocking(False)
+        self._sock.bind(self.path)
+        asyncio.get_running_loop().add_reader(self._sock.fileno(), self._on_readable)
+
+    async def publish(self, chat_id: int, payload: str) -> None:
+        """Raises ValueError, delivering to no one, if the event does not fit in a frame."""
+        self._sequence += 1
+        frame = f"{self._sequence} {chat_id}\n{payload}".encode()
+        if len(frame) > self.MAX_FRAME_BYTES:
+            raise ValueError(f"Event of {len(frame)} bytes exceeds the {self.MAX_FRAME_BYTES} byte frame limit")
+        for peer in self._get_peers():
+            try:
+                self._sock.sendto(frame, peer)
+            except (ConnectionRefusedError, FileNotFoundError):
+                self._forget_peer(peer)
+            except BlockingIOError:
+                logger.warning("Broadcast queue of %s is full, event for chat %s dropped", peer, chat_id)
+            except OSError as exc:
+                self._peers_changed_at = None
+                logger.warning("Could not publish chat %s event to %s: %s", chat_id, peer, exc)
+        await self._deliver(chat_id, payload)
+
+    async def stop(self) -> None:
+        if self._sock is not None:
+            asyncio.get_running_loop().remove_reader(self._sock.fileno())
+            self._sock.close()
+            self._sock = None
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*list(self._tasks), return_exceptions=True)
+        await super().stop()
+
+    def _get_peers(self) -> List[str]:
+        changed_at = os.stat(self.directory).st_mtime
+        if changed_at != self._peers_changed_at or time.time() - changed_at < self.PEER_REFRESH_SECONDS:
+            self._peers = [
+                entry.path
+                for entry in os.scandir(self.directory)
+                if entry.name.endswith(".sock") and entry.path != self.path
+            ]
+            self._peers_changed_at = changed_at
+        return self._peers
+
+    def _forget_peer(self, peer: str) -> None:
+        self._peers_changed_at = None
+        self._received.pop(peer, None)
+        if peer in self._peers:
+            self._peers.remove(peer)
+        try:
+            os.unlink(peer)
+        except FileNotFoundError:
+            pass
+
+    def _report_lost(self) -> None:
+        if self._lost is not None:
+            self._lost()
+
+    def _on_readable(self) -> None:
+        while True:
+            try:
+                frame, sender = self._sock.recvfrom(self.MAX_FRAME_BYTES + 1)
+            except BlockingIOError:
+                return
+            try:
+                if len(frame) > self.MAX_FRAME_BYTES:
+                    raise ValueError("frame too large")
+                header, _, payload = frame.decode().partition("\n")
+                sequence, chat_id = (int(field) for field in header.split(" "))
+            except ValueError as exc:  # UnicodeDecodeError is a ValueError
+                logger.warning("Dropped malformed broadcast frame of %s bytes from %s: %s", len(frame), sender, exc)
+                self._report_lost()
+                continue
+            previous = self._received.get(sender)
+            self._received[sender] = sequence
+            if sequence != (previous or 0) + 1:
+                # Also the first frame from a peer that started earlier:
+                # whether it published to us before then is unknown.
+                logger.warning("Missed up to %s broadcast frames from %s", sequence - (previous or 0) - 1, sender)
+                self._report_lost()
+            task = asyncio.ensure_future(self._deliver(chat_id, payload))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+
+def default_socket_dir(database_url: str) -> str:
+    """A socket directory shared by the workers of one deployment only.
+
+    Workers serving the same database must see each other's events, while
+    other apps on the host must not, so the directory is named after the
+    database URL.
+    """
+    digest = hashlib.sha256(database_url.encode()).hexdigest()[:16]
+    return os.path.join(tempfile.gettempdir(), f"couple-api-broadcast-{digest}")
+
+
+def get_backend() -> BroadcastBackend:
+    """Build the backend selected by ``BROADCAST_BACKEND`` (``memory`` or ``unix``)."""
+    kind = os.getenv("BROADCAST_BACKEND", "memory")
+    if kind == "memory":
+        return InProcessBackend()
+    if kind == "unix":
+        directory = os.getenv("BROADCAST_SOCKET_DIR")
+        if not directory:
+            from app.database import DATABASE_URL
+
+            directory = default_socket_dir(DATABASE_URL)
+        return UnixSocketBackend(directory)
+    raise ValueError(f"Unknown BROADCAST_BACKEND: {kind}")
@@ -1,39 +1,99 @@
+import os
+from typing import NamedTuple, Optional
+
 from fastapi import HTTPException
-from sqlmodel import and_, select, Session
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session as ORMSession, object_session
+from sqlmodel import and_, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 import app.models as models
 from app.schemas import UserResponse
+from app.utils.cache import TTLCache
 
-def participation_controller(album_id: int, db: Session, current_user: UserResponse):
-    album = db.exec(select(models.Album).where(models.Album.id == album_id)).first()
-    if not album:
-        raise HTTPException(status_code=404, detail="Album not found")
+# Decisions are keyed by (user_id, album_id). Writes made through this process
+# invalidate them explicitly; the TTL bounds staleness for writes made by
+# other workers.
+album_access_cache = TTLCache(
+    maxsize=int(os.getenv("ACL_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("ACL_CACHE_TTL", "30")),
+)
 
-    participant = db.exec(select(models.AlbumParticipant).where(
-        and_(
-            models.AlbumParticipant.user_id == current_user.id,
-            models.AlbumParticipant.album_id == album.id
+class AlbumAccess(NamedTuple):
+    album_id: int
+    owner_id: int
+    is_participant: bool
+
+    def allows(self, user_id: int) -> bool:
+        return self.owner_id == user_id or self.is_participant
+
+async def participation_controller(album_id: int, db: AsyncSession, current_user: UserResponse) -> AlbumAccess:
+    """Return the user's relation to the album, loading it with one query on a cache miss.
+
+    Raises a 404 error if the album does not exist.
+    """
+    key = (current_user.id, album_id)
+    access = album_access_cache.get(key)
+    if access is not None:
+        return access
+
+    row = (await db.exec(
+        select(models.Album.owner_id, models.AlbumParticipant.user_id)
+        .outerjoin(
+            models.AlbumParticipant,
+            and_(
+                models.AlbumParticipant.album_id == models.Album.id,
+                models.AlbumParticipant.user_id == current_user.id,
+            ),
         )
+        .where(models.Album.id == album_id)
     )).first()
-    return album, participant
+    if row is None:
+        raise HTTPException(status_code=404, detail="Album not found")
 
-def verify_album_access(album_id: int, db: Session, current_user: UserResponse):
-    """Return the album if the user is the owner or a participant.
+    access = AlbumAccess(album_id=album_id, owner_id=row[0], is_participant=row[1] is not None)
+    album_access_cache.set(key, access)
+    return access
+
+async def verify_album_access(album_id: int, db: AsyncSession, current_user: UserResponse) -> AlbumAccess:
+    """Return the access decision if the user is the owner or a participant.
 
     Raises a 403 error if the user has no permissions.
     """
-    album, participant = participation_controller(album_id, db, current_user)
-    if album.owner_id != current_user.id and not participant:
+    access = await participation_controller(album_id, db, current_user)
+    if not access.allows(current_user.id):
         raise HTTPException(status_code=403, detail="Album not found")
-    return album
+    return access
+
+def invalidate_album_access(album_id: Optional[int] = None, user_id: Optional[int] = None) -> None:
+    """Forget cached decisions for an album, a user, or a single pair."""
+    if album_id is not None and user_id is not None:
+        album_access_cache.pop((user_id, album_id))
+    elif album_id is not None:
+        album_access_cache.discard_where(lambda key: key[1] == album_id)
+    elif user_id is not None:
+        album_access_cache.discard_where(lambda key: key[0] == user_id)
 
-def get_image(album_id: int, image_id: int, db: Session):
-    image = db.exec(select(models.Image).where(
+async def get_chat_album_id(chat_id: int, db: AsyncSession) -> int:
+    """Resolve the album a chat belongs to with a single query."""
+    row = (await db.exec(
+        select(models.Chat.id, models.Image.album_id)
+        .outerjoin(models.Image, models.Image.id == models.Chat.image_id)
+        .where(models.Chat.id == chat_id)
+    )).first()
+    if row is None:
+        raise HTTPException(status_code=404, detail="Chat not found")
+    if row[1] is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    return row[1]
+
+async def get_image(album_id: int, image_id: int, db: AsyncSession):
+    image = (await db.exec(select(models.Image).where(
         and_(
             models.Image.id == image_id,
             models.Image.album_id == album_id
         )
-    )).first()
+    ))).first()
 
     return image
 
@@ -44,3 +104,41 @@ def not_found_exception(element: any, detail: str):
 def existing_element_exception(element: any, detail: str):
     if element:
         raise HTTPException(status_code=400, detail=detail)
+
+
+# ORM writes queue invalidations on the session and apply them after commit,
+# so a concurrent reader cannot re-cache the pre-commit state.
+
+def _queue_invalidation(target, album_id: Optional[int] = None, user_id: Optional[int] = None) -> None:
+    session = object_session(target)
+    if session is None:
+        invalidate_album_access(album_id, user_id)
+    else:
+        session.info.setdefault("acl_invalidations", set()).add((album_id, user_id))
+
+@event.listens_for(models.AlbumParticipant, "after_insert")
+@event.listens_for(models.AlbumParticipant, "after_delete")
+def _participant_changed(mapper, connection, target):
+    _queue_invalidation(target, album_id=target.album_id, user_id=target.user_id)
+
+@event.listens_for(models.Album, "after_delete")
+def _album_deleted(mapper, connection, target):
+    _queue_invalidation(target, album_id=target.id)
+
+@event.listens_for(models.Album, "after_update")
+def _album_updated(mapper, connection, target):
+    if inspect(target).attrs.owner_id.history.has_changes():
+        _queue_invalidation(target, album_id=target.id)
+
+@event.listens_for(models.User, "after_delete")
+def _user_deleted(mapper, connection, target):
+    _queue_invalidation(target, user_id=target.id)
+
+@event.listens_for(ORMSession, "after_commit")
+def _apply_invalidations(session):
+    for album_id, user_id in session.info.pop("acl_invalidations", ()):
+        invalidate_album_access(album_id, user_id)
+
+@event.listens_for(ORMSession, "after_rollback")
+def _drop_invalidations(session):
+    session.info.pop("acl_invalidations", None)
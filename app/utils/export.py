@@ -0,0 +1,209 @@
+import asyncio
+import itertools
+import json
+import logging
+import mimetypes
+import os
+import re
+import time
+import zipfile
+from typing import AsyncIterator, Dict
+
+from fastapi.concurrency import run_in_threadpool
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app import crud
+from app.database import read_engine
+import app.models as models
+from app.schemas import AlbumResponse, ImageResponse, MessageResponse
+from app.utils.serialization import dump_ndjson, response_columns
+from app.utils.storage import CHUNK_SIZE, blob_path
+
+EXPORT_BATCH_SIZE = 200
+
+logger = logging.getLogger(__name__)
+
+
+class StreamSink:
+    """Write-only file object collecting what ZipFile writes until it is drained.
+
+    It has no ``tell``/``seek``, so ZipFile writes entries with data
+    descriptors and never goes back in the stream.
+    """
+
+    def __init__(self) -> None:
+        self._chunks = []
+
+    def write(self, data: bytes) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+class ExportProgress:
+    def __init__(self, export_id: int, album_id: int, user_id: int) -> None:
+        self.id = export_id
+        self.album_id = album_id
+        self.user_id = user_id
+        self.started_at = time.monotonic()
+        self.bytes_sent = 0
+        self.files = 0
+        self.messages = 0
+
+    def as_dict(self) -> dict:
+        elapsed = time.monotonic() - self.started_at
+        return {
+            "id": self.id,
+            "album_id": self.album_id,
+            "user_id": self.user_id,
+            "seconds": round(elapsed, 2),
+            "bytes_sent": self.bytes_sent,
+            "files": self.files,
+            "messages": self.messages,
+            "bytes_per_second": round(self.bytes_sent / elapsed) if elapsed else 0,
+        }
+
+
+class ExportRegistry:
+    """Tracks running exports and totals, for ``/stats/exports``."""
+
+    def __init__(self) -> None:
+        self.active: Dict[int, ExportProgress] = {}
+        self.completed = 0
+        self.cancelled = 0
+        self.failed = 0
+        self.bytes_sent = 0
+        self._ids = itertools.count(1)
+
+    def start(self, album_id: int, user_id: int) -> ExportProgress:
+        progress = ExportProgress(next(self._ids), album_id, user_id)
+        self.active[progress.id] = progress
+        return progress
+
+    def finish(self, progress: ExportProgress, outcome: str) -> None:
+        self.active.pop(progress.id, None)
+        self.bytes_sent += progress.bytes_sent
+        setattr(self, outcome, getattr(self, outcome) + 1)
+
+    def stats(self) -> dict:
+        return {
+            "active": [progress.as_dict() for progress in self.active.values()],
+            "completed": self.completed,
+            "cancelled": self.cancelled,
+            "failed": self.failed,
+            "bytes_sent": self.bytes_sent + sum(p.bytes_sent for p in self.active.values()),
+        }
+
+
+exports = ExportRegistry()
+
+
+def _entry(name: str, compress: bool) -> zipfile.ZipInfo:
+    info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+    info.compress_type = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+    return info
+
+
+def _file_name(image: models.Image) -> str:
+    slug = re.sub(r"[^\w.-]+", "-", image.title).strip("-")[:60] or "image"
+    extension = mimetypes.guess_extension(image.content_type or "") or ""
+    return f"images/{image.id}-{slug}{extension}"
+
+
+async def _image_batches(db: AsyncSession, album_id: int):
+    """Yield the album's images ``EXPORT_BATCH_SIZE`` at a time, with their chat ids."""
+    after = 0
+    while True:
+        images = (await db.exec(
+            select(models.Image)
+            .where(models.Image.album_id == album_id, models.Image.id > after)
+            .order_by(models.Image.id)
+            .limit(EXPORT_BATCH_SIZE)
+        )).all()
+        if not images:
+            return
+        chats = dict((await db.exec(
+            select(models.Chat.image_id, models.Chat.id).where(models.Chat.image_id.in_([image.id for image in images]))
+        )).all())
+        await db.close()
+        after = images[-1].id
+        yield images, chats
+
+
+def _has_file(image: models.Image) -> bool:
+    return bool(image.sha256) and os.path.exists(blob_path(image.sha256))
+
+
+async def album_archive(album_id: int, user_id: int) -> AsyncIterator[bytes]:
+    """Stream a zip of an album: metadata, image files and chat transcripts.
+
+    The archive holds ``album.json``, ``images.ndjson`` (one line per image,
+    naming its file and transcript), ``images/`` and ``chats/``. Rows are read
+    in batches and files in ``CHUNK_SIZE`` pieces, so memory use does not
+    depend on the album size, and the database connection is released while
+    data is being sent.
+    """
+    progress = exports.start(album_id, user_id)
+    outcome = "failed"
+    sink = StreamSink()
+    archive = zipfile.ZipFile(sink, mode="w", allowZip64=True)
+    message_columns = response_columns(models.Message, MessageResponse)
+
+    def sent() -> bytes:
+        data = sink.drain()
+        progress.bytes_sent += len(data)
+        return data
+
+    try:
+        async with AsyncSession(read_engine) as db:
+            album = await db.get(models.Album, album_id)
+            await db.close()
+            archive.writestr(_entry("album.json", compress=True), AlbumResponse.model_validate(album).model_dump_json(indent=2))
+
+            with archive.open(_entry("images.ndjson", compress=True), "w", force_zip64=True) as target:
+                async for images, chats in _image_batches(db, album_id):
+                    for image in images:
+                        entry = ImageResponse.model_validate(image).model_dump(mode="json")
+                        entry["file"] = _file_name(image) if _has_file(image) else None
+                        entry["chat"] = f"chats/{image.id}.ndjson" if image.id in chats else None
+                        target.write(json.dumps(entry).encode() + b"\n")
+                    if data := sent():
+                        yield data
+
+            async for images, chats in _image_batches(db, album_id):
+                for image in images:
+                    if _has_file(image):
+                        with open(blob_path(image.sha256), "rb") as source, \
+                                archive.open(_entry(_file_name(image), compress=False), "w", force_zip64=True) as target:
+                            while chunk := await run_in_threadpool(source.read, CHUNK_SIZE):
+                                target.write(chunk)
+                                if data := sent():
+                                    yield data
+                        progress.files += 1
+
+                    if image.id in chats:
+                        with archive.open(_entry(f"chats/{image.id}.ndjson", compress=True), "w", force_zip64=True) as target:
+                            async for batch in crud.iter_messages(db, chats[image.id], columns=message_columns):
+                                await db.close()
+                                target.write(dump_ndjson(batch, MessageResponse))
+                                progress.messages += len(batch)
+                                if data := sent():
+                                    yield data
+
+        archive.close()
+        yield sent()
+        outcome = "completed"
+    except (asyncio.CancelledError, GeneratorExit):
+        outcome = "cancelled"
+        logger.info("Export of album %s cancelled after %s bytes", album_id, progress.bytes_sent)
+        raise
+    finally:
+        exports.finish(progress, outcome)
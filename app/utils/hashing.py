@@ -0,0 +1,100 @@
+import asyncio
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Optional
+
+from fastapi import HTTPException
+
+import app.auth as auth
+
+
+class PasswordHasher:
+    """Runs bcrypt on a dedicated process pool instead of Starlette's threadpool.
+
+    At most ``max_pending`` calls may be queued or running; beyond that callers
+    get an immediate 503 rather than waiting behind a login spike. A pool
+    broken by a dead worker is replaced, and the call retried once.
+    """
+
+    def __init__(self, workers: int, max_pending: int) -> None:
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.restarts = 0
+        self._latencies: deque = deque(maxlen=1000)
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    async def hash(self, password: str) -> str:
+        return await self._run(auth.hash_password, password)
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        return await self._run(auth.verify_password, plain_password, hashed_password)
+
+    def stats(self) -> dict:
+        latencies = sorted(self._latencies)
+        percentile = lambda q: round(latencies[int(q * (len(latencies) - 1))] * 1000, 2) if latencies else None
+        return {
+            "workers": self.workers,
+            "rounds": auth.BCRYPT_ROUNDS,
+            "in_flight": self.pending,
+            "queue_depth": max(self.pending - self.workers, 0),
+            "max_pending": self.max_pending,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "restarts": self.restarts,
+            "latency_ms_p50": percentile(0.5),
+            "latency_ms_p99": percentile(0.99),
+        }
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+
+    async def _run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HTTPException(status_code=503, detail="Server busy, try again", headers={"Retry-After": "1"})
+
+        self.pending += 1
+        start = time.perf_counter()
+        try:
+            try:
+                result = await self._submit(fn, *args)
+            except BrokenProcessPool:
+                try:
+                    result = await self._submit(fn, *args)
+                except BrokenProcessPool:
+                    raise HTTPException(status_code=503, detail="Server busy, try again", headers={"Retry-After": "1"})
+        finally:
+            self.pending -= 1
+        self.completed += 1
+        self._latencies.append(time.perf_counter() - start)
+        return result
+
+    async def _submit(self, fn: Callable[..., Any], *args: Any) -> Any:
+        if self._executor is None:
+            # spawn keeps the workers free of the event loop's threads and sockets.
+            self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+        executor = self._executor
+        try:
+            return await asyncio.wrap_future(executor.submit(fn, *args))
+        except BrokenProcessPool:
+            # A worker died; every call on this pool fails from now on.
+            if self._executor is executor:
+                self._executor = None
+                self.restarts += 1
+                executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+
+password_hasher = PasswordHasher(
+    workers=int(os.getenv("PASSWORD_HASH_WORKERS", str(min(2, os.cpu_count() or 1)))),
+    max_pending=int(os.getenv("PASSWORD_HASH_QUEUE", "32")),
+)
@@ -0,0 +1,120 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, List, Optional
+
+from sqlalchemy.exc import IntegrityError
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.database import async_engine
+import app.models as models
+from app.schemas import MessageResponse
+from app.utils.versions import bump_chat_versions
+
+MAX_BATCH = int(os.getenv("MESSAGE_BATCH_SIZE", "200"))
+MAX_DELAY = int(os.getenv("MESSAGE_BATCH_DELAY_MS", "5")) / 1000
+QUEUE_SIZE = int(os.getenv("MESSAGE_QUEUE_SIZE", "10000"))
+
+logger = logging.getLogger(__name__)
+
+
+def message_payload(message) -> dict:
+    """A message or message row as JSON-ready data, encoded exactly like ``MessageResponse`` lists."""
+    return MessageResponse.model_validate(message).model_dump(mode="json")
+
+
+class MessageWriter:
+    """Group-commit writer for chat messages.
+
+    Messages submitted from any chat are queued and inserted by a single task,
+    up to ``MAX_BATCH`` rows per transaction and waiting at most ``MAX_DELAY``
+    for a batch to fill. The insert goes through the async engine so commits never
+    block the event loop. Once a batch is committed ``on_commit`` receives the
+    stored messages, e.g. to broadcast them.
+    """
+
+    def __init__(self, on_commit: Callable[[List[dict]], Awaitable[None]]) -> None:
+        self._on_commit = on_commit
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    async def submit(self, chat_id: int, sender_id: int, content: str) -> dict:
+        """Queue a message and wait until it has been committed."""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._start(loop)
+        future = loop.create_future()
+        sent_at = datetime.now(timezone.utc)
+        await self._queue.put((models.Message(chat_id=chat_id, sender_id=sender_id, content=content, sent_at=sent_at), future))
+        return await future
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = self._queue = self._loop = None
+
+    def _start(self, loop: asyncio.AbstractEventLoop) -> None:
+        self._loop = loop
+        self._queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        self._task = loop.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            deadline = self._loop.time() + MAX_DELAY
+            while len(batch) < MAX_BATCH:
+                timeout = deadline - self._loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                stored = await self._insert([message for message, _ in batch])
+            except IntegrityError:
+                # Typically a chat deleted while its messages were queued:
+                # retry one by one so only those messages fail.
+                stored = await self._insert_each(batch)
+            except Exception as exc:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(exc)
+                continue
+
+            for (_, future), payload in zip(batch, stored):
+                if payload is not None and not future.done():
+                    future.set_result(payload)
+            stored = [payload for payload in stored if payload is not None]
+            try:
+                await self._on_commit(stored)
+            except Exception:
+                logger.exception("on_commit failed for a batch of %s messages", len(stored))
+
+    async def _insert_each(self, batch: list) -> List[Optional[dict]]:
+        stored = []
+        for message, future in batch:
+            try:
+                stored += await self._insert([models.Message(
+                    chat_id=message.chat_id, sender_id=message.sender_id, content=message.content, sent_at=message.sent_at
+                )])
+            except Exception as exc:
+                stored.append(None)
+                if not future.done():
+                    future.set_exception(exc)
+        return stored
+
+    @staticmethod
+    async def _insert(messages: List[models.Message]) -> List[dict]:
+        async with AsyncSession(async_engine, expire_on_commit=False) as db:
+            db.add_all(messages)
+            await bump_chat_versions(db, [message.chat_id for message in messages])
+            await db.commit()
+            return [message_payload(message) for message in messages]
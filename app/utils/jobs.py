@@ -0,0 +1,209 @@
+import asyncio
+import logging
+import os
+import secrets
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, Optional
+
+from sqlalchemy import delete, or_, update
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.database import async_engine
+import app.models as models
+from app.utils.concurrent import invalidate_album_access
+from app.utils.recent import recent_messages
+from app.utils.security import invalidate_user
+from app.utils.storage import release_blob
+from app.utils.versions import bump_chat_versions
+
+DELETE_BATCH_SIZE = int(os.getenv("DELETE_BATCH_SIZE", "5000"))
+# Running jobs not updated for this long are assumed orphaned by a dead worker.
+STALE_AFTER = timedelta(seconds=int(os.getenv("JOB_STALE_SECONDS", "600")))
+
+logger = logging.getLogger(__name__)
+
+
+async def _delete_batches(db: AsyncSession, job: models.Job, model, ids) -> None:
+    """Delete the rows selected by ``ids`` ``DELETE_BATCH_SIZE`` at a time.
+
+    Each batch is its own transaction, so the writer is never held for long.
+    """
+    while True:
+        result = await db.exec(
+            delete(model)
+            .where(model.id.in_(ids.limit(DELETE_BATCH_SIZE)))
+            .execution_options(synchronize_session=False)
+        )
+        job.progress += result.rowcount
+        job.updated_at = datetime.now(timezone.utc)
+        db.add(job)
+        await db.commit()
+        if result.rowcount < DELETE_BATCH_SIZE:
+            return
+
+
+async def _delete_album(db: AsyncSession, job: models.Job, album_id: int) -> None:
+    Image, Chat, Message = models.Image, models.Chat, models.Message
+    images = select(Image.id).where(Image.album_id == album_id)
+    blobs = set((await db.exec(
+        select(Image.sha256).where(Image.album_id == album_id, Image.sha256.is_not(None)).distinct()
+    )).all())
+
+    # Children first, newest tables last: every batch stays small even though
+    # a single DELETE of the album would cascade to all of them.
+    await _delete_batches(db, job, Message, select(Message.id).where(Message.chat_id.in_(
+        select(Chat.id).where(Chat.image_id.in_(images))
+    )))
+    await _delete_batches(db, job, Chat, select(Chat.id).where(Chat.image_id.in_(images)))
+    await _delete_batches(db, job, Image, images)
+    await db.exec(delete(models.Album).where(models.Album.id == album_id))
+    await db.commit()
+
+    invalidate_album_access(album_id=album_id)
+    for sha256 in blobs:
+        await release_blob(db, sha256)
+
+
+async def delete_album_job(db: AsyncSession, job: models.Job) -> None:
+    await _delete_album(db, job, job.target_id)
+
+
+async def _delete_sent_messages(db: AsyncSession, job: models.Job, user_id: int) -> None:
+    """Delete a user's messages in chats that outlive them, batch by batch.
+
+    Each batch bumps the version of the chats it touched in the same
+    transaction, so cached histories and ETags stop matching, and drops their
+    reconnect buffers once committed.
+    """
+    Message = models.Message
+    while True:
+        rows = (await db.exec(
+            select(Message.id, Message.chat_id).where(Message.sender_id == user_id).limit(DELETE_BATCH_SIZE)
+        )).all()
+        if not rows:
+            return
+        chat_ids = {chat_id for _, chat_id in rows}
+        await db.exec(
+            delete(Message)
+            .where(Message.id.in_([message_id for message_id, _ in rows]))
+            .execution_options(synchronize_session=False)
+        )
+        await bump_chat_versions(db, chat_ids)
+        job.progress += len(rows)
+        job.updated_at = datetime.now(timezone.utc)
+        db.add(job)
+        await db.commit()
+        for chat_id in chat_ids:
+            recent_messages.discard(chat_id)
+        if len(rows) < DELETE_BATCH_SIZE:
+            return
+
+
+async def delete_user_job(db: AsyncSession, job: models.Job) -> None:
+    user_id = job.target_id
+    for album_id in (await db.exec(select(models.Album.id).where(models.Album.owner_id == user_id))).all():
+        await _delete_album(db, job, album_id)
+    await _delete_sent_messages(db, job, user_id)
+    await db.exec(delete(models.User).where(models.User.id == user_id))
+    await db.commit()
+
+    invalidate_user(user_id)
+    invalidate_album_access(user_id=user_id)
+
+
+HANDLERS: Dict[str, Callable[[AsyncSession, models.Job], Awaitable[None]]] = {
+    "delete_album": delete_album_job,
+    "delete_user": delete_user_job,
+}
+
+
+class JobRunner:
+    """Runs jobs stored in the ``jobs`` table, one at a time, on the event loop.
+
+    A job is claimed by moving it from ``pending`` to ``running`` in a single
+    UPDATE, so several workers resuming jobs never run the same one twice.
+    """
+
+    def __init__(self) -> None:
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    async def submit(self, db: AsyncSession, kind: str, target_id: int) -> models.Job:
+        """Store a job in the caller's session, commit it and queue it."""
+        job = models.Job(id=secrets.token_urlsafe(16), kind=kind, target_id=target_id)
+        db.add(job)
+        await db.commit()
+        self._enqueue(job.id)
+        return job
+
+    async def resume(self) -> None:
+        """Queue jobs left pending or orphaned by a previous process."""
+        stale = datetime.now(timezone.utc) - STALE_AFTER
+        try:
+            async with AsyncSession(async_engine) as db:
+                ids = (await db.exec(select(models.Job.id).where(or_(
+                    models.Job.status == "pending",
+                    (models.Job.status == "running") & (models.Job.updated_at < stale),
+                )))).all()
+        except Exception as exc:  # e.g. before init_db created the table
+            logger.warning("Could not resume jobs: %s", exc)
+            return
+        for job_id in ids:
+            self._enqueue(job_id, resume=True)
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = self._queue = self._loop = None
+
+    def _enqueue(self, job_id: str, resume: bool = False) -> None:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._task = loop.create_task(self._run())
+        self._queue.put_nowait((job_id, resume))
+
+    async def _run(self) -> None:
+        while True:
+            job_id, resume = await self._queue.get()
+            try:
+                await self._execute(job_id, resume)
+            except Exception:
+                logger.exception("Job %s crashed", job_id)
+
+    async def _execute(self, job_id: str, resume: bool) -> None:
+        async with AsyncSession(async_engine, expire_on_commit=False) as db:
+            claimable = [models.Job.status == "pending"]
+            if resume:
+                claimable.append(models.Job.status == "running")
+            claimed = await db.exec(
+                update(models.Job)
+                .where(models.Job.id == job_id, or_(*claimable))
+                .values(status="running", updated_at=datetime.now(timezone.utc))
+            )
+            await db.commit()
+            if not claimed.rowcount:
+                return
+
+            job = await db.get(models.Job, job_id)
+            try:
+                await HANDLERS[job.kind](db, job)
+                job.status = "done"
+            except Exception as exc:
+                logger.exception("Job %s (%s %s) failed", job.id, job.kind, job.target_id)
+                await db.rollback()
+                job = await db.get(models.Job, job_id)
+                job.status, job.error = "failed", str(exc)
+            job.updated_at = datetime.now(timezone.utc)
+            db.add(job)
+            await db.commit()
+
+
+jobs = JobRunner()
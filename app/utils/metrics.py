@@ -0,0 +1,216 @@
+import bisect
+import math
+import time
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.utils.profiling import current_profile, route_template
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()) -> None:
+        self.name, self.help, self.labelnames = name, help, tuple(labelnames)
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, *labels) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self) -> Iterable[Tuple[str, str, float]]:
+        for labels, value in self._values.items():
+            yield self.name, _format_labels(self.labelnames, labels), value
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value: float, *labels) -> None:
+        self._values[labels] = value
+
+
+class Histogram:
+    """Cumulative-bucket histogram; ``observe`` is a bisect and two increments."""
+
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS) -> None:
+        self.name, self.help, self.labelnames = name, help, tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series: Dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels) -> None:
+        series = self._series.get(labels)
+        if series is None:
+            # Per-bucket counts (the last one is +Inf), then the sum.
+            series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def samples(self) -> Iterable[Tuple[str, str, float]]:
+        for labels, series in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), series):
+                cumulative += count
+                yield f"{self.name}_bucket", _format_labels(self.labelnames + ("le",), labels + (_format_value(bound),)), cumulative
+            yield f"{self.name}_sum", _format_labels(self.labelnames, labels), series[-1]
+            yield f"{self.name}_count", _format_labels(self.labelnames, labels), cumulative
+
+
+class Registry:
+    """Metrics rendered in the Prometheus text format.
+
+    Metrics updated on the hot path are registered objects. Values that
+    already live elsewhere (pool, hasher, sockets) are read by collectors at
+    scrape time, so they cost nothing between scrapes.
+    """
+
+    def __init__(self) -> None:
+        self._metrics: list = []
+        self._collectors: List[Callable[[], Iterable[Tuple[str, str, str, Sequence[str], Iterable[tuple]]]]] = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def collector(self, function: Callable):
+        """Register ``function`` yielding ``(name, type, help, labelnames, [(labels, value), ...])``."""
+        self._collectors.append(function)
+        return function
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(f"{name}{labels} {_format_value(value)}" for name, labels, value in metric.samples())
+        for collect in self._collectors:
+            for name, kind, help, labelnames, samples in collect():
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                lines.extend(
+                    f"{name}{_format_labels(labelnames, labels)} {_format_value(value)}"
+                    for labels, value in samples if value is not None
+                )
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+http_request_duration = registry.register(Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route.", ("method", "route", "status")
+))
+http_request_queries = registry.register(Histogram(
+    "http_request_db_queries", "Database statements executed per HTTP request.", ("route",), buckets=COUNT_BUCKETS
+))
+http_request_query_time = registry.register(Histogram(
+    "http_request_db_seconds", "Time spent in database statements per HTTP request.", ("route",)
+))
+db_queries = registry.register(Counter("db_queries_total", "Database statements executed.", ("engine",)))
+db_query_duration = registry.register(Histogram(
+    "db_query_duration_seconds", "Database statement latency.", ("engine",)
+))
+broadcast_fanout = registry.register(Histogram(
+    "chat_broadcast_fanout_seconds", "Time to queue a chat event for every local subscriber."
+))
+message_delivery = registry.register(Histogram(
+    "chat_message_delivery_seconds", "Time from a message being sent to its broadcast reaching this worker."
+))
+
+
+def observe_delivery(sent_at: Optional[str]) -> None:
+    """Record how long ago a broadcast message was sent, from its ISO ``sent_at``."""
+    if not sent_at:
+        return
+    sent = datetime.fromisoformat(sent_at)
+    if sent.tzinfo is None:
+        sent = sent.replace(tzinfo=timezone.utc)
+    message_delivery.observe(max((datetime.now(timezone.utc) - sent).total_seconds(), 0.0))
+
+
+class RequestStats:
+    __slots__ = ("queries", "query_time")
+
+    def __init__(self) -> None:
+        self.queries = 0
+        self.query_time = 0.0
+
+
+# Set for the duration of each HTTP request; engine hooks add to it.
+current_request: ContextVar[Optional[RequestStats]] = ContextVar("current_request", default=None)
+
+
+def instrument_engine(sync_engine, name: str) -> None:
+    """Count and time every statement run by ``sync_engine``."""
+    from sqlalchemy import event
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        context._query_start = time.perf_counter()
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - context._query_start
+        db_queries.inc(1, name)
+        db_query_duration.observe(elapsed, name)
+        stats = current_request.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.query_time += elapsed
+        profile = current_profile.get()
+        if profile is not None:
+            profile.record(statement, parameters, elapsed)
+
+
+class MetricsMiddleware:
+    """Records latency, status and database usage of every HTTP request, labelled by route template."""
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        stats = RequestStats()
+        token = current_request.set(stats)
+        status = 500
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            current_request.reset(token)
+            route = route_template(scope)
+            http_request_duration.observe(time.perf_counter() - start, scope["method"], route, str(status))
+            http_request_queries.observe(stats.queries, route)
+            http_request_query_time.observe(stats.query_time, route)
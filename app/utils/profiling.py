@@ -0,0 +1,141 @@
+import logging
+import os
+import re
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, List, Optional
+
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+# Off by default: every statement of a profiled request is normalised and counted.
+ENABLED = os.getenv("QUERY_PROFILING", "off").lower() in ("1", "true", "on")
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "100"))
+# A statement shape repeated more often than this in one request is reported as N+1.
+REPEAT_THRESHOLD = int(os.getenv("QUERY_REPEAT_THRESHOLD", "5"))
+
+logger = logging.getLogger(__name__)
+
+_SPACES = re.compile(r"\s+")
+# Expanded IN lists: (?, ?, ?) on SQLite, ($1, $2) on asyncpg.
+_PLACEHOLDER_LISTS = re.compile(r"\bIN \(\s*(?:\?|\$\d+)(?:\s*,\s*(?:\?|\$\d+))+\s*\)", re.IGNORECASE)
+_NUMBERED = re.compile(r"\$\d+")
+
+
+def statement_shape(statement: str) -> str:
+    """Normalise a statement so executions differing only in parameters compare equal."""
+    shape = _SPACES.sub(" ", statement).strip()
+    shape = _PLACEHOLDER_LISTS.sub("IN (?)", shape)
+    return _NUMBERED.sub("?", shape)
+
+
+def route_template(scope: Scope) -> str:
+    route = scope.get("route")
+    return getattr(route, "path", None) or "unmatched"
+
+
+class QueryProfile:
+    """Statements run while serving one request."""
+
+    def __init__(self, scope: Scope) -> None:
+        self.scope = scope
+        self.queries = 0
+        self.query_time = 0.0
+        self.shapes: Dict[str, int] = {}
+
+    @property
+    def route(self) -> str:
+        # Resolved lazily: routing happens after the profile is created.
+        return f"{self.scope['method']} {route_template(self.scope)}"
+
+    def record(self, statement: str, parameters, elapsed: float) -> None:
+        self.queries += 1
+        self.query_time += elapsed
+        shape = statement_shape(statement)
+        self.shapes[shape] = self.shapes.get(shape, 0) + 1
+        if elapsed * 1000 >= SLOW_QUERY_MS:
+            logger.warning(
+                "Slow query (%.1f ms) in %s: %s params=%r", elapsed * 1000, self.route, shape, parameters
+            )
+
+    def repeated(self, threshold: int) -> Dict[str, int]:
+        return {shape: count for shape, count in self.shapes.items() if count > threshold}
+
+    def summary(self) -> str:
+        lines = [f"{self.route}: {self.queries} queries in {self.query_time * 1000:.1f} ms"]
+        lines += [f"  {count} x {shape}" for shape, count in sorted(self.shapes.items(), key=lambda item: -item[1])]
+        return "\n".join(lines)
+
+
+# Set while a profiled request runs; the engine hooks in app.utils.metrics feed it.
+current_profile: ContextVar[Optional[QueryProfile]] = ContextVar("current_profile", default=None)
+
+
+class QueryProfiler:
+    """Profiles requests when ``QUERY_PROFILING`` is on or a test is recording."""
+
+    def __init__(self, enabled: bool, repeat_threshold: int) -> None:
+        self.enabled = enabled
+        self.repeat_threshold = repeat_threshold
+        self._recorders: List[List[QueryProfile]] = []
+
+    @property
+    def active(self) -> bool:
+        return self.enabled or bool(self._recorders)
+
+    @contextmanager
+    def record(self) -> Iterator[List[QueryProfile]]:
+        """Collect the profile of every request finished inside the block."""
+        profiles: List[QueryProfile] = []
+        self._recorders.append(profiles)
+        try:
+            yield profiles
+        finally:
+            self._recorders.remove(profiles)
+
+    def finish(self, profile: QueryProfile) -> None:
+        for shape, count in profile.repeated(self.repeat_threshold).items():
+            logger.warning("Possible N+1 in %s: %d x %s", profile.route, count, shape)
+        for profiles in self._recorders:
+            profiles.append(profile)
+
+
+profiler = QueryProfiler(ENABLED, REPEAT_THRESHOLD)
+
+
+class QueryProfilerMiddleware:
+    """Attaches a ``QueryProfile`` to HTTP requests while ``profiler`` is active."""
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or not profiler.active:
+            await self.app(scope, receive, send)
+            return
+
+        profile = QueryProfile(scope)
+        token = current_profile.set(profile)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_profile.reset(token)
+            profiler.finish(profile)
+
+
+@contextmanager
+def query_budget(max_queries: int, max_repeats: Optional[int] = None) -> Iterator[List[QueryProfile]]:
+    """Fail if any request made inside the block exceeds a query budget.
+
+    ``max_queries`` bounds the statements of each request and ``max_repeats``
+    how often a single statement shape may run in it. For use in tests::
+
+        with query_budget(3):
+            client.get("/me/albums/1")
+    """
+    with profiler.record() as profiles:
+        yield profiles
+    for profile in profiles:
+        if profile.queries > max_queries:
+            raise AssertionError(f"Query budget of {max_queries} exceeded\n{profile.summary()}")
+        if max_repeats is not None and profile.repeated(max_repeats):
+            raise AssertionError(f"Statement repeated more than {max_repeats} times\n{profile.summary()}")
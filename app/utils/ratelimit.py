@@ -0,0 +1,99 @@
+import math
+import os
+import time
+from collections import OrderedDict
+from typing import Hashable, Optional, Tuple
+
+from fastapi import Depends, HTTPException, Request
+
+from app.schemas import UserResponse
+from app.utils.security import get_current_user
+
+PERIODS = {"second": 1, "minute": 60, "hour": 3600}
+
+
+def parse_rate(value: str) -> Optional[Tuple[float, int]]:
+    """Parse ``"<count>/<second|minute|hour>"`` into (tokens per second, burst). ``off`` disables."""
+    if value.strip().lower() == "off":
+        return None
+    count, period = value.split("/")
+    return int(count) / PERIODS[period.strip()], int(count)
+
+
+class TokenBucketLimiter:
+    """In-process token buckets, one per key (user id or client address).
+
+    Each bucket holds up to ``burst`` tokens and refills at ``rate`` tokens per
+    second; a request takes one. Only the ``max_keys`` most recently seen keys
+    are tracked. Used from the event loop only, so no locking.
+    """
+
+    def __init__(self, name: str, rate: float, burst: int, max_keys: int = 100_000) -> None:
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.rejected = 0
+        self._buckets: "OrderedDict[Hashable, Tuple[float, float]]" = OrderedDict()
+
+    def acquire(self, key: Hashable) -> float:
+        """Take a token for ``key``. Returns 0 on success, else the seconds until one is available."""
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens >= 1:
+            self._buckets[key] = (tokens - 1, now)
+            wait = 0.0
+        else:
+            self._buckets[key] = (tokens, now)
+            self.rejected += 1
+            wait = (1 - tokens) / self.rate
+        if len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return wait
+
+    def clear(self) -> None:
+        self._buckets.clear()
+
+    def stats(self) -> dict:
+        return {"rate_per_second": self.rate, "burst": self.burst, "keys": len(self._buckets), "rejected": self.rejected}
+
+
+def limiter_from_env(name: str, variable: str, default: str) -> Optional[TokenBucketLimiter]:
+    rate = parse_rate(os.getenv(variable, default))
+    return TokenBucketLimiter(name, *rate) if rate else None
+
+
+# Login runs bcrypt, so it is limited per client address before any work.
+login_limiter = limiter_from_env("login", "RATE_LIMIT_LOGIN", "10/minute")
+message_limiter = limiter_from_env("messages", "RATE_LIMIT_MESSAGES", "60/minute")
+ws_frame_limiter = limiter_from_env("ws_frames", "RATE_LIMIT_WS_FRAMES", "120/minute")
+
+
+def check(limiter: Optional[TokenBucketLimiter], key: Hashable) -> None:
+    """Raise a 429 with Retry-After if ``key`` is over its limit."""
+    if limiter is None:
+        return
+    wait = limiter.acquire(key)
+    if wait:
+        raise HTTPException(
+            status_code=429,
+            detail="Too many requests",
+            headers={"Retry-After": str(math.ceil(wait))},
+        )
+
+
+async def limit_login(request: Request) -> None:
+    check(login_limiter, request.client.host if request.client else None)
+
+
+async def limit_messages(current_user: UserResponse = Depends(get_current_user)) -> None:
+    check(message_limiter, current_user.id)
+
+
+def limiter_stats() -> dict:
+    return {
+        limiter.name: limiter.stats()
+        for limiter in (login_limiter, message_limiter, ws_frame_limiter)
+        if limiter is not None
+    }
@@ -0,0 +1,97 @@
+import bisect
+import os
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Tuple
+
+
+class RecentMessages:
+    """Ring buffers of the latest delivered messages per chat, for reconnect catch-up.
+
+    Each chat keeps up to ``per_chat`` encoded messages ordered by id. Chats
+    are evicted least recently used first once all buffers together hold more
+    than ``max_bytes`` of payload.
+
+    Message ids are global, so consecutive messages of a chat rarely have
+    consecutive ids and a gap cannot be seen in the buffer itself. Each chat
+    instead has a floor: every message after it has been buffered. The floor
+    starts at the first buffered id and moves up as old messages are
+    trimmed. Messages that arrive below the floor are not buffered. Callers
+    that learn an event was lost must ``discard`` that chat's buffer, or
+    ``clear`` every buffer if they cannot tell which chat it was for.
+    """
+
+    def __init__(self, per_chat: int, max_bytes: int) -> None:
+        self.per_chat = per_chat
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._chats: "OrderedDict[int, Deque[Tuple[int, str]]]" = OrderedDict()
+        self._floors: Dict[int, int] = {}
+
+    def add(self, chat_id: int, message_id: int, payload: str) -> None:
+        buffer = self._chats.get(chat_id)
+        if buffer is None:
+            buffer = self._chats[chat_id] = deque()
+            self._floors[chat_id] = message_id
+        elif message_id < self._floors[chat_id]:
+            return
+        self._chats.move_to_end(chat_id)
+
+        if not buffer or buffer[-1][0] < message_id:
+            buffer.append((message_id, payload))
+        else:
+            # Another worker's batch can arrive after a newer one.
+            bisect.insort(buffer, (message_id, payload))
+        self.total_bytes += len(payload)
+
+        if len(buffer) > self.per_chat:
+            trimmed_id, trimmed = buffer.popleft()
+            self._floors[chat_id] = trimmed_id
+            self.total_bytes -= len(trimmed)
+        while self.total_bytes > self.max_bytes and len(self._chats) > 1:
+            evicted_id, evicted = self._chats.popitem(last=False)
+            del self._floors[evicted_id]
+            self.total_bytes -= sum(len(payload) for _, payload in evicted)
+
+    def covers(self, chat_id: int, last_seen_id: int) -> bool:
+        """Whether every message after ``last_seen_id`` is still buffered."""
+        covered = chat_id in self._chats and self._floors[chat_id] <= last_seen_id
+        if covered:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return covered
+
+    def since(self, chat_id: int, last_seen_id: int) -> List[str]:
+        buffer = self._chats.get(chat_id)
+        if not buffer:
+            return []
+        self._chats.move_to_end(chat_id)
+        return [payload for message_id, payload in buffer if message_id > last_seen_id]
+
+    def discard(self, chat_id: int) -> None:
+        """Forget a chat's buffer, e.g. after some of its messages were deleted."""
+        buffer = self._chats.pop(chat_id, None)
+        if buffer is not None:
+            del self._floors[chat_id]
+            self.total_bytes -= sum(len(payload) for _, payload in buffer)
+
+    def clear(self) -> None:
+        self._chats.clear()
+        self._floors.clear()
+        self.total_bytes = 0
+
+    def stats(self) -> dict:
+        return {
+            "chats": len(self._chats),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+recent_messages = RecentMessages(
+    per_chat=int(os.getenv("HOT_CHAT_MESSAGES", "200")),
+    max_bytes=int(os.getenv("HOT_CHAT_BYTES", str(16 * 1024 * 1024))),
+)
@@ -0,0 +1,151 @@
+import re
+from typing import Optional
+
+from sqlalchemy import Engine, column, func, literal_column, null, table, text, union_all
+from sqlmodel import select
+
+import app.models as models
+
+SNIPPET_TOKENS = 12
+
+# SQLite: external-content FTS5 tables over messages and images, kept in sync
+# by triggers so every write path (ORM, group commit, bulk SQL) is covered.
+SQLITE_INDEXES = {
+    "messages_fts": [
+        "CREATE VIRTUAL TABLE messages_fts USING fts5("
+        "content, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+        "CREATE TRIGGER messages_fts_ai AFTER INSERT ON messages BEGIN "
+        "INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content); END",
+        "CREATE TRIGGER messages_fts_ad AFTER DELETE ON messages BEGIN "
+        "INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content); END",
+        "CREATE TRIGGER messages_fts_au AFTER UPDATE OF content ON messages BEGIN "
+        "INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content); "
+        "INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content); END",
+        "INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')",
+    ],
+    "images_fts": [
+        "CREATE VIRTUAL TABLE images_fts USING fts5("
+        "title, description, content='images', content_rowid='id', tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+        "CREATE TRIGGER images_fts_ai AFTER INSERT ON images BEGIN "
+        "INSERT INTO images_fts(rowid, title, description) VALUES (new.id, new.title, new.description); END",
+        "CREATE TRIGGER images_fts_ad AFTER DELETE ON images BEGIN "
+        "INSERT INTO images_fts(images_fts, rowid, title, description) "
+        "VALUES ('delete', old.id, old.title, old.description); END",
+        "CREATE TRIGGER images_fts_au AFTER UPDATE OF title, description ON images BEGIN "
+        "INSERT INTO images_fts(images_fts, rowid, title, description) "
+        "VALUES ('delete', old.id, old.title, old.description); "
+        "INSERT INTO images_fts(rowid, title, description) VALUES (new.id, new.title, new.description); END",
+        "INSERT INTO images_fts(images_fts) VALUES ('rebuild')",
+    ],
+}
+
+# Postgres: GIN expression indexes. Queries must use the same expressions.
+MESSAGE_TSVECTOR = "to_tsvector('simple', messages.content)"
+IMAGE_TSVECTOR = "to_tsvector('simple', coalesce(images.title, '') || ' ' || coalesce(images.description, ''))"
+POSTGRES_INDEXES = [
+    f"CREATE INDEX IF NOT EXISTS ix_messages_content_tsv ON messages USING gin (({MESSAGE_TSVECTOR}))",
+    f"CREATE INDEX IF NOT EXISTS ix_images_text_tsv ON images USING gin (({IMAGE_TSVECTOR}))",
+]
+
+
+def create_search_indexes(engine: Engine) -> None:
+    """Create the full-text indexes for the engine's backend, filling new ones from existing rows.
+
+    SQLite indexes created with a different definition (e.g. fewer prefix
+    lengths) are dropped and rebuilt.
+    """
+    with engine.begin() as connection:
+        if engine.dialect.name == "postgresql":
+            for statement in POSTGRES_INDEXES:
+                connection.execute(text(statement))
+        elif engine.dialect.name == "sqlite":
+            existing = dict(connection.execute(
+                text("SELECT name, sql FROM sqlite_master WHERE type = 'table'")
+            ).all())
+            for name, statements in SQLITE_INDEXES.items():
+                if name in existing and existing[name] == statements[0]:
+                    continue
+                if name in existing:
+                    for suffix in ("ai", "ad", "au"):
+                        connection.execute(text(f"DROP TRIGGER IF EXISTS {name}_{suffix}"))
+                    connection.execute(text(f"DROP TABLE {name}"))
+                for statement in statements:
+                    connection.execute(text(statement))
+
+
+def fts5_query(terms: str) -> Optional[str]:
+    """Turn free text into an FTS5 query: every word must match, the last as a prefix.
+
+    Words are quoted so user input can never be parsed as FTS5 syntax.
+    """
+    words = re.findall(r"[^\W_]+", terms)
+    if not words:
+        return None
+    return " ".join(f'"{word}"' for word in words) + "*"
+
+
+def search_statement(dialect: str, album_ids, terms: str):
+    """Matching messages and images in ``album_ids``, best first.
+
+    Rows carry ``kind``, ``id``, ``album_id``, ``image_id``, ``chat_id``,
+    ``snippet`` and ``rank`` (lower is better). Every accessible match is
+    ranked by the database: ``bm25()`` on SQLite, ``ts_rank`` on Postgres.
+    Returns None if ``terms`` has nothing to search for.
+    """
+    Message, Chat, Image = models.Message, models.Chat, models.Image
+    in_albums = Image.album_id.in_(select(album_ids.c.album_id))
+
+    if dialect == "postgresql":
+        if not terms.strip():
+            return None
+        tsquery = func.plainto_tsquery(literal_column("'simple'"), terms)
+        message_vector, image_vector = literal_column(MESSAGE_TSVECTOR), literal_column(IMAGE_TSVECTOR)
+        messages = select(
+            func.left(Message.content, 200).label("snippet"), (-func.ts_rank(message_vector, tsquery)).label("rank")
+        ).where(message_vector.op("@@")(tsquery))
+        images = select(
+            func.left(func.coalesce(Image.title + " — " + Image.description, Image.title), 200).label("snippet"),
+            (-func.ts_rank(image_vector, tsquery)).label("rank"),
+        ).where(image_vector.op("@@")(tsquery))
+    else:
+        query = fts5_query(terms)
+        if query is None:
+            return None
+        messages_fts = table("messages_fts", column("rowid"))
+        images_fts = table("images_fts", column("rowid"))
+        message_index, image_index = literal_column("messages_fts"), literal_column("images_fts")
+        messages = (
+            select(
+                func.snippet(message_index, 0, "[", "]", "…", SNIPPET_TOKENS).label("snippet"),
+                func.bm25(message_index).label("rank"),
+            )
+            .select_from(messages_fts)
+            .join(Message, Message.id == messages_fts.c.rowid)
+            .where(message_index.op("MATCH")(query))
+        )
+        images = (
+            select(
+                func.snippet(image_index, -1, "[", "]", "…", SNIPPET_TOKENS).label("snippet"),
+                func.bm25(image_index).label("rank"),
+            )
+            .select_from(images_fts)
+            .join(Image, Image.id == images_fts.c.rowid)
+            .where(image_index.op("MATCH")(query))
+        )
+
+    messages = messages.add_columns(
+        literal_column("'message'").label("kind"),
+        Message.id.label("id"),
+        Image.album_id.label("album_id"),
+        Image.id.label("image_id"),
+        Message.chat_id.label("chat_id"),
+    ).join_from(Message, Chat, Chat.id == Message.chat_id).join(Image, Image.id == Chat.image_id).where(in_albums)
+    images = images.add_columns(
+        literal_column("'image'").label("kind"),
+        Image.id.label("id"),
+        Image.album_id.label("album_id"),
+        Image.id.label("image_id"),
+        null().label("chat_id"),
+    ).where(in_albums)
+    hits = union_all(messages, images).subquery()
+    return select(*hits.c).order_by(hits.c.rank, hits.c.kind, hits.c.id)
@@ -1,12 +1,53 @@
+import hmac
+import os
+
 from fastapi.security import OAuth2PasswordBearer
 from fastapi import Depends, HTTPException, status, Request, Response, WebSocket
-from sqlmodel import Session, select
-from app.database import get_db
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from app.database import get_read_db
+from app.schemas import UserResponse
+from app.utils.cache import TTLCache
 import app.models as models
 import app.auth as auth
 
+# Identities resolved from a token's ``uid`` claim. Entries are revalidated
+# against the users table once their TTL expires; /me/update and /me/delete
+# drop them immediately.
+user_cache = TTLCache(
+    maxsize=int(os.getenv("AUTH_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("AUTH_CACHE_TTL", "60")),
+)
+
+# Shared secret for /stats/* and /metrics. Unset, those endpoints refuse
+# every request.
+OPS_TOKEN = os.getenv("OPS_TOKEN", "")
+
+
+async def resolve_user(data: dict, db: AsyncSession):
+    """Return the identity carried by a decoded token, or None if the user is gone."""
+    user_id = data.get("uid")
+    if user_id is not None:
+        user = user_cache.get(user_id)
+        if user is not None:
+            return user
+        db_user = await db.get(models.User, user_id)
+    else:
+        # Tokens issued before ids were embedded only carry the email.
+        db_user = (await db.exec(select(models.User).filter(models.User.email == data.get("sub")))).first()
+
+    if db_user is None:
+        return None
+    user = UserResponse.model_validate(db_user)
+    user_cache.set(user.id, user)
+    return user
 
-def get_current_user(request: Request, response: Response, db: Session = Depends(get_db)):
+
+def invalidate_user(user_id: int) -> None:
+    user_cache.pop(user_id)
+
+
+async def get_current_user(request: Request, response: Response, db: AsyncSession = Depends(get_read_db)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -25,7 +66,7 @@ def get_current_user(request: Request, response: Response, db: Session = Depends
         if data is None:
             raise credentials_exception
 
-        user = db.exec(select(models.User).filter(models.User.email == data.get("sub"))).first()
+        user = await resolve_user(data, db)
         if user is None:
             raise credentials_exception
 
@@ -33,8 +74,8 @@ def get_current_user(request: Request, response: Response, db: Session = Depends
     except:
         response.delete_cookie("access")
         raise credentials_exception
-        
-async def get_current_user_ws(websocket: WebSocket, db: Session = Depends(get_db)):
+
+async def get_current_user_ws(websocket: WebSocket, db: AsyncSession = Depends(get_read_db)):
     credentials_exception = HTTPException(
         status_code=status.WS_1008_POLICY_VIOLATION,
         detail="Could not validate credentials",
@@ -54,7 +95,7 @@ async def get_current_user_ws(websocket: WebSocket, db: Session = Depends(get_db
             await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
             raise credentials_exception
 
-        user = db.exec(select(models.User).filter(models.User.email == data.get("sub"))).first()
+        user = await resolve_user(data, db)
         if user is None:
             await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
             raise credentials_exception
@@ -64,3 +105,15 @@ async def get_current_user_ws(websocket: WebSocket, db: Session = Depends(get_db
         await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
         raise credentials_exception
 
+
+async def require_ops_token(request: Request):
+    """Allow operational endpoints only to callers sending ``Authorization: Bearer <OPS_TOKEN>``."""
+    if not OPS_TOKEN:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Set OPS_TOKEN to enable this endpoint")
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(token.encode(), OPS_TOKEN.encode()):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
@@ -0,0 +1,40 @@
+from typing import Iterable, List, Type
+
+from pydantic import BaseModel, TypeAdapter
+from sqlmodel import SQLModel
+
+try:
+    import orjson
+except ImportError:  # rows are then encoded through pydantic
+    orjson = None
+else:
+    ORJSON_OPTIONS = orjson.OPT_UTC_Z | orjson.OPT_NAIVE_UTC
+
+
+def response_columns(model: Type[SQLModel], schema: Type[BaseModel]) -> list:
+    """Columns of ``model`` matching ``schema``'s fields, in the schema's order.
+
+    Selecting these instead of the entity gives plain rows that serialize to
+    exactly what ``schema`` would produce.
+    """
+    return [getattr(model, field) for field in schema.model_fields]
+
+
+def dump_rows(rows: Iterable, schema: Type[BaseModel]) -> bytes:
+    """Encode rows selected with ``response_columns`` as a JSON array.
+
+    Skips building a model per row. Naive datetimes are taken as UTC and,
+    like pydantic does for aware ones, rendered with a ``Z`` suffix.
+    """
+    items = [row._asdict() for row in rows]
+    if orjson is None:
+        adapter = TypeAdapter(List[schema])
+        return adapter.dump_json(adapter.validate_python(items))
+    return orjson.dumps(items, option=ORJSON_OPTIONS)
+
+
+def dump_ndjson(rows: Iterable, schema: Type[BaseModel]) -> bytes:
+    """Encode rows selected with ``response_columns`` one JSON object per line."""
+    if orjson is None:
+        return "".join(schema.model_validate(row._asdict()).model_dump_json() + "\n" for row in rows).encode()
+    return b"".join(orjson.dumps(row._asdict(), option=ORJSON_OPTIONS | orjson.OPT_APPEND_NEWLINE) for row in rows)
@@ -0,0 +1,229 @@
+import asyncio
+import fcntl
+import hashlib
+import os
+import tempfile
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable, Coroutine, Dict, List, NamedTuple, Optional
+
+from fastapi import HTTPException, Request, Response, UploadFile
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse
+from fastapi.routing import APIRoute
+from sqlalchemy import func
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from starlette.datastructures import FormData, Headers
+from starlette.formparsers import MultiPartException, MultiPartParser, parse_options_header
+
+import app.models as models
+
+# Image files are stored once per distinct content, under their SHA-256.
+MEDIA_ROOT = os.getenv("MEDIA_ROOT", "./media")
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(50 * 1024 * 1024)))
+CHUNK_SIZE = 1024 * 1024
+# Room in a request body for the multipart boundaries and the other form fields.
+FORM_OVERHEAD = 64 * 1024
+# Types served inline. Anything else (HTML, SVG, ...) could run script on the
+# API origin, so it is recorded and served as an opaque download.
+IMAGE_CONTENT_TYPES = frozenset({
+    "image/avif", "image/bmp", "image/gif", "image/heic", "image/heif", "image/jpeg", "image/png", "image/webp",
+})
+
+
+class StoredBlob(NamedTuple):
+    sha256: str
+    size: int
+
+
+def blob_path(sha256: str) -> str:
+    return os.path.join(MEDIA_ROOT, sha256[:2], sha256[2:4], sha256)
+
+
+def stored_content_type(declared: Optional[str]) -> str:
+    """The type to record for an upload: the client's if it is an allowed image type."""
+    declared = (declared or "").split(";")[0].strip().lower()
+    return declared if declared in IMAGE_CONTENT_TYPES else "application/octet-stream"
+
+
+class BlobFile:
+    """Where the form parser writes an uploaded file: a temporary file in the
+    store, hashed and size-checked as each chunk arrives, so the upload is
+    written to disk once and an oversized one is stopped early.
+    """
+
+    def __init__(self) -> None:
+        tmp_dir = os.path.join(MEDIA_ROOT, "tmp")
+        os.makedirs(tmp_dir, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(dir=tmp_dir)
+        self._file = os.fdopen(fd, "w+b")
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data: bytes) -> int:
+        self.size += len(data)
+        if self.size > MAX_UPLOAD_BYTES:
+            raise HTTPException(status_code=413, detail="File too large")
+        self.digest.update(data)
+        return self._file.write(data)
+
+    def read(self, size: int = -1) -> bytes:
+        return self._file.read(size)
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        return self._file.seek(offset, whence)
+
+    def close(self) -> None:
+        """Close the file, deleting it unless ``save_upload`` moved it into the store."""
+        self._file.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class BlobMultiPartParser(MultiPartParser):
+    """MultiPartParser that writes file parts to ``BlobFile`` instead of a spooled temporary file."""
+
+    def on_headers_finished(self) -> None:
+        super().on_headers_finished()
+        upload = self._current_part.file
+        if upload is not None:
+            self._files_to_close_on_error.pop().close()
+            upload.file = BlobFile()
+            self._files_to_close_on_error.append(upload.file)
+
+    async def parse(self) -> FormData:
+        try:
+            return await super().parse()
+        except HTTPException:
+            for file in self._files_to_close_on_error:
+                await run_in_threadpool(file.close)
+            raise
+
+
+class UploadRequest(Request):
+    """Request whose multipart form streams files into the store.
+
+    Bodies declaring a Content-Length over the upload limit are refused
+    before any of them is read.
+    """
+
+    async def _get_form(self, **kwargs) -> FormData:
+        if self._form is None:
+            length = self.headers.get("content-length", "")
+            if length.isdigit() and int(length) > MAX_UPLOAD_BYTES + FORM_OVERHEAD:
+                raise HTTPException(status_code=413, detail="File too large")
+            content_type, _ = parse_options_header(self.headers.get("content-type"))
+            if content_type == b"multipart/form-data":
+                try:
+                    self._form = await BlobMultiPartParser(self.headers, self.stream(), **kwargs).parse()
+                except MultiPartException as exc:
+                    raise HTTPException(status_code=400, detail=exc.message)
+        return await super()._get_form(**kwargs)
+
+
+class UploadRoute(APIRoute):
+    """Route class for endpoints taking files that ``save_upload`` stores."""
+
+    def get_route_handler(self) -> Callable[[Request], Coroutine[None, None, Response]]:
+        handler = super().get_route_handler()
+
+        async def upload_handler(request: Request) -> Response:
+            return await handler(UploadRequest(request.scope, request.receive))
+
+        return upload_handler
+
+
+# Per-file locks, with the number of holders and waiters of each. Uploads hold
+# the lock from placing their file until their image row is committed, and
+# releases hold it while counting references and unlinking, so a release can
+# never remove a file an upload is about to reference. Within a process an
+# asyncio lock queues the requests; across processes each holder also takes
+# an flock on one of 256 lock files picked by the hash.
+_blob_locks: Dict[str, List] = {}
+
+
+def _lock_stripe(sha256: str) -> int:
+    lock_dir = os.path.join(MEDIA_ROOT, "locks")
+    os.makedirs(lock_dir, exist_ok=True)
+    fd = os.open(os.path.join(lock_dir, sha256[:2]), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+    except BaseException:
+        os.close(fd)
+        raise
+    return fd
+
+
+@asynccontextmanager
+async def blob_lock(sha256: str) -> AsyncIterator[None]:
+    entry = _blob_locks.setdefault(sha256, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            fd = await run_in_threadpool(_lock_stripe, sha256)
+            try:
+                yield
+            finally:
+                os.close(fd)
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del _blob_locks[sha256]
+
+
+@asynccontextmanager
+async def save_upload(upload: UploadFile) -> AsyncIterator[StoredBlob]:
+    """Move an upload parsed by an ``UploadRoute`` to its content address.
+
+    If that content is already stored the upload is discarded. Commit the
+    image that references the file inside the ``async with`` block.
+    """
+    blob = upload.file
+    if not isinstance(blob, BlobFile):
+        raise TypeError("save_upload needs a route declared with route_class=UploadRoute")
+    sha256 = blob.digest.hexdigest()
+    async with blob_lock(sha256):
+        final_path = blob_path(sha256)
+        if not os.path.exists(final_path):
+            os.makedirs(os.path.dirname(final_path), exist_ok=True)
+            os.replace(blob.path, final_path)
+        yield StoredBlob(sha256, blob.size)
+
+
+async def release_blob(db: AsyncSession, sha256: str) -> None:
+    """Delete a stored file and its derivatives once no image references it any more."""
+    from app.utils.thumbnails import thumbnails  # thumbnails imports this module
+
+    async with blob_lock(sha256):
+        references = (await db.exec(
+            select(func.count()).select_from(models.Image).where(models.Image.sha256 == sha256)
+        )).one()
+        if references:
+            return
+        if os.path.exists(blob_path(sha256)):
+            os.unlink(blob_path(sha256))
+        thumbnails.discard(sha256)
+
+
+class BlobResponse(FileResponse):
+    """FileResponse that hands whole-file responses to the server when it can.
+
+    Servers advertising the ASGI ``http.response.pathsend`` extension send the
+    file themselves (sendfile). Range requests, and servers without the
+    extension, use Starlette's chunked implementation. Both get the
+    Content-Length, Last-Modified and (unless given) ETag headers from the
+    file's stat, taken here if no ``stat_result`` was passed.
+    """
+
+    async def __call__(self, scope, receive, send) -> None:
+        if self.stat_result is None:
+            self.stat_result = await run_in_threadpool(os.stat, self.path)
+            self.set_stat_headers(self.stat_result)
+        if "http.response.pathsend" in scope.get("extensions", {}) and "range" not in Headers(scope=scope):
+            await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+            if scope["method"] == "HEAD":
+                await send({"type": "http.response.body", "body": b""})
+            else:
+                await send({"type": "http.response.pathsend", "path": os.path.abspath(self.path)})
+            return
+        await super().__call__(scope, receive, send)
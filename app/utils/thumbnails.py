@@ -0,0 +1,214 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, List, Optional, Tuple
+
+from app.utils.cache import TTLCache
+from app.utils.storage import MEDIA_ROOT, blob_path
+
+try:
+    import PIL
+except ImportError:  # thumbnails are optional; endpoints fall back to placeholders
+    PIL = None
+
+logger = logging.getLogger(__name__)
+
+# Longest side, in pixels, of each derivative.
+SIZES = {"thumb": 256, "medium": 640, "preview": 1280}
+
+
+def derivative_path(sha256: str, size: str) -> str:
+    return f"{blob_path(sha256)}.{size}.jpg"
+
+
+def placeholder_svg(size: str) -> str:
+    side = SIZES[size]
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{side}" height="{side}">'
+        f'<rect width="100%" height="100%" fill="#e5e5e5"/></svg>'
+    )
+
+
+def render_derivative(source: str, target: str, max_side: int) -> int:
+    """Write a JPEG no larger than ``max_side`` on either side. Runs in a worker process."""
+    from PIL import Image as PILImage
+
+    tmp_path = f"{target}.{os.getpid()}.tmp"
+    with PILImage.open(source) as image:
+        image.thumbnail((max_side, max_side))
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        image.save(tmp_path, "JPEG", quality=82, optimize=True)
+    os.replace(tmp_path, target)
+    return os.path.getsize(target)
+
+
+class ThumbnailService:
+    """Generates image derivatives on a process pool and bounds their disk usage.
+
+    Derivatives live next to the original file. Once they take more than
+    ``max_bytes`` the least recently served ones are deleted; they are
+    regenerated on the next request. A pool broken by a dead worker (a Pillow
+    crash, an OOM kill) is replaced; a derivative that breaks it twice is
+    treated as failed.
+    """
+
+    def __init__(self, workers: int, max_bytes: int) -> None:
+        self.workers = workers
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._pending: Dict[Tuple[str, str], asyncio.Future] = {}
+        self._failed = TTLCache(maxsize=10000, ttl=300)
+        self._crashed = TTLCache(maxsize=10000, ttl=300)
+        self.restarts = 0
+        self._index: "OrderedDict[str, int]" = OrderedDict()
+        self._index_loaded: Optional[asyncio.Future] = None
+
+    def schedule(self, sha256: str) -> None:
+        """Queue every derivative of a newly stored file."""
+        for size in SIZES:
+            if not os.path.exists(derivative_path(sha256, size)):
+                self._generate(sha256, size)
+
+    async def get(self, sha256: str, size: str, timeout: float) -> Optional[str]:
+        """Return the derivative's path, waiting up to ``timeout`` for it to be generated."""
+        await self._load_index()
+        path = derivative_path(sha256, size)
+        if os.path.exists(path):
+            self._remember(path)
+            return path
+
+        for _ in range(2):
+            future = self._generate(sha256, size)
+            if future is None:
+                return None
+            try:
+                await asyncio.wait_for(asyncio.shield(future), timeout)
+            except BrokenProcessPool:
+                continue  # retried once on the replacement pool
+            except Exception:
+                return None
+            break
+        return path if os.path.exists(path) else None
+
+    def discard(self, sha256: str) -> None:
+        """Delete every derivative of a file that is no longer stored."""
+        for size in SIZES:
+            path = derivative_path(sha256, size)
+            self.total_bytes -= self._index.pop(path, 0)
+            self._failed.pop((sha256, size))
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+
+    def _generate(self, sha256: str, size: str) -> Optional[asyncio.Future]:
+        key = (sha256, size)
+        if key in self._pending:
+            return self._pending[key]
+        if PIL is None or self._failed.get(key):
+            return None
+
+        args = (render_derivative, blob_path(sha256), derivative_path(sha256, size), SIZES[size])
+        try:
+            submitted = self._pool().submit(*args)
+        except BrokenProcessPool:
+            self._replace_pool(self._executor)
+            submitted = self._pool().submit(*args)
+        executor = self._executor
+        future = asyncio.wrap_future(submitted)
+        self._pending[key] = future
+        future.add_done_callback(lambda done: self._finished(key, done, executor))
+        return future
+
+    def _pool(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+    def _replace_pool(self, executor: Optional[ProcessPoolExecutor]) -> None:
+        # Every call on a broken pool fails; the next one gets a fresh pool.
+        if executor is not None and self._executor is executor:
+            self._executor = None
+            self.restarts += 1
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _finished(self, key: Tuple[str, str], future: asyncio.Future, executor: ProcessPoolExecutor) -> None:
+        self._pending.pop(key, None)
+        if future.cancelled():
+            return
+        if isinstance(future.exception(), BrokenProcessPool):
+            self._replace_pool(executor)
+            if not self._crashed.get(key):
+                # Possibly another job's crash: let the next request retry.
+                self._crashed.set(key, True)
+                return
+        if future.exception() is not None:
+            logger.warning("Could not render %s derivative of %s: %s", key[1], key[0], future.exception())
+            self._failed.set(key, True)
+            return
+        if not os.path.exists(blob_path(key[0])):
+            # The file was released while this derivative was rendering.
+            self.discard(key[0])
+            return
+        self._remember(derivative_path(*key), future.result())
+
+    def _remember(self, path: str, size: Optional[int] = None) -> None:
+        if path in self._index:
+            self._index.move_to_end(path)
+            return
+        size = size if size is not None else os.path.getsize(path)
+        self._index[path] = size
+        self.total_bytes += size
+        self._evict()
+
+    def _evict(self) -> None:
+        while self.total_bytes > self.max_bytes and len(self._index) > 1:
+            evicted, evicted_size = self._index.popitem(last=False)
+            self.total_bytes -= evicted_size
+            try:
+                os.unlink(evicted)
+            except FileNotFoundError:
+                pass
+
+    async def _load_index(self) -> None:
+        # Derivatives left by a previous run, scanned once off the event loop.
+        if self._index_loaded is None:
+            self._index_loaded = asyncio.ensure_future(self._merge_existing())
+        await asyncio.shield(self._index_loaded)
+
+    async def _merge_existing(self) -> None:
+        found = await asyncio.to_thread(self._scan)
+        # Anything remembered meanwhile is more recent than what was on disk.
+        index = OrderedDict((path, size) for path, size in found if path not in self._index)
+        self.total_bytes += sum(index.values())
+        index.update(self._index)
+        self._index = index
+        self._evict()
+
+    @staticmethod
+    def _scan() -> List[Tuple[str, int]]:
+        suffixes = tuple(f".{size}.jpg" for size in SIZES)
+        found = []
+        for directory, _, files in os.walk(MEDIA_ROOT):
+            for name in files:
+                if name.endswith(suffixes):
+                    stat = os.stat(os.path.join(directory, name))
+                    found.append((stat.st_mtime, os.path.join(directory, name), stat.st_size))
+        return [(path, size) for _, path, size in sorted(found)]
+
+
+thumbnails = ThumbnailService(
+    workers=int(os.getenv("THUMB_WORKERS", "2")),
+    max_bytes=int(os.getenv("THUMB_CACHE_BYTES", str(512 * 1024 * 1024))),
+)
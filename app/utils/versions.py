@@ -0,0 +1,80 @@
+import os
+from typing import Awaitable, Callable, Dict, Iterable, Optional, Tuple
+
+from fastapi import Request, Response
+from sqlalchemy import update
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+import app.models as models
+from app.utils.cache import TTLCache
+
+# Rendered bodies of polled reads, keyed by (path, query, etag). A write bumps
+# the version, so stale entries are never served and simply age out.
+response_cache = TTLCache(
+    maxsize=int(os.getenv("RESPONSE_CACHE_SIZE", "512")),
+    ttl=float(os.getenv("RESPONSE_CACHE_TTL", "60")),
+)
+
+CACHE_CONTROL = "private, no-cache"
+
+
+async def bump_album_version(db: AsyncSession, album_id: int) -> None:
+    """Mark an album's contents as changed; commits with the caller's transaction."""
+    await db.exec(
+        update(models.Album)
+        .where(models.Album.id == album_id)
+        .values(version=models.Album.version + 1)
+        .execution_options(synchronize_session=False)
+    )
+
+async def bump_chat_versions(db: AsyncSession, chat_ids: Iterable[int]) -> None:
+    await db.exec(
+        update(models.Chat)
+        .where(models.Chat.id.in_(set(chat_ids)))
+        .values(version=models.Chat.version + 1)
+        .execution_options(synchronize_session=False)
+    )
+
+async def album_version(db: AsyncSession, album_id: int) -> Optional[int]:
+    return (await db.exec(select(models.Album.version).where(models.Album.id == album_id))).first()
+
+async def chat_version(db: AsyncSession, chat_id: int) -> Optional[int]:
+    return (await db.exec(select(models.Chat.version).where(models.Chat.id == chat_id))).first()
+
+
+def entity_tag(kind: str, object_id: int, version: int) -> str:
+    return f'W/"{kind}-{object_id}-{version}"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Weak comparison of ``etag`` against an If-None-Match header."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == opaque for tag in if_none_match.split(","))
+
+
+async def conditional_json(
+    request: Request,
+    etag: str,
+    render: Callable[[], Awaitable[Tuple[bytes, Dict[str, str]]]],
+) -> Response:
+    """Answer a read for a versioned resource.
+
+    Returns 304 if the client already has ``etag``, the cached body if this
+    exact URL was rendered at this version, and otherwise calls ``render`` for
+    the JSON body and extra headers.
+    """
+    headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    key = (request.url.path, request.url.query, etag)
+    cached = response_cache.get(key)
+    if cached is None:
+        cached = await render()
+        response_cache.set(key, cached)
+    body, extra_headers = cached
+    return Response(body, media_type="application/json", headers={**headers, **extra_headers})
@@ -0,0 +1,92 @@
+"""Helpers shared by the benchmark scripts: timing, percentiles and JSON results."""
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, List, Optional, Sequence
+
+
+def percentile(samples: Sequence[float], q: float) -> Optional[float]:
+    """Nearest-rank percentile of ``samples`` (``q`` between 0 and 1)."""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+def summarize(name: str, latencies: List[float], elapsed: Optional[float] = None, **extra) -> dict:
+    """Latency summary in milliseconds, plus throughput when ``elapsed`` is given."""
+    result = {
+        "name": name,
+        "count": len(latencies),
+        "p50_ms": _ms(percentile(latencies, 0.5)),
+        "p99_ms": _ms(percentile(latencies, 0.99)),
+        "max_ms": _ms(max(latencies) if latencies else None),
+    }
+    if elapsed:
+        result["per_second"] = round(len(latencies) / elapsed, 1)
+    result.update(extra)
+    return result
+
+
+def _ms(seconds: Optional[float]) -> Optional[float]:
+    return round(seconds * 1000, 3) if seconds is not None else None
+
+
+async def time_async(name: str, repeat: int, run: Callable[[], Awaitable], warmup: int = 10, **extra) -> dict:
+    """Time ``repeat`` sequential calls of ``run`` after ``warmup`` untimed ones."""
+    for _ in range(warmup):
+        await run()
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(repeat):
+        call = time.perf_counter()
+        await run()
+        latencies.append(time.perf_counter() - call)
+    return summarize(name, latencies, time.perf_counter() - start, **extra)
+
+
+def time_sync(name: str, repeat: int, run: Callable[[], object], warmup: int = 10, **extra) -> dict:
+    for _ in range(warmup):
+        run()
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(repeat):
+        call = time.perf_counter()
+        run()
+        latencies.append(time.perf_counter() - call)
+    return summarize(name, latencies, time.perf_counter() - start, **extra)
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_results(path: Optional[str], suite: str, params: dict, results: List[dict]) -> dict:
+    """Print ``results`` and, if ``path`` is set, write them with run metadata as JSON."""
+    report = {
+        "suite": suite,
+        "revision": git_revision(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "params": params,
+        "results": results,
+    }
+    for result in results:
+        fields = "  ".join(f"{key}={value}" for key, value in result.items() if key != "name")
+        print(f"{result['name']:>28}: {fields}")
+    if path:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w") as out:
+            json.dump(report, out, indent=2)
+        print(f"Results written to {path}")
+    return report
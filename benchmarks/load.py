@@ -0,0 +1,240 @@
+"""Load driver for the REST API and WebSocket fan-out.
+
+Seeds a database with ``benchmarks.seed``, starts the app under a local
+uvicorn, then measures:
+
+- REST: ``--concurrency`` clients issue reads for ``--duration`` seconds;
+  p50/p99 latency and throughput per endpoint.
+- WebSocket: ``--chats`` chats with ``--subscribers`` sockets each; one
+  socket per chat sends ``--fanout-messages`` messages and the time until
+  every subscriber receives each one is recorded.
+
+    python -m benchmarks.load --users 200 --messages 1000000 --duration 30 \\
+        --chats 20 --subscribers 50 --output bench/load.json
+
+Pass ``--url`` (and ``--manifest`` from an earlier seed run) to drive an
+already running server instead; it must share ``SECRET_KEY``.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import timedelta
+from typing import Dict, List, Optional
+
+import httpx
+import websockets
+
+from benchmarks.common import summarize, write_results
+
+os.environ.setdefault("SECRET_KEY", "benchmark-secret")
+
+
+def auth_cookie(user_id: int, email: str) -> str:
+    from app.auth import create_access_token
+
+    # Minted directly: logging in would spend the run in bcrypt and the login limiter.
+    token = create_access_token({"sub": email, "uid": user_id}, expires_delta=timedelta(hours=6))
+    return f'access="Bearer {token}"'
+
+
+def prepare_database(args) -> dict:
+    os.environ["SQLMODEL_DATABASE_URL"] = f"sqlite:///{args.database}"
+    from app.database import engine, init_db
+    from benchmarks.seed import seed
+
+    init_db()
+    return seed(
+        engine, args.users, args.albums_per_user, args.images_per_album,
+        args.participants_per_album, chat_ratio=0.5, messages=args.messages, seed=args.seed,
+    )
+
+
+def start_server(args) -> subprocess.Popen:
+    env = dict(
+        os.environ,
+        SQLMODEL_DATABASE_URL=f"sqlite:///{args.database}",
+        RATE_LIMIT_LOGIN="off",
+        RATE_LIMIT_MESSAGES="off",
+        RATE_LIMIT_WS_FRAMES="off",
+    )
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(args.port), "--log-level", "warning"],
+        env=env,
+    )
+
+
+async def wait_until_up(url: str, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=url) as client:
+        while True:
+            try:
+                if (await client.get("/")).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"Server at {url} did not start")
+            await asyncio.sleep(0.2)
+
+
+def rest_requests(manifest: dict, cookies: Dict[int, str], rng: random.Random):
+    """Yield (endpoint name, path, cookie) tuples forever, mixing the main read paths."""
+    owners = manifest["album_owners"]
+    albums = list(owners)
+    chats = manifest["chats"]
+    while True:
+        album_id = rng.choice(albums)
+        owner = cookies[owners[album_id]]
+        chat_id = rng.choice(chats)
+        member = cookies[rng.choice(manifest["chat_members"][chat_id])]
+        yield rng.choice([
+            ("GET /me/albums/", "/me/albums/", owner),
+            ("GET /me/albums/{album_id}", f"/me/albums/{album_id}", owner),
+            ("GET /me/albums/{album_id}/images/", f"/me/albums/{album_id}/images/", owner),
+            ("GET /me/albums/{album_id}/feed", f"/me/albums/{album_id}/feed", owner),
+            ("GET /chats/{chat_id}/messages", f"/chats/{chat_id}/messages", member),
+            ("GET /me/search/", "/me/search/?q=beach", owner),
+        ])
+
+
+async def run_rest(url: str, manifest: dict, cookies: Dict[int, str], concurrency: int, duration: float, seed: int) -> List[dict]:
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    errors: Dict[str, int] = defaultdict(int)
+    deadline = time.perf_counter() + duration
+
+    async def client_loop(worker: int) -> None:
+        requests = rest_requests(manifest, cookies, random.Random(seed + worker))
+        async with httpx.AsyncClient(base_url=url, timeout=30) as client:
+            while time.perf_counter() < deadline:
+                name, path, cookie = next(requests)
+                start = time.perf_counter()
+                try:
+                    response = await client.get(path, headers={"Cookie": cookie})
+                    ok = response.status_code == 200
+                except httpx.HTTPError:
+                    ok = False
+                latencies[name].append(time.perf_counter() - start)
+                if not ok:
+                    errors[name] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client_loop(worker) for worker in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    results = [summarize("rest[all]", [l for samples in latencies.values() for l in samples], elapsed,
+                         errors=sum(errors.values()))]
+    results += [summarize(f"rest[{name}]", samples, elapsed, errors=errors[name]) for name, samples in sorted(latencies.items())]
+    return results
+
+
+async def run_fanout(url: str, manifest: dict, cookies: Dict[int, str], chats: int, subscribers: int,
+                     messages: int, interval: float) -> List[dict]:
+    ws_url = url.replace("http", "ws", 1)
+    chosen = manifest["chats"][:chats]
+    sent_at: Dict[str, float] = {}
+    latencies: List[float] = []
+    expected = len(chosen) * subscribers * messages
+    received = 0
+    done = asyncio.Event()
+
+    async def listen(socket) -> None:
+        nonlocal received
+        async for frame in socket:
+            arrived = time.perf_counter()
+            key = json.loads(frame).get("content")
+            if key in sent_at:
+                latencies.append(arrived - sent_at[key])
+                received += 1
+                if received >= expected:
+                    done.set()
+
+    sockets, listeners = [], []
+    for chat_id in chosen:
+        members = manifest["chat_members"][chat_id]
+        for n in range(subscribers):
+            socket = await websockets.connect(
+                f"{ws_url}/chats/ws/{chat_id}",
+                additional_headers={"Cookie": cookies[members[n % len(members)]]},
+                max_queue=None,
+            )
+            sockets.append((chat_id, socket))
+            listeners.append(asyncio.create_task(listen(socket)))
+
+    senders = {chat_id: socket for chat_id, socket in reversed(sockets)}
+    start = time.perf_counter()
+    for n in range(messages):
+        for chat_id, socket in senders.items():
+            key = f"fanout {chat_id} {n}"
+            sent_at[key] = time.perf_counter()
+            await socket.send(json.dumps({"content": key}))
+        await asyncio.sleep(interval)
+    try:
+        await asyncio.wait_for(done.wait(), timeout=30)
+    except asyncio.TimeoutError:
+        pass
+    elapsed = time.perf_counter() - start
+
+    for task in listeners:
+        task.cancel()
+    await asyncio.gather(*(socket.close() for _, socket in sockets), return_exceptions=True)
+    return [summarize(
+        "ws[fanout]", latencies, elapsed,
+        chats=len(chosen), subscribers=subscribers, expected=expected, lost=expected - received,
+    )]
+
+
+async def main(args) -> List[dict]:
+    server: Optional[subprocess.Popen] = None
+    if args.url:
+        with open(args.manifest) as source:
+            manifest = json.load(source)
+        manifest["album_owners"] = {int(k): v for k, v in manifest["album_owners"].items()}
+        manifest["chat_members"] = {int(k): v for k, v in manifest["chat_members"].items()}
+        url = args.url
+    else:
+        manifest = prepare_database(args)
+        server = start_server(args)
+        url = f"http://127.0.0.1:{args.port}"
+    try:
+        await wait_until_up(url)
+        emails = dict(zip(manifest["users"], manifest["emails"]))
+        cookies = {user_id: auth_cookie(user_id, email) for user_id, email in emails.items()}
+        results = await run_rest(url, manifest, cookies, args.concurrency, args.duration, args.seed)
+        results += await run_fanout(url, manifest, cookies, args.chats, args.subscribers,
+                                    args.fanout_messages, args.interval)
+        return results
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=30)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="drive a running server instead of starting one")
+    parser.add_argument("--manifest", help="seed manifest describing the running server's data")
+    parser.add_argument("--database", default=os.path.join(tempfile.mkdtemp(), "load.db"))
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--albums-per-user", type=int, default=3)
+    parser.add_argument("--images-per-album", type=int, default=20)
+    parser.add_argument("--participants-per-album", type=int, default=3)
+    parser.add_argument("--messages", type=int, default=100_000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--chats", type=int, default=10)
+    parser.add_argument("--subscribers", type=int, default=20)
+    parser.add_argument("--fanout-messages", type=int, default=50)
+    parser.add_argument("--interval", type=float, default=0.02, help="pause between send rounds")
+    parser.add_argument("--output", help="write results to this JSON file")
+    args = parser.parse_args()
+    if args.url and not args.manifest:
+        parser.error("--url requires --manifest")
+    write_results(args.output, "load", vars(args), asyncio.run(main(args)))
@@ -0,0 +1,70 @@
+"""Micro-benchmarks for the per-request hot path.
+
+Covers token decoding, the album access check (cached and uncached),
+crud.create_message and message-list serialization, on a throwaway SQLite
+database unless ``SQLMODEL_DATABASE_URL`` is set.
+
+    python -m benchmarks.micro --repeat 2000 --output bench/micro.json
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+from datetime import timedelta
+from typing import List
+
+os.environ.setdefault("SQLMODEL_DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/bench.db")
+os.environ.setdefault("BCRYPT_ROUNDS", "4")
+
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app import crud
+from app.auth import create_access_token, decode_access_token
+from app.database import async_engine, engine, read_engine
+from app.schemas import MessageCreate, UserResponse
+from app.utils.concurrent import album_access_cache, participation_controller
+from benchmarks import serialization
+from benchmarks.common import time_async, time_sync, write_results
+from benchmarks.seed import seed
+
+
+async def main(repeat: int, rows: int) -> List[dict]:
+    serialization_results = await serialization.main(rows, repeat // 10 or 1)
+    manifest = seed(engine, users=10, albums_per_user=2, images_per_album=5,
+                    participants_per_album=2, chat_ratio=1.0, messages=0)
+    album_id = manifest["albums"][0]
+    chat_id = manifest["chats"][0]
+    user = UserResponse(id=manifest["album_owners"][album_id], email="bench@example.com", username="bench")
+    token = create_access_token({"sub": user.email, "uid": user.id}, expires_delta=timedelta(hours=1))
+
+    results = [time_sync("decode_access_token", repeat, lambda: decode_access_token(token))]
+
+    async with AsyncSession(read_engine, expire_on_commit=False) as db:
+        results.append(await time_async(
+            "participation_controller[hit]", repeat, lambda: participation_controller(album_id, db, user)
+        ))
+
+        async def uncached():
+            album_access_cache.clear()
+            await participation_controller(album_id, db, user)
+
+        results.append(await time_async("participation_controller[miss]", repeat, uncached))
+
+    async with AsyncSession(async_engine, expire_on_commit=False) as db:
+        message = MessageCreate(chat_id=chat_id, content="benchmark message")
+        results.append(await time_async(
+            "crud.create_message", repeat // 10 or 1, lambda: crud.create_message(db, message, user.id)
+        ))
+
+    for result in serialization_results:
+        results.append({**result, "name": f"serialize[{result['name']}]", "rows": rows})
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=2000)
+    parser.add_argument("--rows", type=int, default=200, help="messages per serialized page")
+    parser.add_argument("--output", help="write results to this JSON file")
+    args = parser.parse_args()
+    write_results(args.output, "micro", vars(args), asyncio.run(main(args.repeat, args.rows)))
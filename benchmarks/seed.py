@@ -0,0 +1,158 @@
+"""Fill a database with reproducible synthetic users, albums, images, chats and messages.
+
+The same ``--seed`` and sizes always produce the same rows. Point it at a
+fresh database; every user's password is ``--password``.
+
+    SQLMODEL_DATABASE_URL=sqlite:///./database/bench.db \\
+        python -m benchmarks.seed --users 1000 --messages 2000000 --manifest bench/seed.json
+"""
+import argparse
+import json
+import os
+import random
+import time
+from datetime import datetime, timedelta, timezone
+from typing import List
+
+from sqlalchemy import func, insert, select
+from sqlalchemy.engine import Engine
+
+import app.models as models
+from app.auth import hash_password
+
+BATCH = 10_000
+EMAIL = "user{}@example.com"
+
+
+def _next_id(connection, table) -> int:
+    return (connection.execute(select(func.max(table.c.id))).scalar() or 0) + 1
+
+
+def _insert(connection, table, rows: List[dict]) -> None:
+    for start in range(0, len(rows), BATCH):
+        connection.execute(insert(table), rows[start:start + BATCH])
+
+
+def seed(
+    engine: Engine,
+    users: int,
+    albums_per_user: int,
+    images_per_album: int,
+    participants_per_album: int,
+    chat_ratio: float,
+    messages: int,
+    password: str = "bench",
+    seed: int = 42,
+) -> dict:
+    """Insert the data set and return a manifest describing it."""
+    rng = random.Random(seed)
+    base = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    hashed = hash_password(password)
+    started = time.perf_counter()
+
+    with engine.begin() as connection:
+        user_id = _next_id(connection, models.User.__table__)
+        album_id = _next_id(connection, models.Album.__table__)
+        image_id = _next_id(connection, models.Image.__table__)
+        chat_id = _next_id(connection, models.Chat.__table__)
+
+        user_ids = list(range(user_id, user_id + users))
+        _insert(connection, models.User.__table__, [
+            {"id": uid, "email": EMAIL.format(n), "username": f"user{n}", "password": hashed}
+            for n, uid in enumerate(user_ids)
+        ])
+
+        albums, participants = [], []
+        for owner in user_ids:
+            for _ in range(albums_per_user):
+                albums.append({"id": album_id, "title": f"Album {album_id}", "owner_id": owner,
+                               "created_at": base + timedelta(minutes=album_id), "version": 0})
+                others = rng.sample(user_ids, min(participants_per_album + 1, len(user_ids)))
+                participants += [{"album_id": album_id, "user_id": uid} for uid in others if uid != owner][:participants_per_album]
+                album_id += 1
+        _insert(connection, models.Album.__table__, albums)
+        _insert(connection, models.AlbumParticipant.__table__, participants)
+
+        images, chats = [], []
+        members = {album["id"]: [album["owner_id"]] for album in albums}
+        for row in participants:
+            members[row["album_id"]].append(row["user_id"])
+        for album in albums:
+            for _ in range(images_per_album):
+                images.append({"id": image_id, "title": f"Image {image_id}", "description": f"Photo {image_id} of album {album['id']}",
+                               "path": f"bench/{image_id}.jpg", "album_id": album["id"]})
+                if rng.random() < chat_ratio:
+                    chats.append({"id": chat_id, "image_id": image_id, "created_at": base, "version": 0})
+                    chat_id += 1
+                image_id += 1
+        if messages and not chats:
+            # Raised inside the transaction, so nothing is left half seeded.
+            raise ValueError("messages need at least one chat: raise the chat ratio or the number of images")
+        _insert(connection, models.Image.__table__, images)
+        _insert(connection, models.Chat.__table__, chats)
+
+        # Skewed towards the first chats, so a few are hot and most are quiet.
+        album_of_image = {image["id"]: image["album_id"] for image in images}
+        words = ["photo", "album", "trip", "beach", "dinner", "party", "sunset", "family", "city", "mountain"]
+        batch = []
+        for n in range(messages):
+            chat = chats[int(len(chats) * rng.random() ** 3)]
+            batch.append({
+                "content": " ".join(rng.choices(words, k=rng.randint(3, 12))),
+                "sent_at": base + timedelta(seconds=n),
+                "sender_id": rng.choice(members[album_of_image[chat["image_id"]]]),
+                "chat_id": chat["id"],
+            })
+            if len(batch) == BATCH:
+                _insert(connection, models.Message.__table__, batch)
+                batch = []
+        _insert(connection, models.Message.__table__, batch)
+
+    return {
+        "seed": seed,
+        "password": password,
+        "emails": [EMAIL.format(n) for n in range(users)],
+        "users": user_ids,
+        "albums": [album["id"] for album in albums],
+        "album_owners": {album["id"]: album["owner_id"] for album in albums},
+        "images": len(images),
+        "chats": [chat["id"] for chat in chats],
+        "chat_members": {chat["id"]: members[album_of_image[chat["image_id"]]] for chat in chats},
+        "messages": messages,
+        "seconds": round(time.perf_counter() - started, 1),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--albums-per-user", type=int, default=3)
+    parser.add_argument("--images-per-album", type=int, default=20)
+    parser.add_argument("--participants-per-album", type=int, default=3)
+    parser.add_argument("--chat-ratio", type=float, default=0.5, help="share of images that get a chat")
+    parser.add_argument("--messages", type=int, default=100_000)
+    parser.add_argument("--password", default="bench")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--manifest", help="write the manifest (ids, emails) to this JSON file")
+    args = parser.parse_args()
+
+    from app.database import engine, init_db
+
+    init_db()
+    try:
+        manifest = seed(
+            engine, args.users, args.albums_per_user, args.images_per_album,
+            args.participants_per_album, args.chat_ratio, args.messages, args.password, args.seed,
+        )
+    except ValueError as exc:
+        parser.error(str(exc))
+    print(f"Seeded {len(manifest['users'])} users, {len(manifest['albums'])} albums, {manifest['images']} images, "
+          f"{len(manifest['chats'])} chats and {manifest['messages']} messages in {manifest['seconds']}s")
+    if args.manifest:
+        os.makedirs(os.path.dirname(os.path.abspath(args.manifest)), exist_ok=True)
+        with open(args.manifest, "w") as out:
+            json.dump(manifest, out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""Compare the response_model path with the row/orjson fast path for message lists.
+
+Run from the repository root:
+
+    python -m benchmarks.serialization --rows 200 --repeat 200 --output bench/serialization.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from typing import List
+
+os.environ.setdefault("SQLMODEL_DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/bench.db")
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.routing import serialize_response
+from fastapi.utils import create_model_field
+from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app import crud
+from app.database import engine, init_db, read_engine
+import app.models as models
+from app.routes.messages import message_columns
+from app.schemas import MessageResponse
+from app.utils.serialization import dump_rows
+from benchmarks.common import write_results
+
+
+def seed(rows: int) -> int:
+    init_db()
+    start = datetime.now(timezone.utc)
+    with Session(engine) as db:
+        user = models.User(email="bench@example.com", username="bench", password="x")
+        album = models.Album(title="Bench", owner=user)
+        chat = models.Chat(image=models.Image(title="Bench", path="bench", album=album))
+        db.add(chat)
+        db.flush()
+        db.add_all(
+            models.Message(content=f"message {n} " * 4, sender_id=user.id, chat_id=chat.id, sent_at=start + timedelta(seconds=n))
+            for n in range(rows)
+        )
+        db.commit()
+        return chat.id
+
+
+async def measure(name: str, repeat: int, run) -> dict:
+    await run()  # warm up
+    start = time.perf_counter()
+    for _ in range(repeat):
+        body = await run()
+    elapsed = (time.perf_counter() - start) / repeat
+    return {"name": name, "ms_per_page": round(elapsed * 1000, 3), "bytes": len(body)}
+
+
+async def main(rows: int, repeat: int) -> List[dict]:
+    chat_id = seed(rows)
+    field = create_model_field(name="Response", type_=List[MessageResponse], mode="serialization")
+
+    async with AsyncSession(read_engine) as db:
+        async def response_model_path():
+            messages = await crud.get_messages(db, chat_id, rows)
+            content = await serialize_response(field=field, response_content=messages, is_coroutine=True)
+            db.expunge_all()
+            return json.dumps(jsonable_encoder(content), separators=(",", ":")).encode()
+
+        async def fast_path():
+            return dump_rows(await crud.get_messages(db, chat_id, rows, columns=message_columns), MessageResponse)
+
+        assert json.loads(await response_model_path()) == json.loads(await fast_path())
+        return [
+            await measure("response_model", repeat, response_model_path),
+            await measure("rows+orjson", repeat, fast_path),
+        ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--output", help="write results to this JSON file")
+    args = parser.parse_args()
+    write_results(args.output, "serialization", vars(args), asyncio.run(main(args.rows, args.repeat)))
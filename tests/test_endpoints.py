@@ -1,24 +1,52 @@
+import asyncio
+import io
 import os
 import tempfile
+import time
+
+import pytest
 
 # Use a temporary SQLite database for the tests
 fd, db_path = tempfile.mkstemp(prefix="test_", suffix=".db")
 os.close(fd)
 os.environ["SQLMODEL_DATABASE_URL"] = f"sqlite:///{db_path}"
 os.environ["SECRET_KEY"] = "test_secret"
+os.environ["BCRYPT_ROUNDS"] = "4"
+os.environ["MEDIA_ROOT"] = tempfile.mkdtemp(prefix="media_")
+os.environ["THUMB_SYNC_TIMEOUT"] = "30"
+os.environ["RATE_LIMIT_LOGIN"] = "1000/minute"
+os.environ["OPS_TOKEN"] = "test_ops_token"
+OPS_HEADERS = {"Authorization": "Bearer test_ops_token"}
 
 from fastapi.testclient import TestClient
 from app.database import init_db
 from app.main import app
+from app.utils.hashing import password_hasher
 
 # Initialize tables
 init_db()
 
 client = TestClient(app)
 
+
+@pytest.fixture(scope="module", autouse=True)
+def app_lifespan():
+    # Run every request on one event loop so background writers persist.
+    with client:
+        yield
+
 USER_DATA = {"email": "user@example.com", "username": "user", "password": "pass"}
 
 
+def wait_for_job(status_url, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        job = client.get(status_url).json()
+        if job["status"] in ("done", "failed") or time.monotonic() > deadline:
+            return job
+        time.sleep(0.05)
+
+
 def register_and_login():
     client.post("/auth/register", json=USER_DATA)
     response = client.post("/auth/login", json=USER_DATA)
@@ -60,3 +88,964 @@ def test_album_and_image_flow():
     resp = client.get(f"/chats/{chat_id}/messages")
     assert resp.status_code == 200
     assert len(resp.json()) >= 1
+
+
+def test_message_pagination_and_export():
+    register_and_login()
+    album_id = client.post("/me/albums/new_album", json={"title": "Paged"}).json()["id"]
+    image_id = client.post(
+        f"/me/albums/{album_id}/images/create",
+        json={"title": "Img", "description": "desc", "image_path": "path"},
+    ).json()["id"]
+    chat_id = client.get(f"/chats/{image_id}").json()["id"]
+    for content in ("one", "two", "three"):
+        client.post(f"/chats/{chat_id}/messages", json={"chat_id": chat_id, "content": content})
+
+    resp = client.get(f"/chats/{chat_id}/messages", params={"limit": 2})
+    assert [m["content"] for m in resp.json()] == ["two", "three"]
+    cursor = resp.headers["X-Next-Cursor"]
+
+    resp = client.get(f"/chats/{chat_id}/messages", params={"limit": 2, "before": cursor})
+    assert [m["content"] for m in resp.json()] == ["one"]
+    assert "X-Next-Cursor" not in resp.headers
+
+    resp = client.get(f"/chats/{chat_id}/messages", params={"export": True})
+    assert resp.headers["content-type"].startswith("application/x-ndjson")
+    assert len(resp.text.splitlines()) == 3
+
+    for chat in (client.get(f"/chats/{image_id}").json(), client.post(f"/chats/{image_id}").json()):
+        assert chat["id"] == chat_id and "messages" not in chat
+
+
+def test_websocket_messages_are_persisted_and_broadcast():
+    register_and_login()
+    album_id = client.post("/me/albums/new_album", json={"title": "Live"}).json()["id"]
+    image_id = client.post(
+        f"/me/albums/{album_id}/images/create",
+        json={"title": "Img", "description": "desc", "image_path": "path"},
+    ).json()["id"]
+    chat_id = client.get(f"/chats/{image_id}").json()["id"]
+
+    with client.websocket_connect(f"/chats/ws/{chat_id}") as sender, \
+            client.websocket_connect(f"/chats/ws/{chat_id}") as viewer:
+        sender.send_json({"content": "hello"})
+        sent = sender.receive_json()
+        assert viewer.receive_json() == sent
+
+    resp = client.get(f"/chats/{chat_id}/messages")
+    assert [m["id"] for m in resp.json()] == [sent["id"]]
+
+
+def test_album_access_cache_is_invalidated_on_delete():
+    register_and_login()
+    album_id = client.post("/me/albums/new_album", json={"title": "Gone"}).json()["id"]
+    assert client.get(f"/me/albums/{album_id}").status_code == 200
+
+    resp = client.delete(f"/me/albums/delete/{album_id}")
+    assert resp.status_code == 202
+    assert wait_for_job(resp.json()["status_url"])["status"] == "done"
+    assert client.get(f"/me/albums/{album_id}").status_code == 404
+    assert client.get(f"/me/albums/{album_id}/images/").status_code == 404
+
+
+def test_album_access_decisions_skip_the_database_until_participants_change():
+    from sqlmodel import Session
+    from app.database import engine
+    from app.utils.concurrent import album_access_cache
+    from app.utils.profiling import query_budget
+    import app.models as models
+
+    def access_queries(url, status):
+        with query_budget(10) as profiles:
+            assert client.get(url).status_code == status
+        return sum(count for shape, count in profiles[0].shapes.items() if "LEFT OUTER JOIN album_participants" in shape)
+
+    register_and_login()
+    album_id = client.post("/me/albums/new_album", json={"title": "Acl"}).json()["id"]
+    url = f"/me/albums/{album_id}/images/"
+    album_access_cache.clear()
+    assert [access_queries(url, 200) for _ in range(2)] == [1, 0]
+
+    client.get("/auth/logout")
+    guest = {"email": "acl-guest@example.com", "username": "acl-guest", "password": "pass"}
+    guest_id = client.post("/auth/register", json=guest).json()["id"]
+    client.post("/auth/login", json=guest)
+    assert [access_queries(url, 403) for _ in range(2)] == [1, 0]
+
+    with Session(engine) as db:
+        db.add(models.AlbumParticipant(user_id=guest_id, album_id=album_id))
+        db.commit()
+    assert [access_queries(url, 200) for _ in range(2)] == [1, 0]
+
+    with Session(engine) as db:
+        db.delete(db.get(models.AlbumParticipant, (guest_id, album_id)))
+        db.commit()
+    assert [access_queries(url, 403) for _ in range(2)] == [1, 0]
+    client.get("/auth/logout")
+
+
+def test_profile_update_is_visible_immediately():
+    register_and_login()
+    assert client.get("/me/").json()["username"] == USER_DATA["username"]
+
+    resp = client.put("/me/update", json={**USER_DATA, "username": "renamed"})
+    assert resp.status_code == 200
+    assert "password" not in resp.json()
+    assert client.get("/me/").json()["username"] == "renamed"
+
+
+def test_login_is_shed_when_hash_pool_is_saturated():
+    register_and_login()
+    max_pending = password_hasher.max_pending
+    password_hasher.max_pending = 0
+    try:
+        resp = client.post("/auth/login", json=USER_DATA)
+    finally:
+        password_hasher.max_pending = max_pending
+    assert resp.status_code == 503
+    assert client.get("/stats/hashing", headers=OPS_HEADERS).json()["rejected"] >= 1
+
+
+def test_login_survives_a_killed_hash_worker():
+    import signal
+
+    register_and_login()
+    stats = client.get("/stats/hashing", headers=OPS_HEADERS).json()
+    for pid in list(password_hasher._executor._processes):
+        os.kill(pid, signal.SIGKILL)
+
+    assert client.post("/auth/login", json=USER_DATA).status_code == 200
+    after = client.get("/stats/hashing", headers=OPS_HEADERS).json()
+    assert after["restarts"] == stats["restarts"] + 1
+    assert after["completed"] == stats["completed"] + 1
+
+
+def test_image_upload_download_and_dedup():
+    from sqlmodel import Session
+    from app.database import engine
+    import app.models as models
+
+    register_and_login()
+    album_id = client.post("/me/albums/new_album", json={"title": "Photos"}).json()["id"]
+    payload = bytes(range(256)) * 64
+
+    uploads = [
+        client.post(
+            f"/me/albums/{album_id}/images/upload",
+            files={"file": ("photo.jpg", payload, "image/jpeg")},
+            data={"title": title},
+        ).json()
+        for title in ("first", "copy")
+    ]
+    assert uploads[0]["sha256"] == uploads[1]["sha256"]
+    assert uploads[0]["size"] == len(payload)
+
+    url = f"/me/albums/{album_id}/images/{uploads[0]['id']}/file"
+    resp = client.get(url)
+    assert resp.status_code == 200
+    assert resp.content == payload
+    assert resp.headers["content-type"] == "image/jpeg"
+    etag = resp.headers["etag"]
+
+    for header, status in ((etag, 304), (f'"other", W/{etag}', 304), ("*", 304), (etag[:-2] + '"', 200)):
+        assert client.get(url, headers={"If-None-Match": header}).status_code == status
+
+    resp = client.get(url, headers={"Range": "bytes=10-19"})
+    assert resp.status_code == 206
+    assert resp.content == payload[10:20]
+
+    page = client.post(
+        f"/me/albums/{album_id}/images/upload",
+        files={"file": ("page.html", b"<script>alert(1)</script>", "text/html")},
+        data={"title": "page"},
+    ).json()
+    assert page["content_type"] == "application/octet-stream"
+    with Session(engine) as db:
+        db.get(models.Image, uploads[1]["id"]).content_type = "text/html"  # stored before uploads were checked
+        db.commit()
+    for image_id in (page["id"], uploads[1]["id"]):
+        resp = client.get(f"/me/albums/{album_id}/images/{image_id}/file")
+        assert resp.headers["content-type"] == "application/octet-stream"
+        assert resp.headers["content-disposition"] == "attachment"
+        assert resp.headers["x-content-type-options"] == "nosniff"
+
+
+def test_uploads_are_streamed_into_the_store(monkeypatch):
+    from app.utils import storage
+
+    monkeypatch.setattr(storage, "MAX_UPLOAD_BYTES", 1000)
+    register_and_login()
+    album_id = client.post("/me/albums/new_album", json={"title": "Large"}).json()["id"]
+
+    # Over the limit by Content-Length, then only once the parser has streamed it.
+    for size in (storage.FORM_OVERHEAD * 2, 5000):
+        resp = client.post(
+            f"/me/albums/{album_id}/images/upload",
+            files={"file": ("big.png", b"x" * size, "image/png")},
+            data={"title": "big"},
+        )
+        assert resp.status_code == 413
+    assert client.get(f"/me/albums/{album_id}/images/").json() == []
+
+    for title in ("small", "duplicate"):
+        resp = client.post(
+            f"/me/albums/{album_id}/images/upload",
+            files={"file": ("small.png", b"x" * 500, "image/png")},
+            data={"title": title},
+        )
+        assert resp.status_code == 200
+    assert not os.listdir(os.path.join(storage.MEDIA_ROOT, "tmp"))
+
+
+def test_blob_response_sends_stat_headers_with_pathsend(tmp_path):
+    from app.utils.storage import BlobResponse
+
+    path = tmp_path / "blob"
+    path.write_bytes(b"x" * 1234)
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": "GET", "headers": [], "extensions": {"http.response.pathsend": {}}}
+    asyncio.run(BlobResponse(str(path), media_type="image/png", headers={"ETag": '"given"'})(scope, None, send))
+    headers = dict((key.decode(), value.decode()) for key, value in sent[0]["headers"])
+    assert headers["content-length"] == "1234" and headers["etag"] == '"given"' and "last-modified" in headers
+    assert sent[1] == {"type": "http.response.pathsend", "path": str(path)}
+
+
+def test_thumbnails_are_generated_or_replaced_by_placeholder():
+    import signal
+    from PIL import Image
+    from app.utils.storage import blob_path
+    from app.utils.thumbnails import SIZES, derivative_path, thumbnails
+
+    register_and_login()
+    album_id = client.post("/me/albums/new_album", json={"title": "Thumbs"}).json()["id"]
+    buffer = io.BytesIO()
+    Image.new("RGB", (800, 400), "red").save(buffer, "PNG")
+
+    image_id = client.post(
+        f"/me/albums/{album_id}/images/upload",
+        files={"file": ("photo.png", buffer.getvalue(), "image/png")},
+        data={"title": "red"},
+    ).json()["id"]
+    resp = client.get(f"/me/albums/{album_id}/images/{image_id}/thumb/thumb")
+    assert resp.status_code == 200
+    assert resp.headers["content-type"] == "image/jpeg"
+    assert Image.open(io.BytesIO(resp.content)).size == (256, 128)
+    assert resp.headers["content-length"] == str(len(resp.content)) and "last-modified" in resp.headers
+
+    broken_id = client.post(
+        f"/me/albums/{album_id}/images/upload",
+        files={"file": ("broken.png", b"not an image", "image/png")},
+        data={"title": "broken"},
+    ).json()["id"]
+    resp = client.get(f"/me/albums/{album_id}/images/{broken_id}/thumb/thumb")
+    assert resp.headers["content-type"] == "image/svg+xml"
+
+    restarts = thumbnails.restarts
+    for pid in list(thumbnails._executor._processes):
+        os.kill(pid, signal.SIGKILL)
+    buffer = io.BytesIO()
+    Image.new("RGB", (300, 300), "blue").save(buffer, "PNG")
+    blue_id = client.post(
+        f"/me/albums/{album_id}/images/upload",
+        files={"file": ("blue.png", buffer.getvalue(), "image/png")},
+        data={"title": "blue"},
+    ).json()["id"]
+    resp = client.get(f"/me/albums/{album_id}/images/{blue_id}/thumb/thumb")
+    assert resp.headers["content-type"] == "image/jpeg"
+    assert thumbnails.restarts == restarts + 1
+
+    sha256 = client.get(f"/me/albums/{album_id}/images/{image_id}").json()["sha256"]
+    for size in SIZES:
+        client.get(f"/me/albums/{album_id}/images/{image_id}/thumb/{size}")
+    thumb = derivative_path(sha256, "thumb")
+    assert os.path.exists(thumb) and thumb in thumbnails._index
+    client.delete(f"/me/albums/{album_id}/images/{image_id}/delete")
+    assert not any(os.path.exists(derivative_path(sha256, size)) for size in SIZES)
+    assert not os.path.exists(blob_path(sha256)) and thumb not in thumbnails._index
+
+
+def test_album_listing_is_paginated_and_summarized():
+    from datetime import datetime
+    from sqlmodel import Session
+    from app.database import engine
+    import app.models as models
+
+    register_and_login()
+    me = client.get("/me/").json()
+    other = {"email": "other@example.com", "username": "other", "password": "pass"}
+    other_id = client.post("/auth/register", json=other).json()["id"]
+
+    shared_id = client.post("/me/albums/new_album", json={"title": "Shared"}).json()["id"]
+    with Session(engine) as db:
+        db.add(models.AlbumParticipant(user_id=other_id, album_id=shared_id))
+        db.commit()
+    client.post(
+        f"/me/albums/{shared_id}/images/create",
+        json={"title": "Img", "description": "desc", "image_path": "path"},
+    )
+
+    albums = client.get("/me/albums/", params={"limit": 200}).json()
+    assert len({album["id"] for album in albums}) == len(albums)
+    shared = next(album for album in albums if album["id"] == shared_id)
+    assert shared["image_count"] == 1
+    assert shared["owner_id"] == me["id"]
+    assert shared["last_activity_at"] == shared["created_at"]
+
+    sent = []
+    for title in ("Second", "Third"):
+        image_id = client.post(
+            f"/me/albums/{shared_id}/images/create", json={"title": title, "image_path": "path"}
+        ).json()["id"]
+        chat_id = client.get(f"/chats/{image_id}").json()["id"]
+        for content in ("one", "two"):
+            client.post(f"/chats/{chat_id}/messages", json={"chat_id": chat_id, "content": content})
+        sent += [message["sent_at"] for message in client.get(f"/chats/{chat_id}/messages").json()]
+    albums = client.get("/me/albums/", params={"limit": 200}).json()
+    shared = next(album for album in albums if album["id"] == shared_id)
+
+    def parse(value):
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).replace(tzinfo=None)
+
+    assert parse(shared["last_activity_at"]) == max(map(parse, sent))
+
+    first = client.get("/me/albums/", params={"limit": 1})
+    assert first.json()[0]["id"] == albums[0]["id"]
+    second = client.get("/me/albums/", params={"limit": 1, "before": first.headers["X-Next-Cursor"]})
+    assert second.json()[0]["id"] == albums[1]["id"]
+
+
+def test_album_feed_uses_a_fixed_number_of_queries():
+    from sqlalchemy import event
+    from app.database import read_engine
+
+    register_and_login()
+    album_id = client.post("/me/albums/new_album", json={"title": "Feed"}).json()["id"]
+    image_ids = [
+        client.post(
+            f"/me/albums/{album_id}/images/create",
+            json={"title": f"Img {n}", "description": "desc", "image_path": "path"},
+        ).json()["id"]
+        for n in range(3)
+    ]
+    chat_id = client.get(f"/chats/{image_ids[0]}").json()["id"]
+    for content in ("first", "second"):
+        client.post(f"/chats/{chat_id}/messages", json={"chat_id": chat_id, "content": content})
+
+    statements = []
+    record = lambda *args: statements.append(args[2])
+    event.listen(read_engine.sync_engine, "before_cursor_execute", record)
+    try:
+        resp = client.get(f"/me/albums/{album_id}/feed")
+    finally:
+        event.remove(read_engine.sync_engine, "before_cursor_execute", record)
+    assert resp.status_code == 200
+    assert len(statements) <= 5
+
+    feed = resp.json()
+    assert feed["album"]["id"] == album_id
+    assert [image["id"] for image in feed["images"]] == image_ids[::-1]
+    first = feed["images"][-1]
+    assert first["chat_id"] == chat_id
+    assert first["message_count"] == 2
+    assert first["latest_message"]["content"] == "second"
+    assert feed["images"][0]["message_count"] == 0
+
+    page = client.get(f"/me/albums/{album_id}/feed", params={"limit": 2})
+    rest = client.get(f"/me/albums/{album_id}/feed", params={"before": page.headers["X-Next-Cursor"]})
+    assert [image["id"] for image in rest.json()["images"]] == image_ids[:1]
+
+
+def test_reads_are_conditional_on_album_and_chat_versions():
+    register_and_login()
+    album_id = client.post("/me/albums/new_album", json={"title": "Etag"}).json()["id"]
+    image_id = client.post(
+        f"/me/albums/{album_id}/images/create",
+        json={"title": "Img", "description": "desc", "image_path": "path"},
+    ).json()["id"]
+
+    resp = client.get(f"/me/albums/{album_id}/images/")
+    etag = resp.headers["ETag"]
+    assert client.get(f"/me/albums/{album_id}/images/", headers={"If-None-Match": etag}).status_code == 304
+
+    client.put(
+        f"/me/albums/{album_id}/images/{image_id}/update",
+        json={"title": "Renamed", "description": "desc", "image_path": "path"},
+    )
+    resp = client.get(f"/me/albums/{album_id}/images/", headers={"If-None-Match": etag})
+    assert resp.status_code == 200
+    assert resp.json()[0]["title"] == "Renamed"
+    assert client.get(f"/me/albums/{album_id}", headers={"If-None-Match": resp.headers["ETag"]}).status_code == 304
+
+    chat_id = client.get(f"/chats/{image_id}").json()["id"]
+    etag = client.get(f"/chats/{chat_id}/messages").headers["ETag"]
+    client.post(f"/chats/{chat_id}/messages", json={"chat_id": chat_id, "content": "new"})
+    resp = client.get(f"/chats/{chat_id}/messages", headers={"If-None-Match": etag})
+    assert resp.status_code == 200
+    assert [m["content"] for m in resp.json()] == ["new"]
+
+
+def test_fast_list_serialization_matches_response_models():
+    from sqlmodel import Session, select
+    from app.database import engine
+    from app.schemas import ImageResponse, MessageResponse
+    import app.models as models
+
+    register_and_login()
+    album_id = client.post("/me/albums/new_album", json={"title": "Fast"}).json()["id"]
+    image_id = client.post(
+        f"/me/albums/{album_id}/images/create",
+        json={"title": "Img", "image_path": "path"},
+    ).json()["id"]
+    chat_id = client.get(f"/chats/{image_id}").json()["id"]
+    client.post(f"/chats/{chat_id}/messages", json={"chat_id": chat_id, "content": "héllo"})
+
+    with Session(engine) as db:
+        images = db.exec(select(models.Image).where(models.Image.album_id == album_id)).all()
+        messages = db.exec(select(models.Message).where(models.Message.chat_id == chat_id)).all()
+        expected_images = [ImageResponse.model_validate(i).model_dump(mode="json") for i in images]
+        expected_messages = [MessageResponse.model_validate(m).model_dump(mode="json") for m in messages]
+
+    assert client.get(f"/me/albums/{album_id}/images/").json() == expected_images
+    assert client.get(f"/chats/{chat_id}/messages").json() == expected_messages
+
+
+def test_websocket_reconnect_replays_missed_messages():
+    from app.routes.messages import manager
+
+    register_and_login()
+    album_id = client.post("/me/albums/new_album", json={"title": "Replay"}).json()["id"]
+    image_id = client.post(
+        f"/me/albums/{album_id}/images/create",
+        json={"title": "Img", "description": "desc", "image_path": "path"},
+    ).json()["id"]
+    chat_id = client.get(f"/chats/{image_id}").json()["id"]
+
+    with client.websocket_connect(f"/chats/ws/{chat_id}") as sender:
+        sender.send_json({"content": "seen"})
+        seen = sender.receive_json()
+        sender.send_json({"content": "missed"})
+        missed = sender.receive_json()
+
+    hits = manager.recent.hits
+    with client.websocket_connect(f"/chats/ws/{chat_id}?last_seen_id={seen['id']}") as ws:
+        assert ws.receive_json() == missed
+    assert manager.recent.hits == hits + 1
+
+    manager.recent.clear()
+    with client.websocket_connect(f"/chats/ws/{chat_id}?last_seen_id={seen['id']}") as ws:
+        assert ws.receive_json() == missed
+
+
+def test_websocket_reconnect_replays_messages_posted_over_rest():
+    register_and_login()
+    album_id = client.post("/me/albums/new_album", json={"title": "Mixed"}).json()["id"]
+    image_id = client.post(
+        f"/me/albums/{album_id}/images/create",
+        json={"title": "Img", "image_path": "path"},
+    ).json()["id"]
+    chat_id = client.get(f"/chats/{image_id}").json()["id"]
+
+    from app.routes.messages import manager
+
+    with client.websocket_connect(f"/chats/ws/{chat_id}") as sender:
+        sender.send_json({"content": "A"})
+        seen = sender.receive_json()
+        posted = client.post(f"/chats/{chat_id}/messages", json={"chat_id": chat_id, "content": "B"})
+        assert posted.status_code == 200
+        live = [sender.receive_json()]
+        assert live[0] == posted.json()
+        sender.send_json({"content": "C"})
+        live.append(sender.receive_json())
+
+    # The same payloads, byte for byte once decoded, from the buffer, the
+    # database replay and the message list.
+    with client.websocket_connect(f"/chats/ws/{chat_id}?last_seen_id={seen['id']}") as ws:
+        assert [ws.receive_json() for _ in range(2)] == live
+    manager.recent.discard(chat_id)
+    with client.websocket_connect(f"/chats/ws/{chat_id}?last_seen_id={seen['id']}") as ws:
+        assert [ws.receive_json() for _ in range(2)] == live
+    assert client.get(f"/chats/{chat_id}/messages").json() == [seen, *live]
+    assert live[0]["sent_at"].endswith("Z")
+
+
+class StalledWebSocket:
+    """A client that never reads: every send blocks until the test ends."""
+
+    def __init__(self):
+        self.close_code = None
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, payload):
+        await asyncio.Event().wait()
+
+    async def close(self, code):
+        self.close_code = code
+
+
+def test_slow_websocket_queue_drops_oldest_events(monkeypatch):
+    from app.routes import messages
+
+    monkeypatch.setattr(messages, "SEND_QUEUE_SIZE", 2)
+    monkeypatch.setattr(messages, "OVERFLOW_POLICY", "drop_oldest")
+
+    async def fill():
+        subscriber = messages.Subscriber(StalledWebSocket(), on_error=lambda: None)
+        accepted = [subscriber.push(payload) for payload in ("1", "2", "3", "4")]
+        queued = [subscriber.queue.get_nowait() for _ in range(subscriber.queue.qsize())]
+        subscriber.close()
+        return accepted, queued
+
+    assert asyncio.run(fill()) == ([True] * 4, ["3", "4"])
+
+
+def test_slow_websocket_is_closed_under_disconnect_policy(monkeypatch):
+    from app.routes import messages
+    from app.utils.broadcast import InProcessBackend
+    from app.utils.recent import RecentMessages
+
+    monkeypatch.setattr(messages, "SEND_QUEUE_SIZE", 1)
+    monkeypatch.setattr(messages, "OVERFLOW_POLICY", "disconnect")
+
+    async def overflow():
+        manager = messages.ConnectionManager(InProcessBackend(), RecentMessages(per_chat=10, max_bytes=10000))
+        websocket = StalledWebSocket()
+        await manager.connect(7, websocket)
+        await asyncio.sleep(0)  # the send task takes the first event and stalls
+        for message_id in range(1, 4):
+            await manager.broadcast(7, {"id": message_id, "chat_id": 7})
+        await asyncio.sleep(0)
+        await manager.backend.stop()
+        return manager.connections, websocket.close_code
+
+    assert asyncio.run(overflow()) == ({}, 1013)
+
+
+def test_unix_broadcast_backends_deliver_to_each_other(tmp_path):
+    import socket
+    from app.utils.broadcast import BroadcastBackend, UnixSocketBackend, default_socket_dir
+
+    with pytest.raises(TypeError):
+        BroadcastBackend()
+    assert default_socket_dir("sqlite:///a.db") == default_socket_dir("sqlite:///a.db")
+    assert default_socket_dir("sqlite:///a.db") != default_socket_dir("sqlite:///b.db")
+
+    async def exchange():
+        received = {"a": set(), "b": set()}
+
+        def recorder(name):
+            async def deliver(chat_id, payload):
+                received[name].add((chat_id, payload))
+            return deliver
+
+        a, b = UnixSocketBackend(str(tmp_path)), UnixSocketBackend(str(tmp_path))
+        await a.start(recorder("a"))
+        await a.publish(3, "before b")
+        await b.start(recorder("b"))  # seen by a's next publish, not a second later
+        await a.publish(1, "from a")
+        await b.publish(2, "from b")
+        with pytest.raises(ValueError):
+            await a.publish(4, "x" * UnixSocketBackend.MAX_FRAME_BYTES)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as raw:
+            for frame in (b"not a chat id\n{}", b"\xff\n{}", b"1\n" + b"x" * UnixSocketBackend.MAX_FRAME_BYTES):
+                raw.sendto(frame, b.path)
+        await a.publish(5, "after junk")
+        for _ in range(100):
+            if len(received["a"]) == 4 and len(received["b"]) == 3:
+                break
+            await asyncio.sleep(0.01)
+        await a.stop()
+        await b.stop()
+        return received
+
+    expected = {(1, "from a"), (2, "from b"), (5, "after junk")}
+    assert asyncio.run(exchange()) == {"a": expected | {(3, "before b")}, "b": expected}
+    assert not os.listdir(tmp_path)
+
+
+def test_recent_messages_only_cover_what_they_hold(tmp_path):
+    from app.utils.broadcast import UnixSocketBackend
+    from app.utils.recent import RecentMessages
+
+    recent = RecentMessages(per_chat=2, max_bytes=10000)
+    for message_id in (10, 20, 30):
+        recent.add(1, message_id, str(message_id))
+    recent.add(1, 5, "5")  # arrived late, below what the buffer is complete from
+    assert [recent.covers(1, last_seen) for last_seen in (5, 9, 10, 25)] == [False, False, True, True]
+    assert recent.since(1, 10) == ["20", "30"]
+
+    async def drop_a_frame():
+        lost = []
+        a, b = UnixSocketBackend(str(tmp_path)), UnixSocketBackend(str(tmp_path))
+        await b.start(recorder(set()), lambda: lost.append(len(lost)))
+        await a.start(recorder(set()))
+        await a.publish(1, "delivered")
+        with pytest.raises(ValueError):
+            await a.publish(1, "x" * UnixSocketBackend.MAX_FRAME_BYTES)
+        await asyncio.sleep(0.05)
+        before = len(lost)
+        await a.publish(1, "after the gap")
+        await asyncio.sleep(0.05)
+        await a.stop()
+        await b.stop()
+        return before, len(lost)
+
+    def recorder(received):
+        async def deliver(chat_id, payload):
+            received.add(payload)
+        return deliver
+
+    assert asyncio.run(drop_a_frame()) == (0, 1)
+
+
+def test_search_is_ranked_and_scoped_to_accessible_albums():
+    register_and_login()
+    album_id = client.post("/me/albums/new_album", json={"title": "Trip"}).json()["id"]
+    image_id = client.post(
+        f"/me/albums/{album_id}/images/create",
+        json={"title": "Zanzibar beach", "description": "sunset over the ocean", "image_path": "path"},
+    ).json()["id"]
+    chat_id = client.get(f"/chats/{image_id}").json()["id"]
+    for content in ("what a zanzibar sunset", "lunch"):
+        client.post(f"/chats/{chat_id}/messages", json={"chat_id": chat_id, "content": content})
+
+    results = client.get("/me/search/", params={"q": "zanzibar"}).json()
+    assert {(r["kind"], r["album_id"]) for r in results} == {("image", album_id), ("message", album_id)}
+    message = next(r for r in results if r["kind"] == "message")
+    assert message["chat_id"] == chat_id and "[zanzibar]" in message["snippet"]
+    assert client.get("/me/search/", params={"q": "zanzi"}).json()
+    assert client.get("/me/search/", params={"q": '"unbalanced AND ('}).status_code == 200
+
+    client.get("/auth/logout")
+    stranger = {"email": "stranger@example.com", "username": "stranger", "password": "pass"}
+    client.post("/auth/register", json=stranger)
+    client.post("/auth/login", json=stranger)
+    assert client.get("/me/search/", params={"q": "zanzibar"}).json() == []
+    own_album = client.post("/me/albums/new_album", json={"title": "Own"}).json()["id"]
+    client.post(f"/me/albums/{own_album}/images/create", json={"title": "Zanzibar", "image_path": "path"})
+    assert [r["album_id"] for r in client.get("/me/search/", params={"q": "zanzibar"}).json()] == [own_album]
+    client.get("/auth/logout")
+
+
+def test_bulk_image_operations_report_per_item_results():
+    register_and_login()
+    album_id = client.post("/me/albums/new_album", json={"title": "Bulk"}).json()["id"]
+    base = f"/me/albums/{album_id}/images"
+
+    created = client.post(
+        f"{base}/bulk/create",
+        json=[{"title": f"Img {n}", "description": "desc", "image_path": "path"} for n in range(3)],
+    ).json()
+    assert [item["status"] for item in created] == ["created"] * 3
+    ids = [item["id"] for item in created]
+    assert [image["title"] for image in client.get(f"{base}/").json()] == ["Img 0", "Img 1", "Img 2"]
+
+    updated = client.put(
+        f"{base}/bulk/update",
+        json=[
+            {"id": ids[0], "title": "First", "image_path": "path"},
+            {"id": 999999, "title": "Missing", "image_path": "path"},
+        ],
+    ).json()
+    assert [item["status"] for item in updated] == ["updated", "not_found"]
+    assert client.get(f"{base}/{ids[0]}").json()["title"] == "First"
+
+    chat_id = client.get(f"/chats/{ids[1]}").json()["id"]
+    client.post(f"/chats/{chat_id}/messages", json={"chat_id": chat_id, "content": "bye"})
+    deleted = client.post(f"{base}/bulk/delete", json=[ids[1], ids[2], 999999]).json()
+    assert [item["status"] for item in deleted] == ["deleted", "deleted", "not_found"]
+    assert [image["id"] for image in client.get(f"{base}/").json()] == [ids[0]]
+    assert client.get(f"/chats/{chat_id}/messages").status_code == 404
+
+
+def test_album_and_account_deletes_cascade_in_background_jobs():
+    from sqlmodel import Session, func, select
+    from app.database import engine
+    from app.utils.storage import blob_path
+    import app.models as models
+
+    owner = {"email": "leaving@example.com", "username": "leaving", "password": "pass"}
+    client.post("/auth/register", json=owner)
+    client.post("/auth/login", json=owner)
+    album_ids = [client.post("/me/albums/new_album", json={"title": f"A{n}"}).json()["id"] for n in range(2)]
+    blobs = []
+    for album_id in album_ids:
+        image = client.post(
+            f"/me/albums/{album_id}/images/upload",
+            files={"file": ("f.bin", f"payload {album_id}".encode(), "application/octet-stream")},
+            data={"title": "file"},
+        ).json()
+        image_id = image["id"]
+        blobs.append(blob_path(image["sha256"]))
+        chat_id = client.get(f"/chats/{image_id}").json()["id"]
+        client.post(f"/chats/{chat_id}/messages", json={"chat_id": chat_id, "content": "hello"})
+
+    def count(model, *where):
+        with Session(engine) as db:
+            return db.exec(select(func.count()).select_from(model).where(*where)).one()
+
+    resp = client.delete(f"/me/albums/delete/{album_ids[0]}")
+    assert resp.status_code == 202
+    job = wait_for_job(resp.json()["status_url"])
+    assert (job["status"], job["progress"]) == ("done", 3)
+    assert count(models.Image, models.Image.album_id == album_ids[0]) == 0
+    assert count(models.Album, models.Album.id == album_ids[1]) == 1
+    assert not os.path.exists(blobs[0]) and os.path.exists(blobs[1])
+
+    user_id = client.get("/me/").json()["id"]
+    resp = client.delete("/me/delete")
+    assert resp.status_code == 202
+    assert wait_for_job(resp.json()["status_url"])["status"] == "done"
+    assert count(models.User, models.User.id == user_id) == 0
+    assert count(models.Album, models.Album.owner_id == user_id) == 0
+    assert count(models.Message, models.Message.sender_id == user_id) == 0
+    assert client.get("/jobs/not-a-job").status_code == 404
+
+
+def test_account_delete_invalidates_other_users_chats():
+    from sqlmodel import Session
+    from app.database import engine
+    from app.routes.messages import manager
+    import app.models as models
+
+    register_and_login()
+    album_id = client.post("/me/albums/new_album", json={"title": "Shared"}).json()["id"]
+    image_id = client.post(
+        f"/me/albums/{album_id}/images/create",
+        json={"title": "Img", "image_path": "path"},
+    ).json()["id"]
+    chat_id = client.get(f"/chats/{image_id}").json()["id"]
+    client.post(f"/chats/{chat_id}/messages", json={"chat_id": chat_id, "content": "kept"})
+    client.get("/auth/logout")
+
+    guest = {"email": "guest@example.com", "username": "guest", "password": "pass"}
+    guest_id = client.post("/auth/register", json=guest).json()["id"]
+    with Session(engine) as db:
+        db.add(models.AlbumParticipant(album_id=album_id, user_id=guest_id))
+        db.commit()
+    client.post("/auth/login", json=guest)
+    client.post(f"/chats/{chat_id}/messages", json={"chat_id": chat_id, "content": "leaving"})
+    first = client.get(f"/chats/{chat_id}/messages")
+    assert [m["content"] for m in first.json()] == ["kept", "leaving"]
+    resp = client.delete("/me/delete")
+    assert wait_for_job(resp.json()["status_url"])["status"] == "done"
+
+    register_and_login()
+    resp = client.get(f"/chats/{chat_id}/messages", headers={"If-None-Match": first.headers["ETag"]})
+    assert resp.status_code == 200 and [m["content"] for m in resp.json()] == ["kept"]
+    assert manager.recent.since(chat_id, 0) == []
+
+
+def test_album_export_streams_a_zip():
+    import json
+    import zipfile
+
+    register_and_login()
+    album_id = client.post("/me/albums/new_album", json={"title": "Export"}).json()["id"]
+    payload = os.urandom(3 * 1024 * 1024)
+    image_id = client.post(
+        f"/me/albums/{album_id}/images/upload",
+        files={"file": ("big.png", payload, "image/png")},
+        data={"title": "Big one"},
+    ).json()["id"]
+    client.post(
+        f"/me/albums/{album_id}/images/create",
+        json={"title": "No file", "image_path": "path"},
+    )
+    chat_id = client.get(f"/chats/{image_id}").json()["id"]
+    for content in ("one", "two"):
+        client.post(f"/chats/{chat_id}/messages", json={"chat_id": chat_id, "content": content})
+
+    resp = client.get(f"/me/albums/{album_id}/export")
+    assert resp.status_code == 200
+    archive = zipfile.ZipFile(io.BytesIO(resp.content))
+    assert archive.testzip() is None
+    assert json.loads(archive.read("album.json"))["title"] == "Export"
+    images = [json.loads(line) for line in archive.read("images.ndjson").splitlines()]
+    assert [image["title"] for image in images] == ["Big one", "No file"]
+    assert archive.read(images[0]["file"]) == payload
+    assert [json.loads(line)["content"] for line in archive.read(images[0]["chat"]).splitlines()] == ["one", "two"]
+    assert images[1]["file"] is None and images[1]["chat"] is None
+
+    stats = client.get("/stats/exports", headers=OPS_HEADERS).json()
+    assert stats["completed"] >= 1 and stats["active"] == []
+
+    async def disconnect_early():
+        from app.utils.export import album_archive
+        stream = album_archive(album_id, 0)
+        await stream.__anext__()
+        await stream.aclose()
+
+    client.portal.call(disconnect_early)
+    assert client.get("/stats/exports", headers=OPS_HEADERS).json()["cancelled"] == stats["cancelled"] + 1
+
+
+def test_login_and_messages_are_rate_limited(monkeypatch):
+    from app.utils.ratelimit import login_limiter, message_limiter
+
+    register_and_login()
+    album_id = client.post("/me/albums/new_album", json={"title": "Limits"}).json()["id"]
+    image_id = client.post(
+        f"/me/albums/{album_id}/images/create",
+        json={"title": "Img", "image_path": "path"},
+    ).json()["id"]
+    chat_id = client.get(f"/chats/{image_id}").json()["id"]
+
+    monkeypatch.setattr(message_limiter, "burst", 2)
+    monkeypatch.setattr(message_limiter, "rate", 0.01)
+    message_limiter.clear()
+    statuses = [
+        client.post(f"/chats/{chat_id}/messages", json={"chat_id": chat_id, "content": "spam"}).status_code
+        for _ in range(3)
+    ]
+    assert statuses == [200, 200, 429]
+
+    monkeypatch.setattr(login_limiter, "burst", 1)
+    monkeypatch.setattr(login_limiter, "rate", 0.01)
+    login_limiter.clear()
+    assert client.post("/auth/login", json=USER_DATA).status_code == 200
+    resp = client.post("/auth/login", json=USER_DATA)
+    assert resp.status_code == 429 and int(resp.headers["Retry-After"]) > 0
+    login_limiter.clear()
+    message_limiter.clear()
+
+
+def test_pool_settings_come_from_the_environment_and_are_reported(monkeypatch):
+    from sqlalchemy import NullPool
+    from sqlalchemy.ext.asyncio import create_async_engine
+    from app.database import TimedQueuePool, pool_options
+
+    for name, value in {
+        "DB_POOL_SIZE": "7", "DB_MAX_OVERFLOW": "3", "DB_POOL_RECYCLE": "60",
+        "DB_POOL_PRE_PING": "false", "DB_POOL_TIMEOUT": "2.5",
+    }.items():
+        monkeypatch.setenv(name, value)
+    options = pool_options()
+    assert options == {
+        "poolclass": TimedQueuePool, "pool_size": 7, "max_overflow": 3,
+        "pool_recycle": 60, "pool_pre_ping": False, "pool_timeout": 2.5,
+    }
+    pooled = create_async_engine("sqlite+aiosqlite://", **options)
+    assert (pooled.pool.size(), pooled.pool.timeout()) == (7, 2.5)
+    monkeypatch.setenv("DB_POOL_MODE", "external")
+    assert pool_options() == {"poolclass": NullPool}
+
+    register_and_login()
+    client.get("/me/albums/")
+    stats = client.get("/stats/db", headers=OPS_HEADERS).json()
+    assert stats["write"]["pool"] == stats["read"]["pool"] == "TimedQueuePool"
+    assert (stats["write"]["size"], stats["read"]["size"]) == (1, 4)
+    assert stats["read"]["timeouts"] == 0 and stats["read"]["wait_ms_p50"] is not None
+
+
+def test_sqlite_connections_apply_the_configured_profile(monkeypatch, tmp_path):
+    from sqlalchemy import create_engine, event
+    from sqlalchemy.exc import OperationalError
+    from app.database import async_engine, read_engine, sqlite_pragmas
+
+    names = ("journal_mode", "foreign_keys", "synchronous", "busy_timeout", "temp_store", "query_only")
+
+    async def read_pragmas(target):
+        async with target.connect() as connection:
+            return {name: (await connection.exec_driver_sql(f"PRAGMA {name}")).scalar() for name in names}
+
+    writer = client.portal.call(read_pragmas, async_engine)
+    reader = client.portal.call(read_pragmas, read_engine)
+    production = {"journal_mode": "wal", "foreign_keys": 1, "synchronous": 1, "busy_timeout": 5000, "temp_store": 2}
+    assert writer == {**production, "query_only": 0}
+    assert reader == {**production, "query_only": 1}
+
+    monkeypatch.setenv("SQLITE_PROFILE", "basic")
+    basic = create_engine(f"sqlite:///{tmp_path / 'basic.db'}")
+    event.listen(basic, "connect", sqlite_pragmas(read_only=True))
+    with basic.connect() as connection:
+        pragmas = {name: connection.exec_driver_sql(f"PRAGMA {name}").scalar() for name in names}
+        with pytest.raises(OperationalError):
+            connection.exec_driver_sql("CREATE TABLE t (x)")
+    basic.dispose()
+    # busy_timeout is the sqlite3 module's own 5 second default.
+    assert pragmas == {
+        "journal_mode": "delete", "foreign_keys": 1, "synchronous": 2, "busy_timeout": 5000, "temp_store": 0, "query_only": 1,
+    }
+
+
+def test_requests_are_shed_when_the_event_loop_lags(monkeypatch):
+    from app.utils.admission import admission
+
+    monkeypatch.setattr(admission, "max_lag", -1)
+    resp = client.get("/")
+    assert resp.status_code == 503 and resp.headers["Retry-After"] == "1"
+    assert client.get("/stats/load", headers=OPS_HEADERS).json()["admission"]["rejected"] >= 1
+
+
+def test_metrics_report_routes_queries_and_sockets():
+    register_and_login()
+    album_id = client.post("/me/albums/new_album", json={"title": "Metrics"}).json()["id"]
+    image_id = client.post(
+        f"/me/albums/{album_id}/images/create",
+        json={"title": "Img", "image_path": "path"},
+    ).json()["id"]
+    chat_id = client.get(f"/chats/{image_id}").json()["id"]
+    client.get(f"/me/albums/{album_id}")
+
+    with client.websocket_connect(f"/chats/ws/{chat_id}"):
+        resp = client.get("/metrics", headers=OPS_HEADERS)
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("text/plain; version=0.0.4")
+    for headers in ({}, {"Authorization": "Bearer wrong"}):
+        assert client.get("/metrics", headers=headers).status_code == 401
+        assert client.get("/stats/load", headers=headers).status_code == 401
+    body = resp.text
+    assert 'http_request_duration_seconds_count{method="GET",route="/me/albums/{album_id}",status="200"}' in body
+    assert f'ws_connections{{chat_id="{chat_id}"}} 1' in body
+
+    queries = [
+        line for line in body.splitlines()
+        if line.startswith('http_request_db_queries_sum{route="/me/albums/{album_id}"}')
+    ]
+    assert queries and float(queries[0].split()[-1]) >= 1
+
+
+def test_read_endpoints_stay_within_query_budgets():
+    from app.utils.concurrent import album_access_cache
+    from app.utils.profiling import query_budget
+    from app.utils.security import user_cache
+
+    register_and_login()
+    album_id = client.post("/me/albums/new_album", json={"title": "Budget"}).json()["id"]
+    image_ids = [
+        client.post(
+            f"/me/albums/{album_id}/images/create",
+            json={"title": f"Img {i}", "image_path": "path"},
+        ).json()["id"]
+        for i in range(5)
+    ]
+    chat_ids = [client.get(f"/chats/{image_id}").json()["id"] for image_id in image_ids]
+    for chat_id in chat_ids:
+        client.post(f"/chats/{chat_id}/messages", json={"chat_id": chat_id, "content": "budget"})
+
+    # Worst case: identity and album access are resolved from the database.
+    budgets = {
+        "/me/albums/": 2,
+        f"/me/albums/{album_id}": 4,
+        f"/me/albums/{album_id}/images/": 4,
+        f"/me/albums/{album_id}/images/{image_ids[0]}": 3,
+        f"/me/albums/{album_id}/feed": 6,
+        f"/chats/{chat_ids[0]}/messages": 5,
+        "/me/search/?q=budget": 2,
+    }
+    for url, budget in budgets.items():
+        user_cache.clear()
+        album_access_cache.clear()
+        with query_budget(budget, max_repeats=1) as profiles:
+            assert client.get(url).status_code == 200
+        assert profiles and profiles[0].queries >= 1
+
+    with pytest.raises(AssertionError, match="Query budget of 0 exceeded"):
+        with query_budget(0):
+            client.get(f"/me/albums/{album_id}/feed")